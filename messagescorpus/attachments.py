@@ -0,0 +1,107 @@
+import threading
+from collections import OrderedDict
+
+from .corpus import get_message_db_paths
+from .snapshot import open_message_db
+
+
+"""
+Attachment metadata (file names, types and sizes), looked up lazily.
+
+Loading the corpus doesn't touch the attachment tables: messages with attachments show up as <MEDIA>, and every message
+carries its guid. When a page of messages is shown, the guids of its <MEDIA> messages are looked up with one batched
+IN (...) query per database (message.guid is indexed), and the results are kept in a small LRU so paging back and forth
+is free.
+"""
+
+SQLITE_ATTACHMENT_QUERY = """
+select
+ m.guid
+,a.transfer_name
+,a.filename
+,a.mime_type
+,a.total_bytes
+from
+message as m
+join message_attachment_join as maj on maj.message_id = m.rowid
+join attachment as a on a.rowid = maj.attachment_id
+
+where
+m.guid in ({placeholders})
+
+order by m.guid, a.rowid
+"""
+# Stay well under SQLite's limit on the number of bound parameters
+ATTACHMENT_QUERY_BATCH_SIZE = 500
+ATTACHMENT_CACHE_SIZE = 4096
+
+ATTACHMENT_CACHE = OrderedDict()
+ATTACHMENT_CACHE_LOCK = threading.Lock()
+
+
+def read_sqlite_attachment_rows(db_path, guids):
+    rows = []
+    with open_message_db(db_path) as conn:
+        cursor = conn.cursor()
+        for start in range(0, len(guids), ATTACHMENT_QUERY_BATCH_SIZE):
+            batch = guids[start:start + ATTACHMENT_QUERY_BATCH_SIZE]
+            cursor.execute(SQLITE_ATTACHMENT_QUERY.format(placeholders=','.join('?' * len(batch))), batch)
+            rows.extend(cursor.fetchall())
+        cursor.close()
+    return rows
+
+
+def get_attachments(guids, db_paths=None):
+    """
+    Returns attachment metadata for the given message guids, querying the database only for guids not already cached.
+
+    :param guids: iterable of message guids (None entries are ignored)
+    :return: {guid: list of {'name', 'path', 'mime_type', 'size'}} for every guid given (an empty list if it has none)
+    """
+
+    guids = list(dict.fromkeys(guid for guid in guids if guid is not None))
+    attachments = {}
+    with ATTACHMENT_CACHE_LOCK:
+        for guid in guids:
+            if guid in ATTACHMENT_CACHE:
+                ATTACHMENT_CACHE.move_to_end(guid)
+                attachments[guid] = ATTACHMENT_CACHE[guid]
+    missing = [guid for guid in guids if guid not in attachments]
+    if not missing:
+        return attachments
+
+    found = {guid: [] for guid in missing}
+    for db_path in get_message_db_paths(db_paths):
+        seen_paths = {guid: {attachment['path'] for attachment in found[guid]} for guid in missing}
+        for guid, transfer_name, filename, mime_type, total_bytes in read_sqlite_attachment_rows(db_path, missing):
+            if filename in seen_paths[guid]:
+                continue  # Same attachment read from an overlapping archive
+            found[guid].append({
+                'name': transfer_name or (filename.rsplit('/', 1)[-1] if filename else None),
+                'path': filename,
+                'mime_type': mime_type,
+                'size': total_bytes,
+            })
+    with ATTACHMENT_CACHE_LOCK:
+        for guid, guid_attachments in found.items():
+            ATTACHMENT_CACHE[guid] = guid_attachments
+        while len(ATTACHMENT_CACHE) > ATTACHMENT_CACHE_SIZE:
+            ATTACHMENT_CACHE.popitem(last=False)
+    attachments.update(found)
+    return attachments
+
+
+def clear_attachment_cache():
+    with ATTACHMENT_CACHE_LOCK:
+        ATTACHMENT_CACHE.clear()
+
+
+def format_size(num_bytes):
+    """Human-readable size, e.g. '2.3 MB'."""
+    if num_bytes is None:
+        return ''
+    for unit in ('B', 'KB', 'MB'):
+        if num_bytes < 1024:
+            return f'{num_bytes} {unit}' if unit == 'B' else f'{num_bytes:.1f} {unit}'
+        num_bytes /= 1024
+    return f'{num_bytes:.1f} GB'
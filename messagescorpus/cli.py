@@ -0,0 +1,226 @@
+import argparse
+import os
+import sys
+import time
+
+from .corpus import message_names_from_sqlite
+from .daemon import DEFAULT_SOCKET_PATH, handle_names, handle_request, load_query_state, resolved_db_paths, send_request, serve
+from .export import EXPORT_FORMATS, export_messages
+from .fuzzy import FUZZY_MAX_DISTANCE
+from .regex_guard import DEFAULT_REGEX_TIMEOUT_SECONDS
+
+
+"""
+Command-line interface: python -m messagescorpus <command> ...
+
+Queries go to a running daemon (`python -m messagescorpus daemon`) when there is one, and otherwise fall back to
+loading the corpus in-process.
+"""
+
+
+def run_query(request, socket_path=DEFAULT_SOCKET_PATH, use_daemon=True, db_paths=None):
+    """
+    Sends the request to the daemon if one is running and has loaded the same databases this query would read (the
+    default ones if `db_paths` is None), otherwise answers it in-process.
+    """
+
+    if use_daemon:
+        ping = send_request({'command': 'ping'}, socket_path=socket_path)
+        use_daemon = ping is not None and ping.get('db_paths') == resolved_db_paths(db_paths)
+    if use_daemon:
+        response = send_request(request, socket_path=socket_path)
+        if response is not None:
+            return response, 'daemon'
+    if request['command'] == 'names':
+        # Names come from the chat tables (cached on disk), so there's no need to load every message
+        return handle_names({'names': message_names_from_sqlite(include_phone_numbers=True, db_paths=db_paths)}, request), 'in-process'
+    return handle_request(load_query_state(db_paths=db_paths), request), 'in-process'
+
+
+def format_message(message, highlight_span=None):
+    text = message['message']
+    if highlight_span is not None:
+        start, end = highlight_span
+        text = f'{text[:start]}[[{text[start:end]}]]{text[end:]}'
+    return f"{message['timestamp']}  {message['sender']}: {text}"
+
+
+def print_search(response):
+    for block in response['blocks']:
+        if block['name'] is not None:
+            print(f"*** {block['name']} ***")
+        for row in block['rows']:
+            print(format_message(row, highlight_span=row['span']))
+        print()
+    print(f"{response['num_matches']} match{'es' if response['num_matches'] != 1 else ''}")
+    if response.get('timed_out'):
+        print('The regex search timed out; these are the matches found so far.')
+
+
+def print_show(response):
+    print(f"*** {response['name']} ({response['total_messages']} messages) ***")
+    for message in response['messages']:
+        print(format_message(message))
+
+
+def print_names(response):
+    for name in response['names']:
+        print(name)
+
+
+def print_stats(response):
+    threads = sorted(response['threads'].items(), key=lambda item: item[1]['message_count'], reverse=True)
+    for name, metadata in threads:
+        print(f"{metadata['message_count']:>8}  {metadata['first_timestamp']} to {metadata['last_timestamp']}  {name}")
+    print(f"{response['num_messages']} messages in {response['num_threads']} threads")
+    for snapshot in response.get('snapshots', []):
+        print(f"Snapshot of {snapshot['source_path']}: {snapshot['age_seconds']:.0f}s old, took {snapshot['refresh_seconds']}s to refresh")
+
+
+RESPONSE_PRINTERS = {
+    'search': print_search,
+    'show': print_show,
+    'names': print_names,
+    'stats': print_stats,
+}
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='messagescorpus', description='Search and browse your Messages history.')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET_PATH, help='Unix socket path of the query daemon')
+    parser.add_argument('--no-daemon', action='store_true', help='always load the corpus in-process')
+    parser.add_argument('--db', action='append', dest='db_paths', help='chat.db to read (repeat to merge several); the daemon is only used if it loaded the same databases')
+    parser.add_argument('--timing', action='store_true', help='print how long the query took and where it ran')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    search_parser = subparsers.add_parser('search', help='search message text')
+    search_parser.add_argument('query')
+    search_parser.add_argument('-n', '--name', help='only search this conversation')
+    search_parser.add_argument('-c', '--context', type=int, default=0, help='messages of context around each match')
+    search_parser.add_argument('-m', '--max-results', type=int, default=20)
+    search_parser.add_argument('-r', '--regex', action='store_true')
+    search_parser.add_argument('-a', '--any', action='store_true', help='treat the query as a comma-separated list of terms and match any of them')
+    search_parser.add_argument('-g', '--regex-group', type=int)
+    search_parser.add_argument('--regex-timeout', type=float, default=DEFAULT_REGEX_TIMEOUT_SECONDS, help='seconds before a regex search gives up')
+    search_parser.add_argument('--rank', action='store_true', help='return the most relevant matches (BM25) instead of the most recent')
+    search_parser.add_argument('--rank-window', type=int, default=1, help='with --rank, score windows of this many consecutive messages')
+    search_parser.add_argument('-f', '--fuzzy', action='store_true', help='match every word of the query, allowing typos')
+    search_parser.add_argument('--max-edits', type=int, choices=range(FUZZY_MAX_DISTANCE + 1), help='with --fuzzy, typos allowed per word (default depends on word length)')
+    search_parser.add_argument('--case-sensitive', action='store_true')
+    search_parser.add_argument('--oldest-first', action='store_true')
+
+    show_parser = subparsers.add_parser('show', help='show the most recent messages in a conversation, or those around a date')
+    show_parser.add_argument('name')
+    show_parser.add_argument('-l', '--limit', type=int, default=20, help='number of messages to show (0 for all)')
+    show_parser.add_argument('-d', '--date', help='show messages around this date (YYYY, YYYY-MM or YYYY-MM-DD) instead of the most recent')
+
+    names_parser = subparsers.add_parser('names', help='list conversation names')
+    names_parser.add_argument('--include-phone-numbers', action='store_true')
+
+    stats_parser = subparsers.add_parser('stats', help='message counts and date ranges per conversation')
+    stats_parser.add_argument('-n', '--name', help='only this conversation')
+
+    export_parser = subparsers.add_parser('export', help='stream messages to JSONL or CSV (always reads the database directly)')
+    export_parser.add_argument('output', help="output file ('-' for stdout), or directory with --shard")
+    export_parser.add_argument('--format', choices=EXPORT_FORMATS, default='jsonl')
+    export_parser.add_argument('--gzip', action='store_true', help='gzip the output')
+    export_parser.add_argument('--shard', action='store_true', help='write one file per conversation')
+    export_parser.add_argument('-n', '--thread', action='append', dest='threads', help='only this conversation (repeat for several)')
+    export_parser.add_argument('--after', help='only messages on or after this date (YYYY, YYYY-MM or YYYY-MM-DD)')
+    export_parser.add_argument('--before', help='only messages before this date')
+
+    daemon_parser = subparsers.add_parser('daemon', help='run the query daemon in the foreground')
+    daemon_parser.add_argument('--stop', action='store_true', help='stop a running daemon')
+    daemon_parser.add_argument('--reload', action='store_true', help='make a running daemon reload from the database')
+    return parser
+
+
+def build_request(args):
+    if args.command == 'search':
+        return {
+            'command': 'search',
+            'query': args.query,
+            'name': args.name,
+            'context': args.context,
+            'max_results': args.max_results,
+            'regex': args.regex,
+            'multi_term': args.any,
+            'rank': args.rank,
+            'rank_window': args.rank_window,
+            'fuzzy': args.fuzzy,
+            'max_edits': args.max_edits,
+            'regex_group': args.regex_group,
+            'regex_timeout': args.regex_timeout,
+            'ignore_case': not args.case_sensitive,
+            'most_recent': not args.oldest_first,
+        }
+    if args.command == 'show':
+        return {'command': 'show', 'name': args.name, 'limit': args.limit, 'date': args.date}
+    if args.command == 'names':
+        return {'command': 'names', 'include_phone_numbers': args.include_phone_numbers}
+    return {'command': 'stats', 'name': args.name}
+
+
+def run_daemon_command(args):
+    if not (args.stop or args.reload):
+        serve(socket_path=args.socket, db_paths=args.db_paths)
+        return 0
+    response = send_request({'command': 'shutdown' if args.stop else 'reload'}, socket_path=args.socket)
+    if response is None:
+        print(f'No daemon is listening on {args.socket}', file=sys.stderr)
+        return 1
+    print(response)
+    return 0
+
+
+def run_export_command(args):
+    try:
+        result = export_messages(
+            args.output,
+            export_format=args.format,
+            use_gzip=args.gzip,
+            shard=args.shard,
+            threads=args.threads,
+            after=args.after,
+            before=args.before,
+            db_paths=args.db_paths,
+            progress=True,
+        )
+    except ValueError as exc:
+        print(exc, file=sys.stderr)
+        return 1
+    print(
+        f"Exported {result['rows']} messages to {result['files']} file{'s' if result['files'] != 1 else ''} "
+        f"in {result['seconds']}s ({result['rows_per_second']} rows/s)",
+        file=sys.stderr,
+    )
+    return 0
+
+
+def run_command(args):
+    if args.command == 'daemon':
+        return run_daemon_command(args)
+    if args.command == 'export':
+        return run_export_command(args)
+
+    started_at = time.perf_counter()
+    response, source = run_query(build_request(args), socket_path=args.socket, use_daemon=not args.no_daemon, db_paths=args.db_paths)
+    if 'error' in response:
+        print(response['error'], file=sys.stderr)
+        return 1
+    RESPONSE_PRINTERS[args.command](response)
+    if args.timing:
+        print(f'({source}, {(time.perf_counter() - started_at) * 1000:.1f} ms)', file=sys.stderr)
+    return 0
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        result = run_command(args)
+        sys.stdout.flush()
+    except BrokenPipeError:
+        # The reader went away (e.g. `names | head`); point stdout at devnull so the flush at exit doesn't fail again
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 0
+    return result
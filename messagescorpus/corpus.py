@@ -1,11 +1,18 @@
+import bisect
+import collections
+import hashlib
+import heapq
+import json
 import re
 import os
-import pandas as pd
-import sqlite3
-import tabulate
-from termcolor import colored
+import sys
+import warnings
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-from .shared_utils import MY_DISPLAY_NAME, get_name_groups, get_primary_other_name
+from . import snapshot
+from .regex_guard import guarded_regex_search
+from .snapshot import message_db_state, open_message_db
+from .shared_utils import CORPUS_CACHE_DIR, MY_DISPLAY_NAME, NAME_GROUPS_PATH, get_name_groups, get_primary_other_name
 
 
 """
@@ -20,6 +27,15 @@ The obsolete code has been moved to legacy_utils.
 """
 
 RAW_MESSAGE_DB_PATH = os.path.join(os.environ['HOME'], 'Library', 'Messages', 'chat.db')
+# Optionally read (and merge) several databases, e.g. archived chat.db copies from old Macs, separated by os.pathsep
+MESSAGE_DB_PATHS_ENV_VAR = 'MESSAGESCORPUS_DB_PATHS'
+# Number of processes decoding attributedBody blobs during loads (0 or 1 decodes on the main thread); see get_decode_workers
+DECODE_WORKERS_ENV_VAR = 'MESSAGESCORPUS_DECODE_WORKERS'
+DEFAULT_DECODE_WORKERS = 0
+# Rows fetched from SQLite, and sent to the decode workers, at a time
+DECODE_BATCH_SIZE = 5000
+# Batches queued in the decode pool per worker, ahead of the one being turned into messages
+DECODE_BATCHES_PER_WORKER = 2
 OBJECT_REPLACEMENT_CHAR = "\ufffc"
 MEDIA_PLACEHOLDER = "<MEDIA>"
 
@@ -35,6 +51,8 @@ select
 ,case when m.text is null then '' when m.text = ' ' then '<MEDIA>' else m.text end as MessageText
 ,m.service
 ,m.attributedBody
+,m.guid
+,m.date as RawDate
 from
 message as m
 left join handle as h on m.handle_id = h.rowid
@@ -46,25 +64,83 @@ case when m.is_from_me = 1 then m.account else h.id end is not null
 order by m.date
 """
 
+# Thread ids and group participants, read from the chat membership tables rather than every message: group threads are
+# keyed by room_name (which messages carry as cache_roomnames) and 1:1 threads by the other person's handle. Chats with no
+# messages are left out, as they were when names came from the messages themselves
 SQLITE_NAME_QUERY = """
 select distinct
- coalesce(m.cache_roomnames, h.id) ThreadId
-,h2.id as participant
+ coalesce(c.room_name, h.id) ThreadId
+,case when c.room_name is not null then h.id end as participant
 from
-message as m
-left join handle as h on m.handle_id = h.rowid
-left join chat as c on m.cache_roomnames = c.room_name /* note: chat.room_name is not unique, this may cause one-to-many join */
-left join chat_handle_join as ch on c.rowid = ch.chat_id
-left join handle as h2 on ch.handle_id = h2.rowid
+chat as c
+left join chat_handle_join as ch on ch.chat_id = c.rowid
+left join handle as h on ch.handle_id = h.rowid
 
 where
-coalesce(m.cache_roomnames, h.id) is not null
+coalesce(c.room_name, h.id) is not null
+and exists (select 1 from chat_message_join cmj where cmj.chat_id = c.rowid)
 
 order by ThreadId
 """
 
-# Suppress pandas warnings when modifying the dataframes a certain way (it seems to complain even when we use df.loc)
-pd.options.mode.chained_assignment = None
+# Everything SQLITE_NAME_QUERY's result depends on, hashed by thread_names_fingerprint: the chat, membership and handle rows
+# (small tables) and whether each chat has messages (one primary key lookup per chat)
+SQLITE_NAME_FINGERPRINT_QUERIES = (
+    """
+    select c.rowid, c.room_name, c.chat_identifier, exists (select 1 from chat_message_join cmj where cmj.chat_id = c.rowid)
+    from chat as c order by c.rowid
+    """,
+    "select chat_id, handle_id from chat_handle_join order by chat_id, handle_id",
+    "select rowid, id from handle order by rowid",
+)
+THREAD_NAMES_CACHE_DIR = os.path.join(CORPUS_CACHE_DIR, 'thread_names')
+THREAD_NAMES_CACHE_FILES = 8
+
+# Same rows, limited to messages added after a known rowid, for consumers that ingest incrementally
+SQLITE_ROWS_SINCE_QUERY = SQLITE_QUERY.replace("\norder by m.date", "and m.rowid > ?\n\norder by m.date")
+# Same rows, limited to some threads. The filter is on the expression snapshots index (snapshot_message_thread_date): a
+# group thread's room name, or the handle rowid of a 1:1 thread (see thread_index_keys)
+SQLITE_THREAD_QUERY = SQLITE_QUERY.replace(
+    "\norder by m.date", "and coalesce(m.cache_roomnames, m.handle_id) in ({placeholders})\n\norder by m.date"
+)
+# Upper bound on SQLITE_QUERY's row count, for progress reports while rows are still being read
+SQLITE_COUNT_QUERY = "select count(*) from message"
+
+# Message counts, first/last dates and the latest message of each chat, read from chat_message_join rather than every
+# message: Apple's chat_message_join_idx_message_date_id_chat_id index (chat_id, message_date, message_id), which snapshots
+# also create, covers the per-chat aggregate and finds each chat's latest message with one seek, so no table is sorted.
+# Group chats are keyed by room_name and 1:1 chats by their handle, as in SQLITE_NAME_QUERY; handles that share an id (e.g.
+# one number over SMS and iMessage) have separate chats and come out as separate rows (see read_sqlite_summary_rows).
+# Counts include the rare message without a sender that SQLITE_QUERY leaves out
+SQLITE_SUMMARY_QUERY = """
+select
+ coalesce(c.room_name, h.id) ThreadId
+,stats.MessageCount
+,datetime((stats.FirstRawDate / 1000000000) + 978307200, 'unixepoch', 'localtime') as FirstTextDate
+,datetime((stats.LastRawDate / 1000000000) + 978307200, 'unixepoch', 'localtime') as LastTextDate
+,m.is_from_me
+,case when m.is_from_me = 1 then m.account else mh.id end as sender
+,case when m.text is null then '' when m.text = ' ' then '<MEDIA>' else m.text end as MessageText
+,m.attributedBody
+from (
+ select chat_id, count(*) as MessageCount, min(message_date) as FirstRawDate, max(message_date) as LastRawDate
+ from chat_message_join
+ group by chat_id
+) as stats
+join chat as c on c.rowid = stats.chat_id
+left join handle as h on c.room_name is null and h.rowid = (select ch.handle_id from chat_handle_join as ch where ch.chat_id = c.rowid)
+join message as m on m.rowid = (
+ select cmj.message_id from chat_message_join as cmj where cmj.chat_id = stats.chat_id order by cmj.message_date desc limit 1
+)
+left join handle as mh on m.handle_id = mh.rowid
+
+where
+coalesce(c.room_name, h.id) is not null
+"""
+
+# DataFrame-based display helpers live in .display so that importing this module (and starting the web app) doesn't pay for
+# pandas, tabulate and termcolor. They are still importable from here, and are loaded on first use.
+DISPLAY_FUNCTIONS = ('color_with_substr_highlight', 'color_codes', 'tabulate_df', 'tabulate_messages', 'print_from_corpus')
 
 PHONE_NAME_RE = re.compile(r"^[\d\+\-\(\)\.\s]+$")
 FAKE_CHAT_RE = re.compile("[a-z0-9]{32}")
@@ -100,7 +176,10 @@ def strip_attributed_body_artifacts(message_text):
 
 # https://github.com/my-other-github-account/imessage_tools
 def parse_message_text_from_sqlite_output_row(row):
-    raw_text, attributed_body = row[5], row[7]
+    return parse_message_text(row[5], row[7])
+
+
+def parse_message_text(raw_text, attributed_body):
     if raw_text != '':
         return raw_text
     if attributed_body is None:
@@ -155,135 +234,577 @@ def build_thread_name_map(thread_rows, name_groups):
     return base_thread_names
 
 
-def message_dict_from_sqlite(other_name_filter=None):
-    name_groups = get_name_groups()
-    with sqlite3.connect(RAW_MESSAGE_DB_PATH) as conn:
-        cursor = conn.cursor()
+def thread_display_name(thread_name_map, raw_thread_id, name_groups):
+    """
+    Display name for a message's raw thread id. Ids missing from the map (e.g. messages whose chat row has been deleted)
+    are named the way build_thread_name_map names a thread without known participants.
+    """
+
+    name = thread_name_map.get(raw_thread_id)
+    if name is None:
+        name = raw_thread_id if is_group_thread(raw_thread_id) else get_primary_other_name(raw_thread_id, name_groups=name_groups)
+    return name
+
+
+def get_message_db_paths(db_paths=None):
+    """
+    Normalizes the database path(s) to read from into a list.
+
+    :param db_paths: a single path, a list of paths, or None to use MESSAGESCORPUS_DB_PATHS (falling back to RAW_MESSAGE_DB_PATH)
+    """
+
+    if db_paths is None:
+        env_paths = os.environ.get(MESSAGE_DB_PATHS_ENV_VAR, '')
+        db_paths = [path for path in env_paths.split(os.pathsep) if path] or [RAW_MESSAGE_DB_PATH]
+    elif isinstance(db_paths, (str, os.PathLike)):
+        db_paths = [db_paths]
+    return list(db_paths)
+
+
+def refresh_db_snapshots(db_paths=None):
+    """Re-copies the snapshot of each database if snapshot mode is on, so the next load sees new messages."""
+    if not snapshot.SNAPSHOT_MODE:
+        return []
+    return [snapshot.refresh_snapshot(db_path) for db_path in get_message_db_paths(db_paths)]
+
+
+def message_data_version(db_paths=None):
+    """
+    Changes whenever loading from these databases could return different messages or names: a hash of each database's
+    state (see snapshot.message_db_state) and of name_groups.json's size and modification time. Every process reading the
+    same files gets the same version.
+    """
+
+    try:
+        stat_result = os.stat(NAME_GROUPS_PATH)
+        name_groups_state = (stat_result.st_size, stat_result.st_mtime_ns)
+    except FileNotFoundError:
+        name_groups_state = None
+    state = [(os.path.abspath(db_path), message_db_state(db_path)) for db_path in get_message_db_paths(db_paths)]
+    state.append(name_groups_state)
+    return hashlib.blake2b(repr(state).encode('utf-8'), digest_size=16).hexdigest()
+
+
+def thread_index_keys(conn, raw_thread_ids):
+    """Values of coalesce(cache_roomnames, handle_id) for these raw thread ids: the ids themselves and their handles' rowids."""
+    raw_thread_ids = list(raw_thread_ids)
+    placeholders = ', '.join('?' * len(raw_thread_ids))
+    handle_rowids = [row[0] for row in conn.execute(f'select rowid from handle where id in ({placeholders})', raw_thread_ids)]
+    return raw_thread_ids + handle_rowids
+
+
+def get_decode_workers():
+    """Decode processes to use by default, from MESSAGESCORPUS_DECODE_WORKERS (an invalid value falls back to the default)."""
+    value = os.environ.get(DECODE_WORKERS_ENV_VAR, '').strip()
+    if not value:
+        return DEFAULT_DECODE_WORKERS
+    try:
+        decode_workers = int(value)
+    except ValueError:
+        decode_workers = -1
+    if decode_workers < 0:
+        warnings.warn(f'Ignoring {DECODE_WORKERS_ENV_VAR}={value!r}, which is not a number of processes')
+        return DEFAULT_DECODE_WORKERS
+    return decode_workers
+
+
+def execute_message_query(conn, raw_thread_ids=None):
+    """
+    Runs the message query and returns the cursor.
+
+    :param raw_thread_ids: only read these threads (raw thread ids, as in SQLITE_QUERY's ThreadId)
+    """
+
+    cursor = conn.cursor()
+    if raw_thread_ids is None:
         cursor.execute(SQLITE_QUERY)
+    else:
+        index_keys = thread_index_keys(conn, raw_thread_ids)
+        cursor.execute(SQLITE_THREAD_QUERY.format(placeholders=', '.join('?' * len(index_keys))), index_keys)
+    return cursor
+
+
+def read_sqlite_db(db_path, raw_thread_ids=None):
+    """Message rows of one database, ordered by date (see execute_message_query)."""
+    with open_message_db(db_path) as conn:
+        cursor = execute_message_query(conn, raw_thread_ids=raw_thread_ids)
         output = cursor.fetchall()
-        cursor.execute(SQLITE_NAME_QUERY)
-        thread_rows = cursor.fetchall()
         cursor.close()
-    print(f"Read {len(output)} messages from database")
-    thread_name_map = build_thread_name_map(thread_rows, name_groups=name_groups)
+    return output
+
+
+def read_sqlite_db_since(db_path, since_rowid=0):
+    """Like read_sqlite_db, but only returns message rows whose rowid is greater than `since_rowid`."""
+    with open_message_db(db_path) as conn:
+        cursor = conn.cursor()
+        cursor.execute(SQLITE_ROWS_SINCE_QUERY, (since_rowid,))
+        output = cursor.fetchall()
+        cursor.close()
+    return output
+
+
+def merge_sqlite_outputs(outputs):
+    """
+    Merges per-database message rows (each already ordered by date) into one date-ordered stream,
+    dropping messages whose guid has already been seen in another database.
+    """
+
+    seen_guids = set()
+    merged = []
+    for row in heapq.merge(*outputs, key=lambda row: row[9]):
+        guid = row[8]
+        if guid is not None:
+            if guid in seen_guids:
+                continue
+            seen_guids.add(guid)
+        merged.append(row)
+    return merged
+
+
+def read_sqlite_rows(db_paths=None, raw_thread_ids=None):
+    """
+    Run the message query against the database(s), returning the message rows (see get_thread_names for thread names).
+    Multiple databases are read in parallel threads (sqlite releases the GIL while it executes queries) and merged by date.
+
+    :param raw_thread_ids: only read these threads (see read_sqlite_db)
+    """
+
+    db_paths = get_message_db_paths(db_paths)
+    if len(db_paths) == 1:
+        output = read_sqlite_db(db_paths[0], raw_thread_ids=raw_thread_ids)
+    else:
+        with ThreadPoolExecutor(max_workers=len(db_paths)) as executor:
+            outputs = list(executor.map(lambda db_path: read_sqlite_db(db_path, raw_thread_ids=raw_thread_ids), db_paths))
+        output = merge_sqlite_outputs(outputs)
+        print(f"Merged {sum(len(db_output) for db_output in outputs)} rows from {len(db_paths)} databases", file=sys.stderr)
+    # Progress goes to stderr so that piped command-line output is just the results
+    print(f"Read {len(output)} messages from database", file=sys.stderr)
+    return output
+
+
+def iter_sqlite_row_batches(db_paths=None, raw_thread_ids=None, batch_size=DECODE_BATCH_SIZE):
+    """
+    Yields the rows read_sqlite_rows returns, in batches. A single database is read with fetchmany, so each batch can be
+    decoded and turned into messages while SQLite reads the next (see iter_decoded_batches) and the raw rows are never all
+    in memory at once. Several databases are read in parallel and merged first (see read_sqlite_rows).
+    """
+
+    db_paths = get_message_db_paths(db_paths)
+    if len(db_paths) > 1:
+        output = read_sqlite_rows(db_paths=db_paths, raw_thread_ids=raw_thread_ids)
+        for start in range(0, len(output), batch_size):
+            yield output[start:start + batch_size]
+        return
+    num_rows = 0
+    with open_message_db(db_paths[0]) as conn:
+        cursor = execute_message_query(conn, raw_thread_ids=raw_thread_ids)
+        try:
+            while True:
+                batch = cursor.fetchmany(batch_size)
+                if not batch:
+                    break
+                num_rows += len(batch)
+                yield batch
+        finally:
+            cursor.close()
+    print(f"Read {num_rows} messages from database", file=sys.stderr)
+
+
+def count_message_rows(db_paths=None):
+    """Total messages in the database(s), an upper bound on the rows a load reads (for progress reports)."""
+    total = 0
+    for db_path in get_message_db_paths(db_paths):
+        with open_message_db(db_path) as conn:
+            total += conn.execute(SQLITE_COUNT_QUERY).fetchone()[0]
+    return total
+
+
+def thread_names_fingerprint(db_paths, name_groups):
+    """Hash of the chat membership state of each database (SQLITE_NAME_FINGERPRINT_QUERIES) and of the name groups."""
+    digest = hashlib.blake2b(digest_size=16)
+    for db_path in db_paths:
+        digest.update(repr(os.path.abspath(db_path)).encode('utf-8'))
+        with open_message_db(db_path) as conn:
+            for query in SQLITE_NAME_FINGERPRINT_QUERIES:
+                for row in conn.execute(query):
+                    digest.update(repr(row).encode('utf-8'))
+                digest.update(b'\n')
+    digest.update(json.dumps({name: sorted(alt_names) for name, alt_names in name_groups.items()}, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def get_thread_names(db_paths=None, name_groups=None):
+    """
+    Returns the thread rows (SQLITE_NAME_QUERY, merged across databases) and the map of raw thread ids to display names.
+    Both are cached on disk in THREAD_NAMES_CACHE_DIR, keyed by thread_names_fingerprint, so they're only rebuilt when
+    chat membership, handles or name_groups.json change.
+
+    :return: dictionary with keys 'thread_rows' and 'thread_name_map'
+    """
+
+    if name_groups is None:
+        name_groups = get_name_groups()
+    db_paths = get_message_db_paths(db_paths)
+    cache_path = os.path.join(THREAD_NAMES_CACHE_DIR, f'{thread_names_fingerprint(db_paths, name_groups)}.json')
+    try:
+        with open(cache_path) as f:
+            cached = json.load(f)
+        return {'thread_rows': [tuple(row) for row in cached['thread_rows']], 'thread_name_map': cached['thread_name_map']}
+    except (OSError, ValueError, KeyError):
+        pass
+
+    thread_rows = list(dict.fromkeys(row for db_path in db_paths for row in read_sqlite_thread_rows(db_path)))
+    thread_names = {'thread_rows': thread_rows, 'thread_name_map': build_thread_name_map(thread_rows, name_groups=name_groups)}
+    try:
+        os.makedirs(THREAD_NAMES_CACHE_DIR, exist_ok=True)
+        with open(cache_path + '.tmp', 'w') as f:
+            json.dump(thread_names, f)
+        os.replace(cache_path + '.tmp', cache_path)
+        # Keep the most recent few, e.g. for switching between sets of databases
+        cache_files = sorted(
+            (entry for entry in os.scandir(THREAD_NAMES_CACHE_DIR) if entry.name.endswith('.json')),
+            key=lambda entry: entry.stat().st_mtime,
+            reverse=True,
+        )
+        for entry in cache_files[THREAD_NAMES_CACHE_FILES:]:
+            os.remove(entry.path)
+    except OSError:
+        pass  # The cache is only an optimization
+    return thread_names
+
+
+def decode_message_texts(text_pairs):
+    """Decodes a batch of (text, attributedBody) pairs into message text; runs in the decode worker processes."""
+    return [normalize_message_text(parse_message_text(raw_text, attributed_body)) for raw_text, attributed_body in text_pairs]
+
+
+def _needs_decoding(row):
+    return row[5] == '' and row[7] is not None
+
+
+def _batch_text_pairs(batch):
+    return [(row[5], row[7]) for row in batch if _needs_decoding(row)]
+
+
+def _batch_message_texts(batch, decoded_texts):
+    decoded_texts = iter(decoded_texts)
+    return [next(decoded_texts) if _needs_decoding(row) else normalize_message_text(row[5]) for row in batch]
+
+
+def iter_decoded_batches(row_batches, decode_workers=0):
+    """
+    Yields (rows, message texts) for each batch of rows, in order.
+    With decode_workers > 1, each batch's attributedBody-only rows are submitted to a process pool as soon as the batch is
+    read, with at most DECODE_BATCHES_PER_WORKER batches per worker in flight, so reading, decoding and building messages
+    overlap while only those batches are held in memory.
+    """
+
+    if decode_workers <= 1:
+        for batch in row_batches:
+            yield batch, [normalize_message_text(parse_message_text_from_sqlite_output_row(row)) for row in batch]
+        return
+
+    in_flight = collections.deque()
+    with ProcessPoolExecutor(max_workers=decode_workers) as executor:
+        for batch in row_batches:
+            in_flight.append((batch, executor.submit(decode_message_texts, _batch_text_pairs(batch))))
+            if len(in_flight) >= decode_workers * DECODE_BATCHES_PER_WORKER:
+                batch, future = in_flight.popleft()
+                yield batch, _batch_message_texts(batch, future.result())
+        while in_flight:
+            batch, future = in_flight.popleft()
+            yield batch, _batch_message_texts(batch, future.result())
+
+
+def message_dict_from_row_batches(row_batches, thread_name_map, name_groups, other_name_filter=None, progress_callback=None,
+                                  progress_interval=10000, decode_workers=None, total_rows=None):
+    """
+    Builds the thread-keyed message dictionary from batches of raw SQLite message rows, as they arrive.
+
+    :param progress_callback: optional callable(rows_processed, total_rows), called every `progress_interval` rows and once at the end
+    :param decode_workers: processes to decode attributedBody blobs with (default from get_decode_workers; see iter_decoded_batches)
+    :param total_rows: number of rows (or an upper bound) to report progress against
+    """
+
+    thread_name_map = dict(thread_name_map)
+
+    def thread_name(raw_thread_id):
+        name = thread_name_map.get(raw_thread_id)
+        if name is None:
+            name = thread_name_map[raw_thread_id] = thread_display_name(thread_name_map, raw_thread_id, name_groups=name_groups)
+        return name
+
+    if other_name_filter is not None:
+        row_batches = ([row for row in batch if thread_name(row[1]) == other_name_filter] for batch in row_batches)
+    decode_workers = get_decode_workers() if decode_workers is None else decode_workers
     messages = {}
-    for row in output:
-        other_name = thread_name_map[row[1]]
-        if other_name_filter is not None and other_name != other_name_filter:
-            continue
-        messages[other_name] = messages.get(other_name, [])
-        # Thread naming is based on the conversation as a whole, but sender labeling should use the per-message sender column.
-        message_text = normalize_message_text(parse_message_text_from_sqlite_output_row(row))
-        messages[other_name].append({
-            'sender': get_sender_name(row[2], row[3], name_groups=name_groups),
-            'timestamp': row[4],
-            'message': message_text.strip(),
-        })
+    rows_processed = 0
+    for batch, message_texts in iter_decoded_batches(row_batches, decode_workers=decode_workers):
+        for row, message_text in zip(batch, message_texts):
+            if progress_callback is not None and rows_processed % progress_interval == 0:
+                progress_callback(rows_processed, max(total_rows or 0, rows_processed))
+            rows_processed += 1
+            other_name = thread_name(row[1])
+            messages[other_name] = messages.get(other_name, [])
+            # Thread naming is based on the conversation as a whole, but sender labeling should use the per-message sender column.
+            messages[other_name].append({
+                'sender': get_sender_name(row[2], row[3], name_groups=name_groups),
+                'timestamp': row[4],
+                'message': message_text.strip(),
+                # For looking up attachments lazily (see .attachments)
+                'guid': row[8],
+            })
+    if progress_callback is not None:
+        progress_callback(rows_processed, rows_processed)
     return messages
 
 
-def messages_from_sqlite(other_name_filter=None):
-    messages = message_dict_from_sqlite(other_name_filter=other_name_filter)
+def message_dict_from_rows(output, thread_name_map, name_groups, other_name_filter=None, progress_callback=None, progress_interval=10000, decode_workers=None):
+    """Builds the thread-keyed message dictionary from a list of raw SQLite message rows (see message_dict_from_row_batches)."""
+    row_batches = (output[start:start + DECODE_BATCH_SIZE] for start in range(0, len(output), DECODE_BATCH_SIZE))
+    return message_dict_from_row_batches(
+        row_batches, thread_name_map, name_groups, other_name_filter=other_name_filter, progress_callback=progress_callback,
+        progress_interval=progress_interval, decode_workers=decode_workers, total_rows=len(output),
+    )
+
+
+def raw_thread_ids_for_name(thread_name_map, name, name_groups):
+    """
+    Raw thread ids that may be displayed as `name`: those mapped to it, plus the name itself and its name_groups aliases,
+    which covers messages whose chat row is gone (see thread_display_name). message_dict_from_row_batches still filters exactly.
+    """
+
+    raw_thread_ids = {raw_thread_id for raw_thread_id, thread_name in thread_name_map.items() if thread_name == name}
+    raw_thread_ids.add(name)
+    raw_thread_ids.update(name_groups.get(name, []))
+    return sorted(raw_thread_ids)
+
+
+def message_dict_from_sqlite(other_name_filter=None, progress_callback=None, db_paths=None, decode_workers=None):
+    name_groups = get_name_groups()
+    thread_name_map = get_thread_names(db_paths=db_paths, name_groups=name_groups)['thread_name_map']
+    raw_thread_ids = None
+    if other_name_filter is not None:
+        # Read just this thread's rows (an index lookup in snapshots) rather than the whole database
+        raw_thread_ids = raw_thread_ids_for_name(thread_name_map, other_name_filter, name_groups=name_groups)
+    total_rows = count_message_rows(db_paths) if progress_callback is not None and other_name_filter is None else None
+    return message_dict_from_row_batches(
+        iter_sqlite_row_batches(db_paths=db_paths, raw_thread_ids=raw_thread_ids), thread_name_map, name_groups=name_groups,
+        other_name_filter=other_name_filter, progress_callback=progress_callback, decode_workers=decode_workers, total_rows=total_rows,
+    )
+
+
+def messages_from_sqlite(other_name_filter=None, db_paths=None):
+    messages = message_dict_from_sqlite(other_name_filter=other_name_filter, db_paths=db_paths)
     if len(messages) > 1:
         raise ValueError(f'Messages could not be returned as a flat list because it contains multiple names: {messages.keys()}')
     return list(messages.values())[0]
 
 
-def message_names_from_sqlite(include_phone_numbers=False):
-    name_groups = get_name_groups()
-    with sqlite3.connect(RAW_MESSAGE_DB_PATH) as conn:
+def message_names_from_thread_name_map(thread_name_map, include_phone_numbers=False):
+    thread_names = {thread_name for raw_thread_id, thread_name in thread_name_map.items() if not is_fake_chat(raw_thread_id)}
+    if not include_phone_numbers:
+        thread_names = {thread_name for thread_name in thread_names if not is_phone_like(thread_name)}
+    return sorted(thread_names)
+
+
+def message_names_from_thread_rows(thread_rows, name_groups, include_phone_numbers=False):
+    thread_name_map = build_thread_name_map(thread_rows, name_groups=name_groups)
+    return message_names_from_thread_name_map(thread_name_map, include_phone_numbers=include_phone_numbers)
+
+
+def read_sqlite_thread_rows(db_path):
+    with open_message_db(db_path) as conn:
         cursor = conn.cursor()
         cursor.execute(SQLITE_NAME_QUERY)
         output = cursor.fetchall()
         cursor.close()
-    output = [row for row in output if not is_fake_chat(row[0])]
-    thread_name_map = build_thread_name_map(output, name_groups=name_groups)
-    thread_names = set(thread_name_map.values())
-    if not include_phone_numbers:
-        thread_names = {thread_name for thread_name in thread_names if not is_phone_like(thread_name)}
-    return sorted(thread_names)
+    return output
+
+
+def message_names_from_sqlite(include_phone_numbers=False, db_paths=None):
+    thread_name_map = get_thread_names(db_paths=db_paths)['thread_name_map']
+    return message_names_from_thread_name_map(thread_name_map, include_phone_numbers=include_phone_numbers)
+
+
+def read_sqlite_summary_rows(db_path):
+    """SQLITE_SUMMARY_QUERY rows of one database, with the rows of handles that share an id combined into one per raw thread id."""
+    with open_message_db(db_path) as conn:
+        cursor = conn.cursor()
+        cursor.execute(SQLITE_SUMMARY_QUERY)
+        output = cursor.fetchall()
+        cursor.close()
+    rows_by_thread = {}
+    for row in output:
+        combined = rows_by_thread.get(row[0])
+        if combined is None:
+            rows_by_thread[row[0]] = row
+            continue
+        latest = row if row[3] > combined[3] else combined
+        rows_by_thread[row[0]] = (row[0], combined[1] + row[1], min(combined[2], row[2])) + latest[3:]
+    return list(rows_by_thread.values())
 
 
-def color_with_substr_highlight(s, color, substr_range, substr_color):
+def thread_summaries_from_rows(summary_rows, thread_name_map, name_groups, include_phone_numbers=False):
     """
-    Colorizes a string, with a substring of another color.
-    Simpler instead of using indices would be s.split(substr) and then substr.join(...) but we actually don't want to highlight all instances
-    of substr in case it was a regex group that doesn't actually match. So just highlight the actual match itself.
+    Folds per-raw-thread summary rows into per-conversation summaries, most recently active first.
+    The same raw thread id read from several databases (e.g. archived copies of one history) counts as one thread, using
+    its largest message count, so overlapping archives aren't double counted.
 
-    :param s: string to be colorized
-    :param color: string e.g. 'red', 'green' etc
-    :substr_range tuple of substring to colorize differently. e.g (1,4) colorizes 'est' of 'Testing'
-    :substr_color: string e.g. 'red', 'green' etc
+    :param summary_rows: SQLITE_SUMMARY_QUERY rows, from one or more databases
+    :return: list of dictionaries with keys name, message_count, first_timestamp, last_timestamp, last_sender and last_message
     """
 
-    idx_start, idx_end = substr_range
-    return colored(s[:idx_start], color) + colored(s[idx_start:idx_end], substr_color) + colored(s[idx_end:], color)
+    raw_summaries = {}
+    for raw_thread_id, message_count, first_timestamp, last_timestamp, is_from_me, sender, raw_text, attributed_body in summary_rows:
+        if is_fake_chat(raw_thread_id):
+            continue
+        raw_summary = raw_summaries.get(raw_thread_id)
+        if raw_summary is None:
+            raw_summary = raw_summaries[raw_thread_id] = {'message_count': 0, 'first_timestamp': first_timestamp, 'last_timestamp': ''}
+        raw_summary['message_count'] = max(raw_summary['message_count'], message_count)
+        raw_summary['first_timestamp'] = min(raw_summary['first_timestamp'], first_timestamp)
+        if last_timestamp > raw_summary['last_timestamp']:
+            raw_summary['last_timestamp'] = last_timestamp
+            raw_summary['last_sender'] = get_sender_name(is_from_me, sender, name_groups=name_groups)
+            raw_summary['last_message'] = normalize_message_text(parse_message_text(raw_text, attributed_body)).strip()
+
+    summaries = {}
+    for raw_thread_id, raw_summary in raw_summaries.items():
+        name = thread_display_name(thread_name_map, raw_thread_id, name_groups=name_groups)
+        if not include_phone_numbers and is_phone_like(name):
+            continue
+        summary = summaries.get(name)
+        if summary is None:
+            summaries[name] = dict(name=name, **raw_summary)
+            continue
+        summary['message_count'] += raw_summary['message_count']
+        summary['first_timestamp'] = min(summary['first_timestamp'], raw_summary['first_timestamp'])
+        if raw_summary['last_timestamp'] > summary['last_timestamp']:
+            summary.update(
+                last_timestamp=raw_summary['last_timestamp'],
+                last_sender=raw_summary['last_sender'],
+                last_message=raw_summary['last_message'],
+            )
+    return sorted(summaries.values(), key=lambda summary: summary['last_timestamp'], reverse=True)
+
+
+def thread_summaries_from_sqlite(include_phone_numbers=False, db_paths=None):
+    """
+    Per-conversation message counts, date ranges and latest message, without loading any thread's messages.
+    See thread_summaries_from_rows for the format.
+    """
+
+    name_groups = get_name_groups()
+    db_paths = get_message_db_paths(db_paths)
+    thread_name_map = get_thread_names(db_paths=db_paths, name_groups=name_groups)['thread_name_map']
+    summary_rows = [row for db_path in db_paths for row in read_sqlite_summary_rows(db_path)]
+    return thread_summaries_from_rows(summary_rows, thread_name_map, name_groups, include_phone_numbers=include_phone_numbers)
+
+
+def thread_metadata(message_list):
+    """Summarizes a single thread's message list: message count and first/last timestamps."""
+    return {
+        'message_count': len(message_list),
+        'first_timestamp': message_list[0]['timestamp'] if message_list else None,
+        'last_timestamp': message_list[-1]['timestamp'] if message_list else None,
+    }
 
 
-def tabulate_df(df, substr_highlights=None, my_color='yellow', other_color='green'):
+def load_all_threads(include_phone_numbers=False, progress_callback=None, db_paths=None, decode_workers=None):
     """
-    Pretty-prints a pandas DataFrame, colorizing the rows.
-    If substr_highlights is included, colorize the substrings specified by it .
+    Loads every thread, the thread names list and per-thread metadata from a single pass over the database.
+    Equivalent to calling message_dict_from_sqlite() and message_names_from_sqlite() separately, but only scans the database once.
 
-    :param df: pandas dataframe of a message list
-    :substr_highlights: dictionary of {index: (substr_start, substr_end)}
-        e.g. {2: (1, 4)} will highlight substring (1, 4) of the message in row index 2
-    :my_color: string e.g. 'red', 'green' etc to be used where sender is MY_DISPLAY_NAME
-    :other_color: string e.g. 'red', 'green' etc to be used where sender is not MY_DISPLAY_NAME
+    :param progress_callback: optional callable(rows_processed, total_rows) to report progress while building threads
+    :param db_paths: optional database path or list of paths to merge (see get_message_db_paths)
+    :param decode_workers: processes to decode attributedBody blobs with (see iter_decoded_batches)
+    :return: dictionary with keys 'messages' (name:messages), 'names' (sorted list) and 'metadata' (name:thread_metadata)
     """
 
-    if substr_highlights is None:
-        substr_highlights = {}
-    df = df[['timestamp', 'sender', 'message']]
-    for column in ['timestamp', 'message', 'sender']:  # Have to do sender last because we are also checking its original value
-        if column == 'message':  # highlight the matched text a different color
-            df[column] = df.apply(lambda row: color_with_substr_highlight(row[column], my_color if row.sender == MY_DISPLAY_NAME else other_color, substr_highlights.get(row.name, (0, 0)), 'red'), axis=1)
-        else:
-            df[column] = df.apply(lambda row: colored(row[column], my_color) if row.sender == MY_DISPLAY_NAME else colored(row[column], other_color), axis=1)
-    return tabulate.tabulate(df, showindex=True, headers=df.columns)
+    name_groups = get_name_groups()
+    thread_name_map = get_thread_names(db_paths=db_paths, name_groups=name_groups)['thread_name_map']
+    total_rows = count_message_rows(db_paths) if progress_callback is not None else None
+    messages = message_dict_from_row_batches(
+        iter_sqlite_row_batches(db_paths=db_paths), thread_name_map, name_groups=name_groups, progress_callback=progress_callback,
+        decode_workers=decode_workers, total_rows=total_rows,
+    )
+    return {
+        'messages': messages,
+        'names': message_names_from_thread_name_map(thread_name_map, include_phone_numbers=include_phone_numbers),
+        'metadata': {name: thread_metadata(message_list) for name, message_list in messages.items()},
+    }
 
 
-def tabulate_messages(message_list, start_index=0):
+def guarded_search_matches(message_obj, query, ignore_case=True, regex_group=None, max_results=20, most_recent=True, regex_timeout=None):
     """
-    Pretty-prints a list of messages by converting it to a pandas DataFrame.
-
-    :param message_list: list of message objects
-    :param start_index: optional index to start at, so the DataFrame indices show the original message indices instead of starting at 0
+    Regex version of search_matches that runs the pattern in a worker process with a time budget (see regex_guard).
+    All threads are searched in one worker call, then the hits are mapped back to their threads.
     """
 
-    df = pd.DataFrame(message_list)
-    if start_index:
-        df.index = range(start_index, start_index + len(message_list))
-    print(tabulate_df(df))
+    if isinstance(message_obj, list):
+        named_lists = [(None, message_obj)]
+    elif isinstance(message_obj, dict):
+        named_lists = [(name, message_list) for name, message_list in message_obj.items() if message_list]
+    else:
+        raise TypeError(f"message_obj was {type(message_obj)} which is not recognized")
+
+    ordered_by_name = [(name, list(reversed(message_list)) if most_recent else message_list) for name, message_list in named_lists]
+    texts = []
+    start_offsets = []
+    for _, ordered_list in ordered_by_name:
+        start_offsets.append(len(texts))
+        texts.extend(m['message'] for m in ordered_list)
+    # The worker keeps the last search's texts; the same lists (holding references, so they can't be mistaken for new
+    # lists at the same address) in the same order mean the same texts
+    texts_key = (most_recent, tuple((message_list, len(message_list)) for _, message_list in named_lists))
+    guarded_results = guarded_regex_search(
+        texts, query, ignore_case=ignore_case, regex_group=regex_group, max_results=max_results, timeout=regex_timeout, texts_key=texts_key
+    )
+
+    matches = {name: [] for name, _ in ordered_by_name}
+    for text_idx, span in guarded_results['matches']:
+        list_idx = bisect.bisect_right(start_offsets, text_idx) - 1
+        matches[ordered_by_name[list_idx][0]].append((text_idx - start_offsets[list_idx], span))
+    num_matches = len(guarded_results['matches'])
+    if isinstance(message_obj, list) and not num_matches and not guarded_results['timed_out']:
+        return
+    return {
+        'ordered_lists': {name: ordered_list for name, ordered_list in ordered_by_name if matches[name]},
+        'matches': matches,
+        'num_matches': num_matches,
+        'timed_out': guarded_results['timed_out'],
+    }
 
 
-def search_corpus(message_obj, query, ignore_case=True, regex=False, regex_group=None, context=0, max_results=20, most_recent=True):
+def search_matches(message_obj, query, ignore_case=True, regex=False, regex_group=None, max_results=20, most_recent=True, regex_timeout=None):
     """
-    Searches a collection of messages for a substring or regex patter and returns the matching DataFrames and metadata.
+    Searches a collection of messages for a substring or regex pattern, without building any DataFrames.
+    Takes the same arguments as search_corpus, and returns the matched message lists in search order instead of DataFrames.
 
-    :param message_obj: one of the following:
-        - dictionary of name:messages. E.g. the `messages` object that is returned by parse_files()
-        - list of messages. E.g. if `messages` was returned by parse_files(), this can be messages['Dan']
-    :param query: string or regex pattern to search
-    :param ignore_case: boolean whether to search case-insensitive
-    :param regex: use regex search (otherwise just substring search)
-    :param regex_group: group number of regex pattern to return (otherwise return full match)
-    :param context: number of rows on either side of matched row to display as well
+    :param regex_timeout: if set, regex searches run in a worker process and stop after this many seconds (see regex_guard),
+        and obviously exponential patterns are rejected with regex_guard.UnsafeRegexError
+    :return: dictionary with keys 'ordered_lists' (name:list of messages in search order), 'matches' (name:list of (index, span)),
+        'num_matches' and 'timed_out', or None if message_obj is a list with no matches
     """
 
+    if regex and regex_timeout is not None:
+        return guarded_search_matches(message_obj, query, ignore_case=ignore_case, regex_group=regex_group, max_results=max_results, most_recent=most_recent, regex_timeout=regex_timeout)
+
     regex_group = [regex_group] if regex_group else []
     regex_flags = re.IGNORECASE if ignore_case else 0
+    folded_query = query.lower() if ignore_case else query
     def _search(query, message):
         if regex:
             match = re.search(query, message, flags=regex_flags)
             return match.span(*regex_group) if match else None
         else:
-            match = message.lower().find(query.lower()) if ignore_case else message.find(query)
+            match = message.lower().find(folded_query) if ignore_case else message.find(query)
             return (match, match + len(query)) if match != -1 else None
 
     num_matches = 0
     matches = {}
-    dfs = {}
+    ordered_lists = {}
     if isinstance(message_obj, list):
         message_list = message_obj
         matches[None] = []
@@ -297,7 +818,7 @@ def search_corpus(message_obj, query, ignore_case=True, regex=False, regex_group
                     break
         if not matches[None]:
             return
-        dfs[None] = pd.DataFrame(ordered_list)
+        ordered_lists[None] = ordered_list
     elif isinstance(message_obj, dict):
         for name, message_list in message_obj.items():
             if not message_list:
@@ -313,42 +834,48 @@ def search_corpus(message_obj, query, ignore_case=True, regex=False, regex_group
                         break
             if not matches[name]:
                 continue
-            dfs[name] = pd.DataFrame(ordered_list)
+            ordered_lists[name] = ordered_list
             if num_matches == max_results:
                 break
     else:
         raise TypeError(f"message_obj was {type(message_obj)} which is not recognized")
 
     return {
-        'dfs': dfs,
+        'ordered_lists': ordered_lists,
         'matches': matches,
         'num_matches': num_matches,
+        'timed_out': False,
     }
 
 
-def print_from_corpus(message_obj, query, ignore_case=True, regex=False, regex_group=None, context=0, max_results=20, most_recent=True):
+def search_corpus(message_obj, query, ignore_case=True, regex=False, regex_group=None, context=0, max_results=20, most_recent=True):
     """
-    Searches a collection of messages and prints the results as tabulated DataFrames.
+    Searches a collection of messages for a substring or regex patter and returns the matching DataFrames and metadata.
+
+    :param message_obj: one of the following:
+        - dictionary of name:messages. E.g. the `messages` object that is returned by parse_files()
+        - list of messages. E.g. if `messages` was returned by parse_files(), this can be messages['Dan']
+    :param query: string or regex pattern to search
+    :param ignore_case: boolean whether to search case-insensitive
+    :param regex: use regex search (otherwise just substring search)
+    :param regex_group: group number of regex pattern to return (otherwise return full match)
+    :param context: number of rows on either side of matched row to display as well
     """
 
-    search_results = search_corpus(message_obj, query, ignore_case=ignore_case, regex=regex, regex_group=regex_group, context=context, max_results=max_results, most_recent=most_recent)
+    search_results = search_matches(message_obj, query, ignore_case=ignore_case, regex=regex, regex_group=regex_group, max_results=max_results, most_recent=most_recent)
     if search_results is None:
         return
 
-    dfs = search_results['dfs']
-    matches = search_results['matches']
-    num_matches = search_results['num_matches']
-    for name, df in dfs.items():
-        context_offset = context
-        if most_recent:
-            # So that each conversation snippet is still ordered naturally
-            df = df.iloc[::-1]
-            context_offset = -context
-        if name is not None:
-            print(f"*** MATCHES FOR {name} ***")
-        for message_idx, substr_range in matches[name]:
-            sub_df = df.loc[(message_idx-context_offset):(message_idx+context_offset), :]
-            print(tabulate_df(sub_df, substr_highlights={message_idx: substr_range}))
-
-    if num_matches == max_results:
-        print(f"*** NOTE: Maximum of {num_matches} was reached. ***")
+    import pandas as pd
+    return {
+        'dfs': {name: pd.DataFrame(ordered_list) for name, ordered_list in search_results['ordered_lists'].items()},
+        'matches': search_results['matches'],
+        'num_matches': search_results['num_matches'],
+    }
+
+
+def __getattr__(name):
+    if name in DISPLAY_FUNCTIONS:
+        from . import display
+        return getattr(display, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
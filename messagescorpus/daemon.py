@@ -0,0 +1,313 @@
+import hashlib
+import json
+import os
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+
+from .corpus import get_message_db_paths, is_phone_like, load_all_threads, refresh_db_snapshots, search_matches
+from .multisearch import search_terms
+from .indexes import build_thread_index, centered_window, position_for_date
+from .query_language import is_structured_query, normalize_date, resolve_name, structured_search
+from .fuzzy import fuzzy_search
+from .ranking import ranked_search
+from .regex_guard import DEFAULT_REGEX_TIMEOUT_SECONDS
+from .snapshot import snapshot_status
+from .shared_utils import CORPUS_CACHE_DIR, get_name_groups
+from .textblob import build_text_blob, open_text_blob, search_text_blob
+
+
+"""
+Resident query daemon.
+
+Keeps the normalized corpus, name groups and per-thread metadata loaded in one long-running process, and answers
+JSON requests over a Unix domain socket so that repeated command-line queries don't pay the full load cost each time.
+Requests and responses are single lines of JSON. The same request handler is used in-process when no daemon is running.
+"""
+
+DEFAULT_SOCKET_PATH = os.environ.get(
+    'MESSAGESCORPUS_SOCKET', os.path.join(tempfile.gettempdir(), f'messagescorpus-{os.getuid()}.sock')
+)
+CLIENT_TIMEOUT_SECONDS = 60
+
+
+def text_blob_dir(db_paths=None):
+    """Where the daemon keeps the memory-mapped text blob for a set of databases."""
+    key = hashlib.sha1(os.pathsep.join(db_paths or []).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(CORPUS_CACHE_DIR, f'textblob-{key}')
+
+
+def load_query_state(db_paths=None, use_text_blob=False):
+    """
+    Loads everything the request handler needs in a single database pass.
+
+    :param use_text_blob: also write the text blob (see textblob) and map it, so plain substring searches scan it
+        instead of the message dictionaries
+    """
+
+    started_at = time.time()
+    corpus = load_all_threads(include_phone_numbers=True, db_paths=db_paths)
+    text_blob = None
+    if use_text_blob:
+        blob_dir = text_blob_dir(db_paths)
+        build_text_blob(corpus['messages'], blob_dir)
+        text_blob = open_text_blob(blob_dir)
+    return {
+        'db_paths': db_paths,
+        'messages': corpus['messages'],
+        'names': corpus['names'],
+        'metadata': corpus['metadata'],
+        # Per-thread lookup structures for structured, ranked and fuzzy queries, built on first use
+        'indexes': {},
+        'name_groups': get_name_groups(),
+        'text_blob': text_blob,
+        'loaded_at': time.time(),
+        'load_seconds': round(time.time() - started_at, 3),
+    }
+
+
+def resolved_db_paths(db_paths=None):
+    """Absolute paths of the databases a load reads, for comparing a client's --db with what the daemon loaded."""
+    return [os.path.abspath(db_path) for db_path in get_message_db_paths(db_paths)]
+
+
+def resolve_thread_name(state, name):
+    """
+    Maps a name (in any case), alias, phone number or email to the thread name it is stored under (or None if there's no
+    such thread), the same way in-process queries resolve names.
+    """
+
+    return resolve_name(name, state['messages'], name_groups=state['name_groups'])
+
+
+def build_search_blocks(search_results, context, most_recent):
+    """Slices each match and its surrounding context out of the ordered message lists, in chronological order."""
+    blocks = []
+    if search_results is None:
+        return blocks
+    for name, matches in search_results['matches'].items():
+        ordered_list = search_results['ordered_lists'].get(name)
+        if ordered_list is None:
+            continue
+        for message_idx, match_span in matches:
+            row_indices = range(max(message_idx - context, 0), min(message_idx + context, len(ordered_list) - 1) + 1)
+            if most_recent:
+                row_indices = reversed(row_indices)
+            blocks.append({
+                'name': name,
+                'rows': [
+                    dict(ordered_list[row_idx], is_match=row_idx == message_idx, span=match_span if row_idx == message_idx else None)
+                    for row_idx in row_indices
+                ],
+            })
+    return blocks
+
+
+def handle_search(state, request):
+    message_obj = state['messages']
+    if request.get('name'):
+        thread_name = resolve_thread_name(state, request['name'])
+        if thread_name is None:
+            return {'error': f'No conversation found for "{request["name"]}".'}
+        message_obj = {thread_name: state['messages'][thread_name]}
+    most_recent = request.get('most_recent', True)
+    context = request.get('context', 0)
+    if request.get('rank') and not request.get('regex') and not request.get('multi_term'):
+        search_results = ranked_search(
+            message_obj,
+            request['query'],
+            max_results=request.get('max_results', 20),
+            most_recent=most_recent,
+            window=request.get('rank_window', 1),
+            indexes=state['indexes'],
+        )
+    elif request.get('fuzzy') and not request.get('regex') and not request.get('multi_term'):
+        search_results = fuzzy_search(
+            message_obj,
+            request['query'],
+            max_results=request.get('max_results', 20),
+            most_recent=most_recent,
+            max_distance=request.get('max_edits'),
+            indexes=state['indexes'],
+        )
+    elif not request.get('regex') and not request.get('multi_term') and is_structured_query(request['query']):
+        search_results = structured_search(
+            message_obj,
+            request['query'],
+            ignore_case=request.get('ignore_case', True),
+            max_results=request.get('max_results', 20),
+            most_recent=most_recent,
+            indexes=state['indexes'],
+            name_groups=state['name_groups'],
+        )
+    elif request.get('multi_term'):
+        search_results = search_terms(
+            message_obj,
+            request['query'],
+            ignore_case=request.get('ignore_case', True),
+            max_results=request.get('max_results', 20),
+            most_recent=most_recent,
+        )
+    elif state.get('text_blob') is not None and not request.get('regex'):
+        search_results = search_text_blob(
+            state['text_blob'],
+            request['query'],
+            ignore_case=request.get('ignore_case', True),
+            max_results=request.get('max_results', 20),
+            most_recent=most_recent,
+            names=list(message_obj),
+            message_obj=message_obj,
+        )
+    else:
+        search_results = search_matches(
+            message_obj,
+            request['query'],
+            ignore_case=request.get('ignore_case', True),
+            regex=request.get('regex', False),
+            regex_group=request.get('regex_group'),
+            max_results=request.get('max_results', 20),
+            most_recent=most_recent,
+            regex_timeout=request.get('regex_timeout', DEFAULT_REGEX_TIMEOUT_SECONDS),
+        )
+    return {
+        'blocks': build_search_blocks(search_results, context=context, most_recent=most_recent),
+        'num_matches': 0 if search_results is None else search_results['num_matches'],
+        'timed_out': search_results is not None and search_results['timed_out'],
+    }
+
+
+def handle_show(state, request):
+    thread_name = resolve_thread_name(state, request['name'])
+    if thread_name is None:
+        return {'error': f'No conversation found for "{request["name"]}".'}
+    message_list = state['messages'][thread_name]
+    limit = request.get('limit', 20)
+    if request.get('date') and limit:
+        try:
+            date_prefix = normalize_date(request['date'])
+        except ValueError as exc:
+            return {'error': str(exc)}
+        thread_index = state['indexes'].get(thread_name)
+        if thread_index is None:
+            thread_index = state['indexes'][thread_name] = build_thread_index(message_list)
+        start, end = centered_window(len(message_list), position_for_date(thread_index, date_prefix), limit)
+        messages = message_list[start:end]
+    else:
+        messages = message_list[-limit:] if limit else message_list
+    return {
+        'name': thread_name,
+        'messages': messages,
+        'total_messages': len(message_list),
+    }
+
+
+def handle_names(state, request):
+    names = state['names']
+    if not request.get('include_phone_numbers', False):
+        names = [name for name in names if not is_phone_like(name)]
+    return {'names': names}
+
+
+def handle_stats(state, request):
+    metadata = state['metadata']
+    if request.get('name'):
+        thread_name = resolve_thread_name(state, request['name'])
+        if thread_name is None:
+            return {'error': f'No conversation found for "{request["name"]}".'}
+        metadata = {thread_name: metadata[thread_name]}
+    return {
+        'threads': metadata,
+        'num_threads': len(metadata),
+        'num_messages': sum(thread['message_count'] for thread in metadata.values()),
+        'loaded_at': state['loaded_at'],
+        'load_seconds': state['load_seconds'],
+        'snapshots': snapshot_status(),
+    }
+
+
+REQUEST_HANDLERS = {
+    'search': handle_search,
+    'show': handle_show,
+    'names': handle_names,
+    'stats': handle_stats,
+    'ping': lambda state, request: {'pong': True, 'loaded_at': state['loaded_at'], 'db_paths': resolved_db_paths(state['db_paths'])},
+}
+
+
+def handle_request(state, request):
+    handler = REQUEST_HANDLERS.get(request.get('command'))
+    if handler is None:
+        return {'error': f'Unknown command: {request.get("command")}'}
+    try:
+        return handler(state, request)
+    except Exception as exc:  # Report errors to the client rather than killing the connection
+        return {'error': f'{type(exc).__name__}: {exc}'}
+
+
+class QueryRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        server = self.server
+        if request.get('command') == 'reload':
+            with server.state_lock:
+                refresh_db_snapshots(server.state['db_paths'])
+                server.state = load_query_state(db_paths=server.state['db_paths'], use_text_blob=server.state['text_blob'] is not None)
+            response = {'reloaded': True, 'load_seconds': server.state['load_seconds']}
+        elif request.get('command') == 'shutdown':
+            response = {'shutting_down': True}
+        else:
+            response = handle_request(server.state, request)
+        self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+        self.wfile.flush()
+        if request.get('command') == 'shutdown':
+            # Only after replying, since closing the server doesn't wait for this handler thread
+            threading.Thread(target=server.shutdown, daemon=True).start()
+
+
+class QueryServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(socket_path=DEFAULT_SOCKET_PATH, db_paths=None, use_text_blob=True):
+    """Loads the corpus and answers requests on `socket_path` until a shutdown request is received."""
+    if send_request({'command': 'ping'}, socket_path=socket_path) is not None:
+        raise RuntimeError(f'A daemon is already listening on {socket_path}')
+    if os.path.exists(socket_path):
+        os.remove(socket_path)  # Stale socket left behind by a daemon that didn't exit cleanly
+    state = load_query_state(db_paths=db_paths, use_text_blob=use_text_blob)
+    # The socket is usually in the shared temp directory, so it's created owner-only rather than chmod-ed after binding
+    old_umask = os.umask(0o177)
+    try:
+        server = QueryServer(socket_path, QueryRequestHandler)
+    finally:
+        os.umask(old_umask)
+    server.state = state
+    server.state_lock = threading.Lock()
+    print(f"Serving {sum(len(v) for v in state['messages'].values())} messages on {socket_path} (loaded in {state['load_seconds']}s)")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+def send_request(request, socket_path=DEFAULT_SOCKET_PATH, timeout=CLIENT_TIMEOUT_SECONDS):
+    """
+    Sends one request to a running daemon.
+
+    :return: the response dictionary, or None if no daemon is listening on `socket_path`
+    """
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socket_path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        return None
+    with sock, sock.makefile('rb') as response_file:
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        return json.loads(response_file.readline())
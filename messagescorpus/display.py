@@ -0,0 +1,135 @@
+import pandas as pd
+import tabulate
+from termcolor import colored
+
+from .corpus import search_corpus
+from .shared_utils import MY_DISPLAY_NAME
+
+
+"""
+Terminal display helpers for message lists and search results.
+These depend on pandas, tabulate and termcolor, so they're kept out of corpus.py and only imported on first use.
+"""
+
+# Suppress pandas warnings when modifying the dataframes a certain way (it seems to complain even when we use df.loc)
+pd.options.mode.chained_assignment = None
+
+
+def color_with_substr_highlight(s, color, substr_range, substr_color):
+    """
+    Colorizes a string, with a substring of another color.
+    Simpler instead of using indices would be s.split(substr) and then substr.join(...) but we actually don't want to highlight all instances
+    of substr in case it was a regex group that doesn't actually match. So just highlight the actual match itself.
+
+    :param s: string to be colorized
+    :param color: string e.g. 'red', 'green' etc
+    :substr_range tuple of substring to colorize differently. e.g (1,4) colorizes 'est' of 'Testing'
+    :substr_color: string e.g. 'red', 'green' etc
+    """
+
+    idx_start, idx_end = substr_range
+    return colored(s[:idx_start], color) + colored(s[idx_start:idx_end], substr_color) + colored(s[idx_end:], color)
+
+
+def color_codes(color, enabled=True):
+    """
+    The (prefix, suffix) escape codes termcolor wraps text of this color in, computed once so whole columns can be
+    colorized with plain string formatting. Both are empty if `enabled` is False or termcolor has color turned off.
+    """
+
+    if not enabled:
+        return '', ''
+    prefix, _, suffix = colored('\0', color).partition('\0')
+    return prefix, suffix
+
+
+def tabulate_df(df, substr_highlights=None, my_color='yellow', other_color='green', highlight_color='red', color=True):
+    """
+    Pretty-prints a pandas DataFrame, colorizing the rows.
+    If substr_highlights is included, colorize the substrings specified by it .
+
+    :param df: pandas dataframe of a message list
+    :substr_highlights: dictionary of {index: (substr_start, substr_end)}
+        e.g. {2: (1, 4)} will highlight substring (1, 4) of the message in row index 2
+    :my_color: string e.g. 'red', 'green' etc to be used where sender is MY_DISPLAY_NAME
+    :other_color: string e.g. 'red', 'green' etc to be used where sender is not MY_DISPLAY_NAME
+    :highlight_color: string e.g. 'red', 'green' etc for the highlighted substrings
+    :color: False for plain text, e.g. when writing to a file
+    """
+
+    if substr_highlights is None:
+        substr_highlights = {}
+    my_prefix, reset = color_codes(my_color, color)
+    other_prefix, _ = color_codes(other_color, color)
+    highlight_prefix, _ = color_codes(highlight_color, color)
+    # Escape codes per row, from one vectorized comparison instead of a per-row apply for each column
+    is_me = (df['sender'] == MY_DISPLAY_NAME).tolist()
+    prefixes = [my_prefix if me else other_prefix for me in is_me]
+
+    timestamps = [f'{prefix}{timestamp}{reset}' for prefix, timestamp in zip(prefixes, df['timestamp'].tolist())]
+    senders = [f'{prefix}{sender}{reset}' for prefix, sender in zip(prefixes, df['sender'].tolist())]
+    messages = []
+    for idx, prefix, message in zip(df.index.tolist(), prefixes, df['message'].tolist()):
+        substr_range = substr_highlights.get(idx)
+        if substr_range is None:
+            messages.append(f'{prefix}{message}{reset}')
+        else:
+            # Highlight only the actual match, not every instance of the matched text (see color_with_substr_highlight)
+            idx_start, idx_end = substr_range
+            messages.append(
+                f'{prefix}{message[:idx_start]}{reset}{highlight_prefix}{message[idx_start:idx_end]}{reset}'
+                f'{prefix}{message[idx_end:]}{reset}'
+            )
+    # Without escape codes, tabulate would otherwise reformat and right-align messages that look like numbers
+    return tabulate.tabulate(
+        zip(df.index.tolist(), timestamps, senders, messages),
+        headers=['timestamp', 'sender', 'message'],
+        disable_numparse=[1, 2, 3],
+    )
+
+
+def tabulate_messages(message_list, start_index=0, color=True):
+    """
+    Pretty-prints a list of messages by converting it to a pandas DataFrame.
+
+    :param message_list: list of message objects
+    :param start_index: optional index to start at, so the DataFrame indices show the original message indices instead of starting at 0
+    :param color: False for plain text
+    """
+
+    df = pd.DataFrame(message_list)
+    if start_index:
+        df.index = range(start_index, start_index + len(message_list))
+    print(tabulate_df(df, color=color))
+
+
+def print_from_corpus(message_obj, query, ignore_case=True, regex=False, regex_group=None, context=0, max_results=20, most_recent=True,
+                      color=True, file=None):
+    """
+    Searches a collection of messages and prints the results as tabulated DataFrames, one block per match as it's rendered.
+
+    :param color: False for plain text, e.g. when piping to a file
+    :param file: file to write to (stdout by default)
+    """
+
+    search_results = search_corpus(message_obj, query, ignore_case=ignore_case, regex=regex, regex_group=regex_group, context=context, max_results=max_results, most_recent=most_recent)
+    if search_results is None:
+        return
+
+    dfs = search_results['dfs']
+    matches = search_results['matches']
+    num_matches = search_results['num_matches']
+    for name, df in dfs.items():
+        context_offset = context
+        if most_recent:
+            # So that each conversation snippet is still ordered naturally
+            df = df.iloc[::-1]
+            context_offset = -context
+        if name is not None:
+            print(f"*** MATCHES FOR {name} ***", file=file)
+        for message_idx, substr_range in matches[name]:
+            sub_df = df.loc[(message_idx-context_offset):(message_idx+context_offset), :]
+            print(tabulate_df(sub_df, substr_highlights={message_idx: substr_range}, color=color), file=file, flush=True)
+
+    if num_matches == max_results:
+        print(f"*** NOTE: Maximum of {num_matches} was reached. ***", file=file)
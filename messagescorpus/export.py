@@ -0,0 +1,202 @@
+import contextlib
+import csv
+import gzip
+import heapq
+import json
+import os
+import re
+import sys
+import time
+from collections import OrderedDict
+
+from .corpus import (
+    SQLITE_QUERY, get_message_db_paths, get_sender_name, get_thread_names, message_names_from_thread_name_map,
+    normalize_message_text, parse_message_text_from_sqlite_output_row, thread_display_name
+)
+from .query_language import normalize_date, resolve_name
+from .shared_utils import get_name_groups
+from .snapshot import open_message_db
+
+
+"""
+Streaming export of the corpus to JSONL or CSV.
+
+Rows go straight from the SQLite cursor through text decoding and thread/sender name resolution to the output file(s),
+one at a time, so memory use doesn't grow with the size of the history (except for the guids remembered to skip
+duplicates when merging several databases). Output can be gzipped and split into one file per thread. Run with e.g.
+
+    python -m messagescorpus export messages.jsonl.gz --gzip
+    python -m messagescorpus export by_thread/ --format csv --shard --thread Dan --after 2020
+"""
+
+EXPORT_FORMATS = ('jsonl', 'csv')
+EXPORT_FIELDS = ('thread', 'sender', 'timestamp', 'message', 'guid')
+# Sharded exports reopen (in append mode) any thread file that falls out of this many open handles
+MAX_OPEN_SHARDS = 64
+PROGRESS_INTERVAL = 50000
+SHARD_NAME_RE = re.compile(r'[^\w\-. &+]+')
+
+SQLITE_EXPORT_QUERY = f"""
+select * from (
+{SQLITE_QUERY}
+)
+where (? is null or TextDate >= ?) and (? is null or TextDate < ?)
+order by RawDate
+"""
+
+
+def iter_export_rows(conn, after=None, before=None):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(SQLITE_EXPORT_QUERY, (after, after, before, before))
+        yield from cursor
+    finally:
+        cursor.close()
+
+
+def shard_file_name(thread_name, export_format, use_gzip):
+    safe_name = SHARD_NAME_RE.sub('_', thread_name).strip(' .') or 'thread'
+    return f"{safe_name}.{export_format}{'.gz' if use_gzip else ''}"
+
+
+def open_export_file(path, use_gzip, append=False):
+    mode = 'at' if append else 'wt'
+    if path == '-':
+        return contextlib.nullcontext(sys.stdout)
+    if use_gzip:
+        # Appending to a gzip file adds a new member, which readers treat as one continuous stream
+        return gzip.open(path, mode, encoding='utf-8', newline='')
+    return open(path, mode, encoding='utf-8', newline='')
+
+
+def open_export_writer(output_path, export_format, use_gzip, shard):
+    """State for writing records to one file (or stdout), or to one file per thread with at most MAX_OPEN_SHARDS open."""
+    if shard:
+        os.makedirs(output_path, exist_ok=True)
+    return {
+        'output_path': output_path,
+        'format': export_format,
+        'gzip': use_gzip,
+        'shard': shard,
+        # path: (file context, write function), least recently used first
+        'open_files': OrderedDict(),
+        'files_written': set(),
+    }
+
+
+def _record_writer(writer, thread_name):
+    if writer['shard']:
+        path = os.path.join(writer['output_path'], shard_file_name(thread_name, writer['format'], writer['gzip']))
+    else:
+        path = writer['output_path']
+    open_files = writer['open_files']
+    if path in open_files:
+        open_files.move_to_end(path)
+        return open_files[path][1]
+    if len(open_files) >= MAX_OPEN_SHARDS:
+        _, (stale_context, _) = open_files.popitem(last=False)
+        stale_context.__exit__(None, None, None)
+    is_new = path not in writer['files_written']
+    file_context = open_export_file(path, writer['gzip'], append=not is_new)
+    f = file_context.__enter__()
+    if writer['format'] == 'csv':
+        csv_writer = csv.writer(f)
+        if is_new:
+            csv_writer.writerow(EXPORT_FIELDS)
+        write = csv_writer.writerow
+    else:
+        write = lambda record: f.write(json.dumps(dict(zip(EXPORT_FIELDS, record)), ensure_ascii=False) + '\n')
+    open_files[path] = (file_context, write)
+    writer['files_written'].add(path)
+    return write
+
+
+def write_export_record(writer, record):
+    """Writes one (thread, sender, timestamp, message, guid) record."""
+    _record_writer(writer, record[0])(record)
+
+
+def close_export_writer(writer):
+    open_files = writer['open_files']
+    while open_files:
+        _, (file_context, _) = open_files.popitem(last=False)
+        file_context.__exit__(None, None, None)
+
+
+def export_messages(output_path, export_format='jsonl', use_gzip=False, shard=False, threads=None, after=None, before=None,
+                    db_paths=None, progress=False):
+    """
+    Streams every message (optionally filtered) to JSONL or CSV, oldest first.
+    Each record has the thread name, sender name, timestamp, message text and message guid.
+
+    :param output_path: file to write ('-' for stdout), or a directory when `shard` is set
+    :param shard: write one file per thread into the `output_path` directory
+    :param threads: optional list of thread names to export (aliases and case-insensitive matches work)
+    :param after: only messages on or after this date (YYYY, YYYY-MM or YYYY-MM-DD)
+    :param before: only messages before this date
+    :param progress: print a progress line to stderr every PROGRESS_INTERVAL rows
+    :return: dictionary with 'rows', 'files', 'seconds' and 'rows_per_second'
+    :raises ValueError: for an unknown format, a bad date, or a thread name that doesn't exist
+    """
+
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f'Unknown export format "{export_format}" (use one of {", ".join(EXPORT_FORMATS)})')
+    if shard and output_path == '-':
+        raise ValueError('A sharded export needs an output directory')
+    after = normalize_date(after) if after else None
+    before = normalize_date(before) if before else None
+    started_at = time.time()
+    name_groups = get_name_groups()
+    db_paths = get_message_db_paths(db_paths)
+
+    thread_name_map = get_thread_names(db_paths=db_paths, name_groups=name_groups)['thread_name_map']
+
+    with contextlib.ExitStack() as stack:
+        connections = [stack.enter_context(open_message_db(db_path)) for db_path in db_paths]
+        wanted_threads = None
+        if threads:
+            thread_names = set(message_names_from_thread_name_map(thread_name_map, include_phone_numbers=True))
+            wanted_threads = set()
+            for thread in threads:
+                resolved = resolve_name(thread, thread_names, name_groups=name_groups)
+                if resolved is None:
+                    raise ValueError(f'No conversation found for "{thread}".')
+                wanted_threads.add(resolved)
+
+        row_streams = [iter_export_rows(conn, after=after, before=before) for conn in connections]
+        rows = row_streams[0] if len(row_streams) == 1 else heapq.merge(*row_streams, key=lambda row: row[9])
+        seen_guids = set() if len(row_streams) > 1 else None
+        writer = open_export_writer(output_path, export_format, use_gzip, shard)
+        stack.callback(close_export_writer, writer)
+
+        num_rows = 0
+        for row in rows:
+            thread_name = thread_display_name(thread_name_map, row[1], name_groups=name_groups)
+            if wanted_threads is not None and thread_name not in wanted_threads:
+                continue
+            guid = row[8]
+            if seen_guids is not None and guid is not None:
+                if guid in seen_guids:
+                    continue
+                seen_guids.add(guid)
+            message_text = normalize_message_text(parse_message_text_from_sqlite_output_row(row)).strip()
+            write_export_record(writer, (
+                thread_name,
+                get_sender_name(row[2], row[3], name_groups=name_groups),
+                row[4],
+                message_text,
+                guid,
+            ))
+            num_rows += 1
+            if progress and num_rows % PROGRESS_INTERVAL == 0:
+                elapsed = time.time() - started_at
+                print(f'{num_rows} rows exported ({num_rows / elapsed:.0f} rows/s)', file=sys.stderr)
+        files = len(writer['files_written'])
+
+    seconds = time.time() - started_at
+    return {
+        'rows': num_rows,
+        'files': files,
+        'seconds': round(seconds, 3),
+        'rows_per_second': round(num_rows / seconds) if seconds else num_rows,
+    }
@@ -0,0 +1,163 @@
+from .indexes import build_thread_index, get_inverted_index, token_spans, tokenize
+
+
+"""
+Typo-tolerant search with a deletion-neighborhood (SymSpell-style) index over each thread's vocabulary.
+
+Every vocabulary word is indexed under each string obtained by deleting up to FUZZY_MAX_DISTANCE characters from it.
+A query word's own deletions are then looked up in that index, so finding the words within edit distance k is a handful
+of dictionary lookups plus a few edit distance checks, instead of comparing against every word (or every message).
+The messages containing those words come straight from the inverted index postings.
+"""
+
+FUZZY_MAX_DISTANCE = 2
+
+
+def deletion_neighborhood(word, max_distance):
+    """All strings obtained by deleting up to `max_distance` characters from `word` (including `word` itself)."""
+    neighborhood = {word}
+    frontier = {word}
+    for _ in range(max_distance):
+        frontier = {variant[:idx] + variant[idx + 1:] for variant in frontier for idx in range(len(variant))}
+        neighborhood |= frontier
+    return neighborhood
+
+
+def edit_distance(a, b, max_distance):
+    """
+    Optimal string alignment distance between `a` and `b` (insertions, deletions, substitutions and adjacent
+    transpositions), or max_distance + 1 as soon as it's known to be larger than `max_distance`.
+    """
+
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous_previous = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous_previous[j - 2] + 1)
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous_previous, previous = previous, current
+    return previous[-1]
+
+
+def build_deletion_index(vocabulary, max_distance=FUZZY_MAX_DISTANCE):
+    """
+    :param vocabulary: iterable of words
+    :return: {deletion variant: list of vocabulary words it came from}
+    """
+
+    deletion_index = {}
+    for word in vocabulary:
+        for variant in deletion_neighborhood(word, max_distance):
+            deletion_index.setdefault(variant, []).append(word)
+    return deletion_index
+
+
+def get_deletion_index(thread_index, message_list):
+    """Returns the thread's deletion index, building and keeping it in `thread_index` on first use."""
+    if 'deletions' not in thread_index:
+        inverted = get_inverted_index(thread_index, message_list)
+        thread_index['deletions'] = build_deletion_index(inverted['postings'])
+    return thread_index['deletions']
+
+
+def default_max_distance(term):
+    """Edits allowed for a query word when none are given: none for very short words, one up to 5 letters, then two."""
+    if len(term) <= 2:
+        return 0
+    if len(term) <= 5:
+        return 1
+    return 2
+
+
+def fuzzy_variants(term, deletion_index, max_distance):
+    """Vocabulary words within `max_distance` edits of `term` (which must be lowercased)."""
+    candidates = set()
+    for variant in deletion_neighborhood(term, max_distance):
+        candidates.update(deletion_index.get(variant, ()))
+    return {word for word in candidates if edit_distance(term, word, max_distance) <= max_distance}
+
+
+def fuzzy_search(message_obj, query, max_results=20, most_recent=True, max_distance=None, indexes=None):
+    """
+    Finds messages containing every word of the query, allowing each word to be misspelled by a few edits.
+    Takes the same kind of message_obj as search_corpus and returns the same structure as corpus.search_matches, where
+    each match's span is the first matched word. Matching is on lowercased word tokens, so it is always case-insensitive.
+
+    :param max_distance: edits allowed per query word (at most FUZZY_MAX_DISTANCE); by default it depends on the
+        word's length (see default_max_distance)
+    :param indexes: optional {name: build_thread_index(...)} cache, in which vocabulary and deletion indexes are kept
+        between queries
+    :return: search_matches-style dictionary with extra keys 'term_spans' (name:list parallel to matches[name] of
+        [(matched word, span), ...]) and 'variants' (query word:sorted list of words it matched)
+    """
+
+    if isinstance(message_obj, list):
+        named_lists = [(None, message_obj)]
+    elif isinstance(message_obj, dict):
+        named_lists = [(name, message_list) for name, message_list in message_obj.items() if message_list]
+    else:
+        raise TypeError(f"message_obj was {type(message_obj)} which is not recognized")
+    if max_distance is not None and not 0 <= max_distance <= FUZZY_MAX_DISTANCE:
+        raise ValueError(f'max_distance must be between 0 and {FUZZY_MAX_DISTANCE}')
+
+    terms = list(dict.fromkeys(tokenize(query)))
+    num_matches = 0
+    matches = {}
+    term_spans = {}
+    ordered_lists = {}
+    variants = {term: set() for term in terms}
+    for name, message_list in named_lists:
+        if not terms:
+            break
+        thread_index = indexes.get(name) if indexes is not None else None
+        if thread_index is None:
+            thread_index = build_thread_index(message_list)
+            if indexes is not None:
+                indexes[name] = thread_index
+        postings = get_inverted_index(thread_index, message_list)['postings']
+        deletion_index = get_deletion_index(thread_index, message_list)
+
+        # Intersect the positions matching each word, rarest word first
+        thread_variants = set()
+        term_positions = []
+        for term in terms:
+            term_distance = default_max_distance(term) if max_distance is None else max_distance
+            words = fuzzy_variants(term, deletion_index, term_distance)
+            variants[term] |= words
+            thread_variants |= words
+            term_positions.append({position for word in words for position, _ in postings[word]})
+        term_positions.sort(key=len)
+        positions = set.intersection(*term_positions)
+
+        matches[name] = []
+        term_spans[name] = []
+        last_position = len(message_list) - 1
+        for position in sorted(positions, reverse=most_recent):
+            spans = token_spans(message_list[position]['message'], thread_variants)
+            matches[name].append((last_position - position if most_recent else position, spans[0][1]))
+            term_spans[name].append(spans)
+            num_matches += 1
+            if num_matches == max_results:
+                break
+        if matches[name]:
+            ordered_lists[name] = list(reversed(message_list)) if most_recent else message_list
+        if num_matches == max_results:
+            break
+
+    if isinstance(message_obj, list) and not num_matches:
+        return
+    return {
+        'ordered_lists': ordered_lists,
+        'matches': matches,
+        'num_matches': num_matches,
+        'timed_out': False,
+        'term_spans': term_spans,
+        'variants': {term: sorted(words) for term, words in variants.items()},
+    }
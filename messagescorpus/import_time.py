@@ -0,0 +1,69 @@
+import argparse
+import subprocess
+import sys
+
+
+"""
+Startup-time regression check.
+
+Runs `python -X importtime` on the core modules in a fresh interpreter and fails if any heavy display dependency gets
+imported, or if the cumulative import time goes over budget. Run with:
+
+    python -m messagescorpus.import_time
+"""
+
+CORE_MODULES = ['messagescorpus.corpus']
+FORBIDDEN_MODULES = ['pandas', 'numpy', 'tabulate', 'termcolor']
+DEFAULT_BUDGET_MS = 150
+
+
+def measure_import_times(modules=None):
+    """
+    Imports the given modules in a fresh interpreter with `-X importtime` and parses its report.
+
+    :param modules: list of module names to import (defaults to CORE_MODULES)
+    :return: dictionary of {module_name: cumulative_microseconds} for every module imported along the way
+    """
+
+    modules = modules or CORE_MODULES
+    code = '; '.join(f'import {module}' for module in modules)
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True, check=True)
+    import_times = {}
+    for line in completed.stderr.splitlines():
+        # Format: "import time: self [us] | cumulative | imported package"
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        _self_us, cumulative_us, module_name = line[len('import time:'):].split('|')
+        import_times[module_name.strip()] = int(cumulative_us)
+    return import_times
+
+
+def check_import_time(modules=None, budget_ms=DEFAULT_BUDGET_MS):
+    """
+    Returns a list of problems with the import of the core modules (empty if everything is within budget).
+    """
+
+    modules = modules or CORE_MODULES
+    import_times = measure_import_times(modules)
+    problems = [f'{module} was imported' for module in FORBIDDEN_MODULES if module in import_times]
+    for module in modules:
+        elapsed_ms = import_times.get(module, 0) / 1000
+        print(f'{module}: {elapsed_ms:.1f} ms cumulative import time')
+        if elapsed_ms > budget_ms:
+            problems.append(f'{module} took {elapsed_ms:.1f} ms to import (budget is {budget_ms} ms)')
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check that the core messagescorpus modules import quickly, without pandas.')
+    parser.add_argument('--budget-ms', type=float, default=DEFAULT_BUDGET_MS, help='maximum cumulative import time per module')
+    parser.add_argument('modules', nargs='*', help=f'modules to check (default: {", ".join(CORE_MODULES)})')
+    args = parser.parse_args(argv)
+    problems = check_import_time(args.modules, budget_ms=args.budget_ms)
+    for problem in problems:
+        print(f'FAIL: {problem}')
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
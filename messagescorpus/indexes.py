@@ -0,0 +1,107 @@
+import bisect
+import re
+
+
+"""
+Per-thread lookup structures, built once from a thread's message list and reused across queries.
+"""
+
+TOKEN_RE = re.compile(r"\w+")
+
+
+def tokenize(text):
+    """Lowercased word tokens of a message, as used by the inverted index."""
+    return [token.casefold() for token in TOKEN_RE.findall(text)]
+
+
+def token_spans(text, terms):
+    """Every (term, (start, end)) where a token of `text` is one of `terms` (lowercased tokens)."""
+    spans = []
+    for match in TOKEN_RE.finditer(text):
+        token = match.group(0).casefold()
+        if token in terms:
+            spans.append((token, match.span()))
+    return spans
+
+
+def is_sorted(values):
+    return all(values[idx] <= values[idx + 1] for idx in range(len(values) - 1))
+
+
+def build_thread_index(message_list):
+    """
+    Builds the lookup structures used to plan queries against one thread.
+
+    :param message_list: list of message objects, in the order they were loaded (oldest first)
+    :return: dictionary with
+        - 'timestamps': list of timestamps by position (sorted unless local-time clock changes reordered them)
+        - 'timestamps_sorted': whether 'timestamps' can be binary searched
+        - 'senders': {sender: sorted list of positions of that sender's messages}
+    """
+
+    timestamps = [message['timestamp'] for message in message_list]
+    senders = {}
+    for position, message in enumerate(message_list):
+        senders.setdefault(message['sender'], []).append(position)
+    return {
+        'timestamps': timestamps,
+        'timestamps_sorted': is_sorted(timestamps),
+        'senders': senders,
+    }
+
+
+def position_for_date(thread_index, date_prefix):
+    """
+    Position of the thread's first message on or after `date_prefix` (a timestamp or a prefix of one, e.g. '2019-06'),
+    or the number of messages if there is none. Binary search when the timestamps are sorted.
+    """
+
+    timestamps = thread_index['timestamps']
+    if thread_index['timestamps_sorted']:
+        return bisect.bisect_left(timestamps, date_prefix)
+    return next((position for position, timestamp in enumerate(timestamps) if timestamp >= date_prefix), len(timestamps))
+
+
+def centered_window(total, position, size):
+    """(start, end) of a window of `size` positions centered on `position`, shifted to fit within range(total)."""
+    start = min(max(position - size // 2, 0), max(total - size, 0))
+    return start, min(start + size, total)
+
+
+def build_inverted_index(message_list, window=1):
+    """
+    Builds a term -> postings index over a thread for relevance ranking.
+
+    :param window: number of consecutive messages that make up one document (1 scores each message on its own)
+    :return: dictionary with
+        - 'postings': {term: list of (doc_id, term_frequency)}, doc_ids ascending
+        - 'doc_lengths': list of token counts per document
+        - 'window': the window size, so doc_id * window is the position of the document's first message
+    """
+
+    postings = {}
+    doc_lengths = []
+    for doc_id, start in enumerate(range(0, len(message_list), window)):
+        term_frequencies = {}
+        doc_length = 0
+        for message in message_list[start:start + window]:
+            tokens = tokenize(message['message'])
+            doc_length += len(tokens)
+            for token in tokens:
+                term_frequencies[token] = term_frequencies.get(token, 0) + 1
+        for term, term_frequency in term_frequencies.items():
+            postings.setdefault(term, []).append((doc_id, term_frequency))
+        doc_lengths.append(doc_length)
+    return {
+        'postings': postings,
+        'doc_lengths': doc_lengths,
+        'window': window,
+    }
+
+
+def get_inverted_index(thread_index, message_list, window=1):
+    """Returns the thread's inverted index for `window`, building and keeping it in `thread_index` on first use."""
+    key = f'inverted_{window}'
+    if key not in thread_index:
+        thread_index[key] = build_inverted_index(message_list, window=window)
+    return thread_index[key]
@@ -0,0 +1,171 @@
+import argparse
+import sys
+import time
+import tracemalloc
+
+from .corpus import message_dict_from_sqlite
+
+
+"""
+Memory footprint profiling for loaded corpora.
+
+profile_message_dict walks a thread-keyed message dictionary (as returned by message_dict_from_sqlite, or the web app's
+MESSAGE_CACHE) and attributes every byte to a thread and to a field, counting each object once however many places refer
+to it. It also reports how much is spent on duplicate strings: equal values stored as separate objects, which interning
+or compaction could share. traced_call measures what a call actually allocated with tracemalloc. Run with:
+
+    python -m messagescorpus.memory_profile
+"""
+
+MESSAGE_FIELDS = ('sender', 'timestamp', 'message')
+
+
+def deep_sizeof(obj, seen=None):
+    """
+    Size in bytes of `obj` and everything it contains (dicts, lists, tuples, sets and their items), skipping objects
+    whose id is already in `seen`, which is updated so repeated calls don't count shared objects twice.
+    """
+
+    if seen is None:
+        seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        current = stack.pop()
+        if id(current) in seen:
+            continue
+        seen.add(id(current))
+        size += sys.getsizeof(current)
+        if isinstance(current, dict):
+            stack.extend(current.keys())
+            stack.extend(current.values())
+        elif isinstance(current, (list, tuple, set, frozenset)):
+            stack.extend(current)
+    return size
+
+
+def profile_message_dict(message_obj, top_threads=None):
+    """
+    :param message_obj: dictionary of name:list of messages
+    :param top_threads: only list this many of the largest threads (all by default)
+    :return: dictionary with
+        - 'total_bytes': everything reachable from message_obj
+        - 'num_threads' and 'num_messages'
+        - 'containers_bytes': the message dicts and thread lists themselves
+        - 'fields': {field: {'bytes', 'unique_values', 'duplicate_objects', 'duplicate_bytes'}}, where duplicate_bytes is
+          what would be saved if equal values shared one object
+        - 'threads': list of {'name', 'messages', 'bytes'}, largest first
+    """
+
+    seen = set()
+    fields = {field: {'bytes': 0, 'unique_values': 0, 'duplicate_objects': 0, 'duplicate_bytes': 0} for field in MESSAGE_FIELDS}
+    canonical_ids = {field: {} for field in MESSAGE_FIELDS}
+    threads = []
+    containers_bytes = sys.getsizeof(message_obj)
+    num_messages = 0
+    for name, message_list in message_obj.items():
+        thread_bytes = deep_sizeof(name, seen) + sys.getsizeof(message_list)
+        containers_bytes += sys.getsizeof(message_list)
+        for message in message_list:
+            message_bytes = sys.getsizeof(message)
+            containers_bytes += message_bytes
+            for key, value in message.items():
+                message_bytes += deep_sizeof(key, seen)
+                value_bytes = deep_sizeof(value, seen)
+                message_bytes += value_bytes
+                field = fields.get(key)
+                if field is None:
+                    continue
+                field['bytes'] += value_bytes
+                value_ids = canonical_ids[key]
+                canonical_id = value_ids.setdefault(value, id(value))
+                if canonical_id != id(value) and value_bytes:
+                    # Equal to a value already seen, but a separate object
+                    field['duplicate_objects'] += 1
+                    field['duplicate_bytes'] += value_bytes
+            thread_bytes += message_bytes
+        num_messages += len(message_list)
+        threads.append({'name': name, 'messages': len(message_list), 'bytes': thread_bytes})
+    for field, value_ids in canonical_ids.items():
+        fields[field]['unique_values'] = len(value_ids)
+
+    threads.sort(key=lambda thread: thread['bytes'], reverse=True)
+    return {
+        'total_bytes': sum(thread['bytes'] for thread in threads) + sys.getsizeof(message_obj),
+        'num_threads': len(threads),
+        'num_messages': num_messages,
+        'containers_bytes': containers_bytes,
+        'fields': fields,
+        'threads': threads[:top_threads] if top_threads is not None else threads,
+    }
+
+
+def traced_call(func, *args, top_lines=10, **kwargs):
+    """
+    Calls func(*args, **kwargs) with tracemalloc running.
+
+    :return: dictionary with 'result', 'allocated_bytes' (still allocated when the call returned), 'peak_bytes',
+        'seconds' and 'top_lines' (list of (file:line, bytes) for the lines holding the most memory)
+    """
+
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    before, _ = tracemalloc.get_traced_memory()
+    started_at = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+        seconds = time.perf_counter() - started_at
+        current, peak = tracemalloc.get_traced_memory()
+        statistics = tracemalloc.take_snapshot().statistics('lineno')[:top_lines]
+    finally:
+        if not was_tracing:
+            tracemalloc.stop()
+    return {
+        'result': result,
+        'allocated_bytes': current - before,
+        'peak_bytes': peak - before,
+        'seconds': round(seconds, 3),
+        'top_lines': [(f'{stat.traceback[0].filename}:{stat.traceback[0].lineno}', stat.size) for stat in statistics],
+    }
+
+
+def format_bytes(num_bytes):
+    for unit in ('B', 'KB', 'MB'):
+        if abs(num_bytes) < 1024:
+            return f'{num_bytes:.1f} {unit}' if unit != 'B' else f'{num_bytes} B'
+        num_bytes /= 1024
+    return f'{num_bytes:.1f} GB'
+
+
+def print_profile(profile):
+    print(f"{profile['num_messages']} messages in {profile['num_threads']} threads: {format_bytes(profile['total_bytes'])}")
+    print(f"  containers (message dicts and lists): {format_bytes(profile['containers_bytes'])}")
+    for field, stats in profile['fields'].items():
+        print(
+            f"  {field}: {format_bytes(stats['bytes'])} in {stats['unique_values']} unique values, "
+            f"{format_bytes(stats['duplicate_bytes'])} in {stats['duplicate_objects']} duplicate strings"
+        )
+    print('Largest threads:')
+    for thread in profile['threads']:
+        print(f"  {thread['name']}: {format_bytes(thread['bytes'])} ({thread['messages']} messages)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Report how much memory a loaded corpus takes, by thread and by field.')
+    parser.add_argument('-n', '--top-threads', type=int, default=10, help='number of threads to list')
+    args = parser.parse_args(argv)
+    traced = traced_call(message_dict_from_sqlite)
+    print(
+        f"Loading took {traced['seconds']}s; {format_bytes(traced['allocated_bytes'])} still allocated, "
+        f"{format_bytes(traced['peak_bytes'])} at peak"
+    )
+    for location, size in traced['top_lines'][:5]:
+        print(f'  {location}: {format_bytes(size)}')
+    print_profile(profile_message_dict(traced['result'], top_threads=args.top_threads))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
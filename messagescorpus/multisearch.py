@@ -0,0 +1,132 @@
+import re
+
+
+"""
+Multi-term literal search with one compiled regex alternation of the terms.
+
+All terms are matched in a single pass over each message, instead of one search_corpus call (and one full scan) per term.
+The scan runs in the regex engine; only messages it matches are searched again for every occurrence of every term.
+"""
+
+
+def split_terms(query):
+    """Splits a comma- or newline-separated term list, dropping blanks and duplicates (keeping the first occurrence's order)."""
+    terms = [term.strip() for line in query.splitlines() for term in line.split(',')]
+    return list(dict.fromkeys(term for term in terms if term))
+
+
+def fold_case(text):
+    """Lowercases `text` without changing its length, so match offsets still line up with the original string."""
+    folded = text.lower()
+    if len(folded) == len(text):
+        return folded
+    # A few characters (e.g. 'İ') lowercase to more than one character; leave those as they are
+    return ''.join(ch if len(ch.lower()) != 1 else ch.lower() for ch in text)
+
+
+def build_term_matcher(terms, ignore_case=True):
+    """
+    Compiles a list of literal terms into one alternation, longest terms first.
+
+    :return: dictionary with 'terms', 'search_terms' (the terms as matched, case-folded if ignore_case), 'pattern' (the
+        compiled alternation, or None if every term is blank) and 'ignore_case'
+    """
+
+    search_terms = [fold_case(term) if ignore_case else term for term in terms]
+    alternatives = sorted({term for term in search_terms if term}, key=len, reverse=True)
+    return {
+        'terms': list(terms),
+        'search_terms': search_terms,
+        'pattern': re.compile('|'.join(map(re.escape, alternatives))) if alternatives else None,
+        'ignore_case': ignore_case,
+    }
+
+
+def find_all(matcher, text):
+    """Returns every (term_index, (start, end)) occurrence in `text`, including overlapping ones, ordered by end offset."""
+    if matcher['pattern'] is None:
+        return []
+    if matcher['ignore_case']:
+        text = fold_case(text)
+    if not matcher['pattern'].search(text):
+        return []
+    hits = []
+    for term_idx, term in enumerate(matcher['search_terms']):
+        if not term:
+            continue
+        start = text.find(term)
+        while start != -1:
+            hits.append((term_idx, (start, start + len(term))))
+            start = text.find(term, start + 1)
+    hits.sort(key=lambda hit: (hit[1][1], hit[1][0]))
+    return hits
+
+
+def non_overlapping_spans(hits):
+    """Picks leftmost-longest, non-overlapping spans out of find_all's hits (for highlighting)."""
+    spans = []
+    last_end = -1
+    for _, (start, end) in sorted(hits, key=lambda hit: (hit[1][0], -hit[1][1])):
+        if start >= last_end:
+            spans.append((start, end))
+            last_end = end
+    return spans
+
+
+def search_terms(message_obj, terms, ignore_case=True, max_results=20, most_recent=True):
+    """
+    Searches a collection of messages for any of several literal terms, in one pass per message.
+    Takes the same kind of message_obj as search_corpus and returns the same structure as corpus.search_matches, where each
+    match's span is its first term occurrence, plus the spans of every term found in each matched message.
+
+    :param terms: list of literal strings, or a comma- or newline-separated string of them
+    :return: search_matches-style dictionary with extra keys 'term_spans' (name:list parallel to matches[name] of
+        [(term, span), ...]) and 'term_counts' (term:number of matched messages containing it)
+    """
+
+    if isinstance(terms, str):
+        terms = split_terms(terms)
+    matcher = build_term_matcher(terms, ignore_case=ignore_case)
+    if isinstance(message_obj, list):
+        named_lists = [(None, message_obj)]
+    elif isinstance(message_obj, dict):
+        named_lists = [(name, message_list) for name, message_list in message_obj.items() if message_list]
+    else:
+        raise TypeError(f"message_obj was {type(message_obj)} which is not recognized")
+
+    num_matches = 0
+    matches = {}
+    term_spans = {}
+    term_counts = dict.fromkeys(terms, 0)
+    ordered_lists = {}
+    for name, message_list in named_lists:
+        matches[name] = []
+        term_spans[name] = []
+        ordered_list = list(reversed(message_list)) if most_recent else message_list
+        for idx, m in enumerate(ordered_list):
+            hits = find_all(matcher, m['message'])
+            if not hits:
+                continue
+            hits.sort(key=lambda hit: hit[1])
+            matches[name].append((idx, hits[0][1]))
+            term_spans[name].append([(terms[term_idx], span) for term_idx, span in hits])
+            for term in {terms[term_idx] for term_idx, _ in hits}:
+                term_counts[term] += 1
+            num_matches += 1
+            if num_matches == max_results:
+                break
+        if matches[name]:
+            ordered_lists[name] = ordered_list
+        if num_matches == max_results:
+            break
+
+    if isinstance(message_obj, list) and not num_matches:
+        return
+    return {
+        'ordered_lists': ordered_lists,
+        'matches': matches,
+        'num_matches': num_matches,
+        'timed_out': False,
+        'term_spans': term_spans,
+        'term_counts': term_counts,
+    }
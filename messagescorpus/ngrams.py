@@ -0,0 +1,369 @@
+import argparse
+import hashlib
+import json
+import math
+import os
+import sqlite3
+import sys
+import time
+from collections import Counter
+
+from .corpus import (
+    MEDIA_PLACEHOLDER, get_message_db_paths, get_sender_name, get_thread_names, normalize_message_text,
+    parse_message_text_from_sqlite_output_row, read_sqlite_db_since, thread_display_name
+)
+from .indexes import tokenize
+from .shared_utils import CORPUS_CACHE_DIR, get_name_groups
+
+
+"""
+Word and phrase (n-gram) frequencies, kept up to date incrementally.
+
+Each message is tokenized once (lowercased words, as in the search indexes) into n-grams of 1 to DEFAULT_MAX_N words,
+which are counted per (raw thread id, sender, month). Counts live in a small SQLite store in CORPUS_CACHE_DIR: n-grams are
+stored as 64-bit hashed ids with one vocabulary row each, and each (thread, sender, month) key has its own id, so a count
+is four integers. Ingesting only reads messages with a rowid above the last one seen in each database, so keeping the
+counts current costs time proportional to the new messages, and queries never re-tokenize history.
+
+Queries sum the counts over any combination of thread, sender and period (a YYYY or YYYY-MM prefix), e.g. the top
+phrases Dan and I use, or how my vocabulary in 2021 differs from 2015:
+
+    python -m messagescorpus.ngrams top --thread Dan -n 2
+    python -m messagescorpus.ngrams compare --sender Fred --period 2021 --vs-period 2015
+
+Counts are stored under raw thread ids, and --thread is matched against the names the loaders, CLI and web app give those
+ids now (get_thread_names), so a group chat's history stays in one thread when its membership (and so its name) changes.
+Messages that appear in more than one database (e.g. overlapping archives) are counted once, by guid. The counts are
+rebuilt from scratch when name_groups.json changes, since sender names depend on it.
+"""
+
+DEFAULT_NGRAM_STORE_PATH = os.path.join(CORPUS_CACHE_DIR, 'ngrams.sqlite')
+DEFAULT_MAX_N = 3
+# Bumped when the layout of the counts changes; stores built with another format are emptied and rebuilt on next ingest
+NGRAM_STORE_FORMAT = 2
+NGRAM_COUNT_TABLES = ('counts', 'count_keys', 'seen_messages', 'ingested')
+
+NGRAM_STORE_SCHEMA = """
+create table if not exists ingested (db_path text primary key, last_rowid integer not null);
+create table if not exists settings (name text primary key, value integer not null);
+create table if not exists vocabulary (id integer primary key, ngram text not null, n integer not null);
+create table if not exists seen_messages (guid_id integer primary key);
+create table if not exists count_keys (
+    id integer primary key, thread_id text not null, sender text not null, period text not null, unique (thread_id, sender, period)
+);
+create table if not exists counts (
+    key_id integer not null, n integer not null, ngram_id integer not null, count integer not null,
+    primary key (key_id, n, ngram_id)
+) without rowid;
+create index if not exists count_keys_sender on count_keys (sender, period);
+create index if not exists count_keys_period on count_keys (period);
+"""
+
+
+def ngram_id(ngram):
+    """Stable signed 64-bit id for an n-gram (SQLite integers are signed). Also used for message guids."""
+    return int.from_bytes(hashlib.blake2b(ngram.encode('utf-8'), digest_size=8).digest(), 'big', signed=True)
+
+
+def name_groups_fingerprint(name_groups):
+    """Signed 64-bit hash of the name groups, stored with the counts (which use the names they produce)."""
+    return ngram_id(json.dumps({name: sorted(alt_names) for name, alt_names in name_groups.items()}, sort_keys=True))
+
+
+def reset_ngram_counts(conn):
+    """Deletes every count and ingest position (keeping the vocabulary), so the next ingest starts over."""
+    for table in NGRAM_COUNT_TABLES:
+        conn.execute(f'delete from {table}')
+
+
+def count_ngrams(tokens, max_n=DEFAULT_MAX_N):
+    """Counter of every 1- to max_n-word n-gram (space-joined) in a list of tokens."""
+    counts = Counter()
+    for n in range(1, max_n + 1):
+        for start in range(len(tokens) - n + 1):
+            counts[' '.join(tokens[start:start + n])] += 1
+    return counts
+
+
+def open_ngram_store(store_path=DEFAULT_NGRAM_STORE_PATH, max_n=DEFAULT_MAX_N):
+    """
+    Opens (creating if needed) the n-gram store.
+
+    :raises ValueError: if the store was built with a different max_n (delete it, or pass the same max_n)
+    """
+
+    os.makedirs(os.path.dirname(os.path.abspath(store_path)), exist_ok=True)
+    conn = sqlite3.connect(store_path)
+    if conn.execute("select 1 from sqlite_master where name = 'settings'").fetchone() is not None:
+        stored_format = conn.execute("select value from settings where name = 'format'").fetchone()
+        if stored_format is None or stored_format[0] != NGRAM_STORE_FORMAT:
+            for table in NGRAM_COUNT_TABLES:
+                conn.execute(f'drop table if exists {table}')
+            conn.execute("delete from settings where name = 'name_groups'")
+    conn.executescript(NGRAM_STORE_SCHEMA)
+    conn.execute("insert or replace into settings values ('format', ?)", (NGRAM_STORE_FORMAT,))
+    conn.execute("insert or ignore into settings values ('max_n', ?)", (max_n,))
+    stored_max_n = conn.execute("select value from settings where name = 'max_n'").fetchone()[0]
+    if stored_max_n != max_n:
+        conn.close()
+        raise ValueError(f'{store_path} counts n-grams up to n={stored_max_n}, not {max_n}; delete it to change this')
+    conn.commit()
+    return conn
+
+
+def ingest_new_messages(store_path=DEFAULT_NGRAM_STORE_PATH, db_paths=None, max_n=DEFAULT_MAX_N):
+    """
+    Tokenizes the messages added to each database since the last ingest and adds their n-gram counts to the store.
+    If name_groups.json has changed since the counts were built, they're rebuilt from every message.
+
+    :return: dictionary with 'messages' (number ingested), 'ngrams' (number of count rows touched), 'rebuilt' and 'seconds'
+    """
+
+    started_at = time.time()
+    name_groups = get_name_groups()
+    db_paths = get_message_db_paths(db_paths)
+    conn = open_ngram_store(store_path, max_n=max_n)
+    num_messages = 0
+    num_count_rows = 0
+    rebuilt = False
+    try:
+        fingerprint = name_groups_fingerprint(name_groups)
+        stored = conn.execute("select value from settings where name = 'name_groups'").fetchone()
+        if stored is None or stored[0] != fingerprint:
+            rebuilt = stored is not None or conn.execute('select 1 from ingested limit 1').fetchone() is not None
+            reset_ngram_counts(conn)
+            conn.execute("insert or replace into settings values ('name_groups', ?)", (fingerprint,))
+            conn.commit()
+        for db_path in db_paths:
+            # The same database may be passed as chat.db or ./chat.db
+            db_key = os.path.abspath(db_path)
+            row = conn.execute('select last_rowid from ingested where db_path = ?', (db_key,)).fetchone()
+            last_rowid = row[0] if row else 0
+            output = read_sqlite_db_since(db_path, since_rowid=last_rowid)
+            if not output:
+                continue
+
+            key_counts = {}
+            for row in output:
+                last_rowid = max(last_rowid, row[0])
+                if row[8] is not None:
+                    # Skip messages already counted from another database
+                    if conn.execute('insert or ignore into seen_messages values (?)', (ngram_id(row[8]),)).rowcount == 0:
+                        continue
+                message_text = normalize_message_text(parse_message_text_from_sqlite_output_row(row)).strip()
+                if not message_text or message_text == MEDIA_PLACEHOLDER:
+                    continue
+                key = (row[1], get_sender_name(row[2], row[3], name_groups=name_groups), row[4][:7])
+                key_counts.setdefault(key, Counter()).update(count_ngrams(tokenize(message_text), max_n=max_n))
+                num_messages += 1
+
+            vocabulary = {}
+            count_rows = []
+            for (thread_id, sender, period), counts in key_counts.items():
+                conn.execute('insert or ignore into count_keys (thread_id, sender, period) values (?, ?, ?)', (thread_id, sender, period))
+                key_id = conn.execute(
+                    'select id from count_keys where thread_id = ? and sender = ? and period = ?', (thread_id, sender, period)
+                ).fetchone()[0]
+                for ngram, count in counts.items():
+                    ngram_key = vocabulary.get(ngram)
+                    if ngram_key is None:
+                        ngram_key = vocabulary[ngram] = ngram_id(ngram)
+                    count_rows.append((key_id, ngram.count(' ') + 1, ngram_key, count))
+            conn.executemany(
+                'insert or ignore into vocabulary (id, ngram, n) values (?, ?, ?)',
+                ((ngram_key, ngram, ngram.count(' ') + 1) for ngram, ngram_key in vocabulary.items()),
+            )
+            conn.executemany(
+                'insert into counts values (?, ?, ?, ?) '
+                'on conflict (key_id, n, ngram_id) do update set count = count + excluded.count',
+                count_rows,
+            )
+            conn.execute('insert or replace into ingested values (?, ?)', (db_key, last_rowid))
+            conn.commit()
+            num_count_rows += len(count_rows)
+    finally:
+        conn.close()
+    return {'messages': num_messages, 'ngrams': num_count_rows, 'rebuilt': rebuilt, 'seconds': round(time.time() - started_at, 3)}
+
+
+def stored_thread_ids(conn, thread, db_paths=None):
+    """Raw thread ids in the store that the loaders currently display as `thread` (see thread_display_name)."""
+    name_groups = get_name_groups()
+    thread_name_map = get_thread_names(db_paths=db_paths, name_groups=name_groups)['thread_name_map']
+    return [
+        thread_id for (thread_id,) in conn.execute('select distinct thread_id from count_keys')
+        if thread_display_name(thread_name_map, thread_id, name_groups=name_groups) == thread
+    ]
+
+
+def _key_filter(conn, thread=None, sender=None, period=None, db_paths=None):
+    """SQL condition and parameters selecting count_keys rows (aliased k) for the given filters."""
+    conditions = []
+    params = []
+    if thread is not None:
+        thread_ids = stored_thread_ids(conn, thread, db_paths=db_paths)
+        conditions.append(f"k.thread_id in ({','.join('?' * len(thread_ids))})")
+        params.extend(thread_ids)
+    if sender is not None:
+        conditions.append('k.sender = ?')
+        params.append(sender)
+    if period is not None:
+        # '2021' matches every month of 2021, '2021-03' just that month
+        conditions.append('k.period like ?')
+        params.append(f'{period}%')
+    return ' and '.join(conditions) or '1', params
+
+
+def ngram_counts(conn, n=1, thread=None, sender=None, period=None, db_paths=None):
+    """Total count of every n-word n-gram (as {ngram_id: count}) over the keys matching the filters."""
+    condition, params = _key_filter(conn, thread=thread, sender=sender, period=period, db_paths=db_paths)
+    rows = conn.execute(
+        f'select c.ngram_id, sum(c.count) from count_keys k join counts c on c.key_id = k.id '
+        f'where {condition} and c.n = ? group by c.ngram_id',
+        params + [n],
+    )
+    return dict(rows)
+
+
+def ngram_texts(conn, ids):
+    """{ngram_id: ngram} for the given ids."""
+    ids = list(ids)
+    texts = {}
+    for start in range(0, len(ids), 500):
+        chunk = ids[start:start + 500]
+        placeholders = ','.join('?' * len(chunk))
+        texts.update(conn.execute(f'select id, ngram from vocabulary where id in ({placeholders})', chunk))
+    return texts
+
+
+def top_ngrams(store_path=DEFAULT_NGRAM_STORE_PATH, n=1, k=20, thread=None, sender=None, period=None, min_length=1, db_paths=None):
+    """
+    The k most frequent n-word n-grams for a thread, sender and/or period (YYYY or YYYY-MM).
+
+    :param min_length: skip n-grams shorter than this many characters (e.g. 3 to drop "a", "ok", ...)
+    :return: list of (ngram, count), most frequent first
+    """
+
+    conn = open_ngram_store(store_path)
+    try:
+        condition, params = _key_filter(conn, thread=thread, sender=sender, period=period, db_paths=db_paths)
+        rows = conn.execute(
+            f'select v.ngram, sum(c.count) as total from count_keys k join counts c on c.key_id = k.id '
+            f'join vocabulary v on v.id = c.ngram_id '
+            f'where {condition} and c.n = ? and length(v.ngram) >= ? group by c.ngram_id order by total desc limit ?',
+            params + [n, min_length, k],
+        )
+        return [(ngram, count) for ngram, count in rows]
+    finally:
+        conn.close()
+
+
+def compare_ngrams(store_path=DEFAULT_NGRAM_STORE_PATH, first=None, second=None, n=1, k=20, min_count=5, db_paths=None):
+    """
+    The n-grams most characteristic of one slice of the corpus compared with another, by smoothed log-odds ratio.
+
+    :param first: dictionary of filters (thread, sender, period) for the first slice, e.g. {'sender': 'Fred', 'period': '2021'}
+    :param second: filters for the slice to compare against (the whole corpus if empty)
+    :param min_count: ignore n-grams used fewer times than this in the first slice
+    :return: list of (ngram, first_count, second_count, log_odds), most characteristic of the first slice first
+    """
+
+    conn = open_ngram_store(store_path)
+    try:
+        first_counts = ngram_counts(conn, n=n, db_paths=db_paths, **(first or {}))
+        second_counts = ngram_counts(conn, n=n, db_paths=db_paths, **(second or {}))
+        first_total = sum(first_counts.values()) or 1
+        second_total = sum(second_counts.values()) or 1
+        vocabulary_size = len(first_counts.keys() | second_counts.keys()) or 1
+        scored = []
+        for ngram_key, first_count in first_counts.items():
+            if first_count < min_count:
+                continue
+            second_count = second_counts.get(ngram_key, 0)
+            # Add-one smoothing, so n-grams missing from the second slice get a finite score
+            log_odds = (
+                math.log((first_count + 1) / (first_total + vocabulary_size))
+                - math.log((second_count + 1) / (second_total + vocabulary_size))
+            )
+            scored.append((log_odds, ngram_key, first_count, second_count))
+        scored.sort(reverse=True)
+        texts = ngram_texts(conn, [ngram_key for _, ngram_key, _, _ in scored[:k]])
+        return [(texts.get(ngram_key, '?'), first_count, second_count, round(log_odds, 3)) for log_odds, ngram_key, first_count, second_count in scored[:k]]
+    finally:
+        conn.close()
+
+
+def ngram_trend(store_path=DEFAULT_NGRAM_STORE_PATH, ngram='', thread=None, sender=None, by_year=True, db_paths=None):
+    """
+    How often one n-gram was used over time.
+
+    :return: list of (period, count) in chronological order, by year (or by month if by_year is False)
+    """
+
+    conn = open_ngram_store(store_path)
+    try:
+        words = ' '.join(tokenize(ngram))
+        condition, params = _key_filter(conn, thread=thread, sender=sender, db_paths=db_paths)
+        period = 'substr(k.period, 1, 4)' if by_year else 'k.period'
+        rows = conn.execute(
+            f'select {period} as p, sum(c.count) from count_keys k join counts c on c.key_id = k.id '
+            f'where {condition} and c.n = ? and c.ngram_id = ? group by p order by p',
+            params + [words.count(' ') + 1, ngram_id(words)],
+        )
+        return list(rows)
+    finally:
+        conn.close()
+
+
+def add_filter_arguments(parser, prefix=''):
+    for name in ('thread', 'sender', 'period'):
+        parser.add_argument(f'--{prefix}{name}', help=f'only count this {name}' + (' (YYYY or YYYY-MM)' if name == 'period' else ''))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Word and phrase frequencies by thread, sender and period.')
+    parser.add_argument('--store', default=DEFAULT_NGRAM_STORE_PATH, help='n-gram store path')
+    parser.add_argument('--no-ingest', action='store_true', help="don't read new messages from the database first")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    top_parser = subparsers.add_parser('top', help='most frequent words or phrases')
+    add_filter_arguments(top_parser)
+    top_parser.add_argument('-n', type=int, default=1, help='words per phrase')
+    top_parser.add_argument('-k', type=int, default=20, help='number of results')
+    top_parser.add_argument('--min-length', type=int, default=1, help='skip shorter words or phrases')
+
+    compare_parser = subparsers.add_parser('compare', help='words or phrases most characteristic of one slice compared with another')
+    add_filter_arguments(compare_parser)
+    add_filter_arguments(compare_parser, prefix='vs-')
+    compare_parser.add_argument('-n', type=int, default=1, help='words per phrase')
+    compare_parser.add_argument('-k', type=int, default=20, help='number of results')
+    compare_parser.add_argument('--min-count', type=int, default=5)
+
+    trend_parser = subparsers.add_parser('trend', help='how often a word or phrase was used each year')
+    trend_parser.add_argument('ngram')
+    trend_parser.add_argument('--thread')
+    trend_parser.add_argument('--sender')
+    trend_parser.add_argument('--by-month', action='store_true')
+
+    args = parser.parse_args(argv)
+    if not args.no_ingest:
+        ingested = ingest_new_messages(args.store)
+        rebuilt = ' (name_groups.json changed, so the counts were rebuilt)' if ingested['rebuilt'] else ''
+        print(f"Ingested {ingested['messages']} new messages in {ingested['seconds']}s{rebuilt}", file=sys.stderr)
+
+    if args.command == 'top':
+        for ngram, count in top_ngrams(args.store, n=args.n, k=args.k, thread=args.thread, sender=args.sender, period=args.period, min_length=args.min_length):
+            print(f'{count:>8}  {ngram}')
+    elif args.command == 'compare':
+        first = {name: getattr(args, name) for name in ('thread', 'sender', 'period') if getattr(args, name) is not None}
+        second = {name: getattr(args, f'vs_{name}') for name in ('thread', 'sender', 'period') if getattr(args, f'vs_{name}') is not None}
+        for ngram, first_count, second_count, log_odds in compare_ngrams(args.store, first, second, n=args.n, k=args.k, min_count=args.min_count):
+            print(f'{log_odds:>7.2f}  {first_count:>6} vs {second_count:<6}  {ngram}')
+    else:
+        for period, count in ngram_trend(args.store, args.ngram, thread=args.thread, sender=args.sender, by_year=not args.by_month):
+            print(f'{period}  {count}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,204 @@
+import bisect
+import re
+
+from .indexes import build_thread_index
+from .shared_utils import MY_DISPLAY_NAME, get_primary_other_name
+
+
+"""
+A small structured query language for searching messages, e.g.
+
+    from:Dan in:"Family Group" after:2021 dinner
+
+Supported filters (values with spaces can be quoted):
+- from:NAME     messages sent by NAME (an alias or phone number works if it's in name_groups; "me" means you)
+- in:NAME       messages in the conversation named NAME
+- after:DATE    messages on or after DATE (YYYY, YYYY-MM or YYYY-MM-DD)
+- before:DATE   messages before DATE
+Everything else is the text to search for (a case-insensitive substring by default; quote it to keep exact spacing).
+
+Queries are parsed into a plan that applies the cheapest, most selective filters first: thread and sender dictionary
+lookups, then date ranges by binary search over each thread's sorted timestamps, and text matching last.
+"""
+
+FILTER_OPERATORS = ('from', 'in', 'after', 'before')
+QUERY_TOKEN_RE = re.compile(r'(?:(\w+):)?(?:"([^"]*)"|(\S+))')
+STRUCTURED_QUERY_RE = re.compile(r'(?:^|\s)(?:' + '|'.join(FILTER_OPERATORS) + r'):\S')
+DATE_RE = re.compile(r'^(\d{4})(?:[-/](\d{1,2})(?:[-/](\d{1,2}))?)?$')
+
+
+def is_structured_query(query):
+    """True if the query uses any of the filter operators."""
+    return STRUCTURED_QUERY_RE.search(query) is not None
+
+
+def normalize_date(value):
+    """Converts YYYY, YYYY-MM or YYYY-MM-DD (or with slashes) to a prefix comparable with message timestamps."""
+    match = DATE_RE.match(value)
+    if not match:
+        raise ValueError(f'Could not understand the date "{value}" (use YYYY, YYYY-MM or YYYY-MM-DD)')
+    year, month, day = match.groups()
+    parts = [year] + [part.zfill(2) for part in (month, day) if part]
+    return '-'.join(parts)
+
+
+def parse_query(query):
+    """
+    Parses a structured query into a plan.
+
+    :return: dictionary with 'threads' and 'senders' (lists of names), 'after' and 'before' (timestamp prefixes or None)
+        and 'text' (the remaining free text, possibly empty)
+    """
+
+    plan = {'threads': [], 'senders': [], 'after': None, 'before': None, 'text': ''}
+    text_parts = []
+    for match in QUERY_TOKEN_RE.finditer(query):
+        operator, quoted_value, bare_value = match.groups()
+        value = quoted_value if quoted_value is not None else bare_value
+        if operator is not None and operator.lower() in FILTER_OPERATORS:
+            operator = operator.lower()
+            if operator == 'from':
+                plan['senders'].append(value)
+            elif operator == 'in':
+                plan['threads'].append(value)
+            elif operator == 'after':
+                plan['after'] = normalize_date(value)
+            else:
+                plan['before'] = normalize_date(value)
+        else:
+            text_parts.append(value if operator is None else f'{operator}:{value}')
+    plan['text'] = ' '.join(text_parts)
+    return plan
+
+
+def resolve_name(name, candidates, name_groups=None):
+    """
+    Finds `name` among `candidates` (thread or sender names): exact match first, then case-insensitive,
+    then through name_groups aliases. Returns None if nothing matches.
+    """
+
+    if name in candidates:
+        return name
+    folded_candidates = {candidate.casefold(): candidate for candidate in candidates if candidate is not None}
+    if name.casefold() in folded_candidates:
+        return folded_candidates[name.casefold()]
+    if name_groups:
+        primary_name = get_primary_other_name(name, name_groups=name_groups)
+        if primary_name in candidates:
+            return primary_name
+        return folded_candidates.get(primary_name.casefold())
+    return None
+
+
+def candidate_positions(thread_index, plan, name_groups=None):
+    """
+    Positions in the thread that pass the sender and date filters, in chronological order.
+    Sender filters are dictionary lookups into per-sender position lists; date filters are binary searches.
+    """
+
+    timestamps = thread_index['timestamps']
+    lo, hi = 0, len(timestamps)
+    if thread_index['timestamps_sorted']:
+        if plan['after'] is not None:
+            lo = bisect.bisect_left(timestamps, plan['after'])
+        if plan['before'] is not None:
+            hi = bisect.bisect_left(timestamps, plan['before'])
+
+    if plan['senders']:
+        sender_names = list(thread_index['senders'])
+        positions = []
+        for sender in plan['senders']:
+            sender = MY_DISPLAY_NAME if sender.casefold() == 'me' else sender
+            resolved = resolve_name(sender, sender_names, name_groups=name_groups)
+            if resolved is not None:
+                sender_positions = thread_index['senders'][resolved]
+                positions.extend(sender_positions[bisect.bisect_left(sender_positions, lo):bisect.bisect_left(sender_positions, hi)])
+        positions.sort()
+    else:
+        positions = range(lo, max(lo, hi))
+
+    if not thread_index['timestamps_sorted']:
+        positions = [
+            position for position in positions
+            if (plan['after'] is None or timestamps[position] >= plan['after'])
+            and (plan['before'] is None or timestamps[position] < plan['before'])
+        ]
+    return positions
+
+
+def structured_search(message_obj, query, ignore_case=True, max_results=20, most_recent=True, indexes=None, name_groups=None,
+                      thread_name=None):
+    """
+    Searches messages with a structured query (see the module docstring).
+    Takes the same kind of message_obj as search_corpus and returns the same structure as corpus.search_matches.
+    Messages that match only on filters (no free text) get an empty (0, 0) span.
+
+    :param query: query string, or a plan returned by parse_query
+    :param indexes: optional {name: build_thread_index(...)} cache, so repeated queries don't rebuild the thread indexes
+    :param name_groups: optional name groups, so from: and in: accept aliases and phone numbers
+    :param thread_name: name of the thread when message_obj is a single message list, which in: filters are checked against
+    :raises ValueError: if a date can't be parsed, or the query has in: filters and message_obj is a list without a thread_name
+    """
+
+    plan = parse_query(query) if isinstance(query, str) else query
+    if isinstance(message_obj, list):
+        named_lists = [(None, message_obj)]
+        if plan['threads']:
+            if thread_name is None:
+                raise ValueError('in: filters need a dictionary of threads, or the thread_name of the message list')
+            if not any(resolve_name(thread, [thread_name], name_groups=name_groups) for thread in plan['threads']):
+                named_lists = []
+    elif isinstance(message_obj, dict):
+        if plan['threads']:
+            thread_names = {resolve_name(thread, list(message_obj), name_groups=name_groups) for thread in plan['threads']}
+            named_lists = [(name, message_obj[name]) for name in message_obj if name in thread_names]
+        else:
+            named_lists = list(message_obj.items())
+    else:
+        raise TypeError(f"message_obj was {type(message_obj)} which is not recognized")
+
+    text = plan['text']
+    folded_text = text.lower() if ignore_case else text
+    num_matches = 0
+    matches = {}
+    ordered_lists = {}
+    for name, message_list in named_lists:
+        if not message_list:
+            continue
+        thread_index = indexes.get(name) if indexes is not None else None
+        if thread_index is None:
+            thread_index = build_thread_index(message_list)
+            if indexes is not None:
+                indexes[name] = thread_index
+        positions = candidate_positions(thread_index, plan, name_groups=name_groups)
+        if most_recent:
+            positions = reversed(positions)
+
+        last_position = len(message_list) - 1
+        matches[name] = []
+        for position in positions:
+            span = (0, 0)
+            if text:
+                message = message_list[position]['message']
+                start = message.lower().find(folded_text) if ignore_case else message.find(text)
+                if start == -1:
+                    continue
+                span = (start, start + len(text))
+            matches[name].append((last_position - position if most_recent else position, span))
+            num_matches += 1
+            if num_matches == max_results:
+                break
+        if matches[name]:
+            ordered_lists[name] = list(reversed(message_list)) if most_recent else message_list
+        if num_matches == max_results:
+            break
+
+    if isinstance(message_obj, list) and not num_matches:
+        return
+    return {
+        'ordered_lists': ordered_lists,
+        'matches': matches,
+        'num_matches': num_matches,
+        'timed_out': False,
+        'plan': plan,
+    }
@@ -0,0 +1,113 @@
+import heapq
+import math
+
+from .indexes import build_thread_index, get_inverted_index, token_spans, tokenize
+
+
+"""
+Relevance-ranked search with BM25.
+
+Each message (or each window of consecutive messages) is scored against the query terms using an inverted index with
+term frequencies and document lengths, and a bounded heap picks the top k without sorting every hit.
+Corpus statistics (document frequencies and average length) are combined across all the threads being searched.
+"""
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def bm25_scores(inverted_indexes, terms, k1=BM25_K1, b=BM25_B):
+    """
+    Scores every document containing at least one of `terms`, term at a time.
+
+    :param inverted_indexes: {name: inverted index} for the threads being searched
+    :return: {(name, doc_id): score}
+    """
+
+    num_docs = sum(len(inverted['doc_lengths']) for inverted in inverted_indexes.values())
+    if not num_docs:
+        return {}
+    avg_doc_length = (sum(sum(inverted['doc_lengths']) for inverted in inverted_indexes.values()) / num_docs) or 1
+
+    scores = {}
+    for term in terms:
+        doc_frequency = sum(len(inverted['postings'].get(term, ())) for inverted in inverted_indexes.values())
+        if not doc_frequency:
+            continue
+        idf = math.log(1 + (num_docs - doc_frequency + 0.5) / (doc_frequency + 0.5))
+        for name, inverted in inverted_indexes.items():
+            doc_lengths = inverted['doc_lengths']
+            for doc_id, term_frequency in inverted['postings'].get(term, ()):
+                length_norm = k1 * (1 - b + b * doc_lengths[doc_id] / avg_doc_length)
+                key = (name, doc_id)
+                scores[key] = scores.get(key, 0) + idf * term_frequency * (k1 + 1) / (term_frequency + length_norm)
+    return scores
+
+
+def ranked_search(message_obj, query, max_results=20, most_recent=True, window=1, indexes=None, k1=BM25_K1, b=BM25_B):
+    """
+    Returns the top `max_results` messages (or windows) by BM25 relevance to the query's words.
+    Takes the same kind of message_obj as search_corpus and returns the same structure as corpus.search_matches, except
+    that each thread's matches are in rank order. Index numbering follows `most_recent` as usual, so results can be
+    displayed with the same context logic. Matching is on lowercased word tokens, so it is always case-insensitive.
+
+    :param window: score windows of this many consecutive messages instead of single messages; the match reported for
+        a window is the message in it with the most query-term occurrences
+    :param indexes: optional {name: build_thread_index(...)} cache, in which inverted indexes are kept between queries
+    :return: search_matches-style dictionary with extra keys 'scores' (name:list of scores parallel to matches[name])
+        and 'term_spans' (name:list parallel to matches[name] of [(term, span), ...])
+    """
+
+    if isinstance(message_obj, list):
+        named_lists = {None: message_obj}
+    elif isinstance(message_obj, dict):
+        named_lists = {name: message_list for name, message_list in message_obj.items() if message_list}
+    else:
+        raise TypeError(f"message_obj was {type(message_obj)} which is not recognized")
+
+    terms = list(dict.fromkeys(tokenize(query)))
+    inverted_indexes = {}
+    for name, message_list in named_lists.items():
+        thread_index = indexes.get(name) if indexes is not None else None
+        if thread_index is None:
+            thread_index = build_thread_index(message_list)
+            if indexes is not None:
+                indexes[name] = thread_index
+        inverted_indexes[name] = get_inverted_index(thread_index, message_list, window=window)
+
+    scores = bm25_scores(inverted_indexes, terms, k1=k1, b=b)
+    top_docs = heapq.nlargest(max_results, scores.items(), key=lambda item: item[1])
+
+    term_set = set(terms)
+    matches = {}
+    match_scores = {}
+    term_spans = {}
+    for (name, doc_id), score in top_docs:
+        message_list = named_lists[name]
+        window_start = doc_id * window
+        window_spans = [
+            (position, token_spans(message_list[position]['message'], term_set))
+            for position in range(window_start, min(window_start + window, len(message_list)))
+        ]
+        position, spans = max(window_spans, key=lambda item: len(item[1]))
+        ordered_idx = len(message_list) - 1 - position if most_recent else position
+        matches.setdefault(name, []).append((ordered_idx, spans[0][1] if spans else (0, 0)))
+        match_scores.setdefault(name, []).append(score)
+        term_spans.setdefault(name, []).append(spans)
+
+    num_matches = len(top_docs)
+    if isinstance(message_obj, list):
+        if not num_matches:
+            return
+        matches.setdefault(None, [])
+    return {
+        'ordered_lists': {
+            name: list(reversed(named_lists[name])) if most_recent else named_lists[name]
+            for name in matches
+        },
+        'matches': matches,
+        'num_matches': num_matches,
+        'timed_out': False,
+        'scores': match_scores,
+        'term_spans': term_spans,
+    }
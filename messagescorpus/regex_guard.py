@@ -0,0 +1,242 @@
+"""
+Guarded regex search for user-supplied patterns.
+
+Patterns are first checked statically for the shapes that cause catastrophic backtracking (e.g. `(a+)+$`), then matched
+in a separate worker process with a time budget. The worker is started once and kept, along with the texts of the last
+search, so repeat searches over the same thread neither start a process (which with the spawn start method, the default
+on macOS, re-imports the caller's __main__) nor send the texts again. Searches take turns with the worker, and the time
+budget covers waiting for it as well as sending the texts, so concurrent searches each still finish within their budget.
+On timeout the worker is terminated (and started again by the next search), and the caller gets whatever matches were
+found so far, plus a flag saying the search didn't finish.
+"""
+
+import multiprocessing
+import re
+import threading
+import time
+
+try:
+    from re import _parser as sre_parse
+    from re import _constants as sre_constants
+except ImportError:  # Python < 3.11
+    import sre_parse
+    import sre_constants
+
+
+DEFAULT_REGEX_TIMEOUT_SECONDS = 2.0
+# How many messages the worker scans between progress reports, so partial results survive a timeout
+WORKER_REPORT_INTERVAL = 2000
+
+# The worker process, its end of the pipe and the key of the texts it holds; searches take turns with it
+REGEX_WORKER = {'process': None, 'conn': None, 'texts_key': None}
+REGEX_WORKER_LOCK = threading.Lock()
+
+REPEAT_OPCODES = {sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT}
+if hasattr(sre_constants, 'POSSESSIVE_REPEAT'):
+    REPEAT_OPCODES.add(sre_constants.POSSESSIVE_REPEAT)
+
+
+class UnsafeRegexError(re.error):
+    """Raised for patterns that are valid but likely to backtrack exponentially."""
+
+
+def _is_unbounded_repeat(op, av):
+    return op in REPEAT_OPCODES and av[1] > 1
+
+
+def _contains_repeat(subpattern):
+    for op, av in subpattern:
+        if _is_unbounded_repeat(op, av):
+            return True
+        for child in _child_subpatterns(op, av):
+            if _contains_repeat(child):
+                return True
+    return False
+
+
+def _child_subpatterns(op, av):
+    if op in REPEAT_OPCODES:
+        return [av[2]]
+    if op == sre_constants.SUBPATTERN:
+        return [av[-1]]
+    if op == sre_constants.BRANCH:
+        return list(av[1])
+    if op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+        return [av[1]]
+    if op == sre_constants.GROUPREF_EXISTS:
+        return [child for child in av[1:] if child is not None]
+    return []
+
+
+def _contains_duplicate_branches(subpattern):
+    """True if any alternation in `subpattern` has two identical branches (the parser factors out common prefixes first)."""
+    for op, av in subpattern:
+        if op == sre_constants.BRANCH:
+            branches = [str(branch) for branch in av[1]]
+            if len(set(branches)) < len(branches):
+                return True
+        for child in _child_subpatterns(op, av):
+            if _contains_duplicate_branches(child):
+                return True
+    return False
+
+
+def _find_unsafe_construct(subpattern):
+    for op, av in subpattern:
+        if _is_unbounded_repeat(op, av):
+            body = av[2]
+            if _contains_repeat(body):
+                return 'nested quantifiers, e.g. (a+)+'
+            if _contains_duplicate_branches(body):
+                return 'a repeated alternation with duplicate branches, e.g. (ab|ab)*'
+        for child in _child_subpatterns(op, av):
+            reason = _find_unsafe_construct(child)
+            if reason:
+                return reason
+    return None
+
+
+def check_regex_safety(pattern, flags=0):
+    """
+    Compiles `pattern` and rejects shapes known to backtrack exponentially.
+
+    :raises re.error: if the pattern is invalid
+    :raises UnsafeRegexError: if the pattern contains nested unbounded quantifiers or a repeated ambiguous alternation
+    """
+
+    re.compile(pattern, flags)
+    reason = _find_unsafe_construct(sre_parse.parse(pattern, flags))
+    if reason:
+        raise UnsafeRegexError(f'pattern rejected because it contains {reason}, which can take exponential time')
+
+
+def _regex_worker(conn):
+    """
+    Worker process loop. Requests are ('texts', texts), which replaces the texts searched, and
+    ('search', pattern, flags, regex_group, max_results), which is acknowledged with 'started' and answered with chunks of
+    (index, span) matches followed by None.
+    """
+
+    texts = []
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            return
+        if request[0] == 'texts':
+            texts = request[1]
+            continue
+        _, pattern, flags, regex_group, max_results = request
+        conn.send('started')
+        compiled = re.compile(pattern, flags)
+        group = [regex_group] if regex_group else []
+        found = []
+        num_found = 0
+        for idx, text in enumerate(texts):
+            match = compiled.search(text)
+            if match:
+                found.append((idx, match.span(*group)))
+                num_found += 1
+                if num_found == max_results:
+                    break
+            if idx % WORKER_REPORT_INTERVAL == WORKER_REPORT_INTERVAL - 1:
+                conn.send(found)
+                found = []
+        conn.send(found)
+        conn.send(None)
+
+
+def _start_regex_worker():
+    parent_conn, child_conn = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_regex_worker, args=(child_conn,), daemon=True)
+    process.start()
+    child_conn.close()
+    REGEX_WORKER.update(process=process, conn=parent_conn, texts_key=None)
+
+
+def stop_regex_worker():
+    """Terminates the worker, if there is one; the next search starts a new one. Call with REGEX_WORKER_LOCK held."""
+    if REGEX_WORKER['process'] is None:
+        return
+    if REGEX_WORKER['process'].is_alive():
+        REGEX_WORKER['process'].terminate()
+    REGEX_WORKER['process'].join()
+    REGEX_WORKER['conn'].close()
+    REGEX_WORKER.update(process=None, conn=None, texts_key=None)
+
+
+def _send_search(texts, texts_key, search_request):
+    """
+    Sends the texts (unless the worker already has them) and the search, and waits until the worker has started it.
+
+    :return: seconds spent starting a new worker process, if one had to be started
+    """
+
+    startup_seconds = 0.0
+    for _ in range(2):
+        if REGEX_WORKER['process'] is None or not REGEX_WORKER['process'].is_alive():
+            stop_regex_worker()
+            started_at = time.perf_counter()
+            _start_regex_worker()
+            startup_seconds += time.perf_counter() - started_at
+        try:
+            if texts_key is None or REGEX_WORKER['texts_key'] != texts_key:
+                REGEX_WORKER['texts_key'] = None
+                REGEX_WORKER['conn'].send(('texts', texts))
+                REGEX_WORKER['texts_key'] = texts_key
+            REGEX_WORKER['conn'].send(search_request)
+            REGEX_WORKER['conn'].recv()
+            return startup_seconds
+        except (EOFError, OSError):  # The worker died (e.g. out of memory); start a new one and try once more
+            stop_regex_worker()
+    raise RuntimeError('The regex worker process could not be started')
+
+
+def guarded_regex_search(texts, pattern, ignore_case=True, regex_group=None, max_results=20, timeout=DEFAULT_REGEX_TIMEOUT_SECONDS,
+                         texts_key=None):
+    """
+    Runs re.search over `texts` in the worker process, giving up `timeout` seconds after the call. The budget includes
+    waiting for other searches to finish with the worker and sending it the texts, but not starting a new worker process.
+
+    :param texts: list of strings to search, in the order results should be returned
+    :param texts_key: optional value that equals the previous search's `texts_key` only if `texts` are the same, e.g. a tuple
+        of the message lists they came from and their lengths; the worker then searches the texts it already has
+    :return: dictionary with keys 'matches' (list of (index, span)), 'timed_out' and 'elapsed_seconds'
+    :raises re.error / UnsafeRegexError: from check_regex_safety, before anything is sent to the worker
+    """
+
+    flags = re.IGNORECASE if ignore_case else 0
+    check_regex_safety(pattern, flags)
+
+    started_at = time.perf_counter()
+    matches = []
+    if not REGEX_WORKER_LOCK.acquire(timeout=timeout):
+        return {'matches': matches, 'timed_out': True, 'elapsed_seconds': round(time.perf_counter() - started_at, 3)}
+    try:
+        if time.perf_counter() - started_at >= timeout:
+            # The whole budget went on waiting; leave the worker (and the texts it holds) alone
+            return {'matches': matches, 'timed_out': True, 'elapsed_seconds': round(time.perf_counter() - started_at, 3)}
+        deadline = started_at + timeout + _send_search(texts, texts_key, ('search', pattern, flags, regex_group, max_results))
+        conn = REGEX_WORKER['conn']
+        timed_out = False
+        try:
+            while True:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0 or not conn.poll(remaining):
+                    timed_out = True
+                    break
+                chunk = conn.recv()
+                if chunk is None:
+                    break
+                matches.extend(chunk)
+        except EOFError:  # Worker died without finishing (e.g. out of memory); report what we have
+            timed_out = True
+        if timed_out:
+            stop_regex_worker()
+    finally:
+        REGEX_WORKER_LOCK.release()
+    return {
+        'matches': matches[:max_results],
+        'timed_out': timed_out,
+        'elapsed_seconds': round(time.perf_counter() - started_at, 3),
+    }
@@ -0,0 +1,254 @@
+import argparse
+import contextlib
+import fcntl
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from pathlib import Path
+
+from .corpus import load_all_threads
+from .shared_utils import CORPUS_CACHE_DIR
+
+
+"""
+A corpus cache on disk that several server processes share, instead of each loading every thread from chat.db.
+
+One loader reads the databases (a single pass, via load_all_threads) and writes every thread's messages, the names list
+and per-thread summaries to a versioned SQLite file, corpus-<version>.sqlite. Builds are serialized with an exclusive
+lock on build.lock, and a finished build is published by atomically replacing current.json (the version stamp), so
+readers only ever see complete versions. Each worker attaches to the current version read-only (the file is immutable once
+published), checks the stamp with one stat per request, and reattaches when a new version appears. Threads are read with
+one indexed range query, so workers share the OS page cache for the file rather than each holding the whole corpus.
+
+Build a version ahead of starting the workers (otherwise the first request builds it) with:
+
+    python -m messagescorpus.shared_cache build
+"""
+
+SHARED_CACHE_DIR = os.path.join(CORPUS_CACHE_DIR, 'shared')
+CURRENT_FILE = 'current.json'
+LOCK_FILE = 'build.lock'
+CORPUS_FILE_RE = re.compile(r'corpus-(\d+)\.sqlite')
+# Versions this many older than the current one are deleted when a new one is published. Workers still attached to one
+# keep reading it through their open connection until they notice the new stamp.
+KEEP_VERSIONS = 2
+
+SHARED_CACHE_SCHEMA = """
+create table names (name text primary key);
+create table threads (
+    id integer primary key, name text not null unique, message_count integer not null, first_timestamp text,
+    last_timestamp text, last_sender text, last_message text
+);
+create table messages (
+    thread_id integer not null, position integer not null, sender text not null, timestamp text not null,
+    message text not null, guid text, primary key (thread_id, position)
+) without rowid;
+"""
+
+
+@contextlib.contextmanager
+def build_lock(cache_dir=SHARED_CACHE_DIR):
+    """Holds the exclusive build lock, waiting for any build in another process to finish first."""
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, LOCK_FILE), 'a') as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def current_stamp(cache_dir=SHARED_CACHE_DIR):
+    """Cheap change marker for the published version: (inode, mtime) of current.json, or None if nothing is published."""
+    try:
+        stat = os.stat(os.path.join(cache_dir, CURRENT_FILE))
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns
+
+
+def read_current_version(cache_dir=SHARED_CACHE_DIR):
+    """The published version's info ('version', 'file', 'built_at', 'build_seconds', 'threads', 'messages'), or None."""
+    try:
+        with open(os.path.join(cache_dir, CURRENT_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_shared_cache(path, corpus):
+    """Writes a corpus as returned by load_all_threads to a new SQLite file at `path`."""
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    try:
+        # A half-written file is simply discarded, so skip the journal
+        conn.execute('pragma journal_mode = off')
+        conn.execute('pragma synchronous = off')
+        conn.executescript(SHARED_CACHE_SCHEMA)
+        conn.executemany('insert into names (name) values (?)', [(name,) for name in corpus['names']])
+        for thread_id, (name, messages) in enumerate(corpus['messages'].items()):
+            last_message = messages[-1] if messages else {}
+            conn.execute(
+                'insert into threads values (?, ?, ?, ?, ?, ?, ?)',
+                (
+                    thread_id, name, len(messages), messages[0]['timestamp'] if messages else None, last_message.get('timestamp'),
+                    last_message.get('sender'), last_message.get('message'),
+                ),
+            )
+            conn.executemany(
+                'insert into messages values (?, ?, ?, ?, ?, ?)',
+                (
+                    (thread_id, position, message['sender'], message['timestamp'], message['message'], message['guid'])
+                    for position, message in enumerate(messages)
+                ),
+            )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _write_current_version(cache_dir, info):
+    temp_path = os.path.join(cache_dir, CURRENT_FILE + '.tmp')
+    with open(temp_path, 'w') as f:
+        json.dump(info, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, os.path.join(cache_dir, CURRENT_FILE))
+
+
+def _prune_old_versions(cache_dir, current_version):
+    for file_name in os.listdir(cache_dir):
+        match = CORPUS_FILE_RE.fullmatch(file_name)
+        if match and int(match.group(1)) <= current_version - KEEP_VERSIONS:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(cache_dir, file_name))
+
+
+def publish_shared_cache(cache_dir=SHARED_CACHE_DIR, db_paths=None, progress_callback=None, if_missing=False):
+    """
+    Builds a new version of the shared cache from the message databases and publishes it.
+
+    :param progress_callback: optional callable(rows_processed, total_rows), passed to load_all_threads
+    :param if_missing: only build if no version is published yet (e.g. when several workers start at once, the first one
+        builds and the others wait for the lock and then use its version)
+    :return: the published version's info (see read_current_version)
+    """
+
+    with build_lock(cache_dir):
+        current = read_current_version(cache_dir)
+        if if_missing and current is not None:
+            return current
+        started_at = time.time()
+        corpus = load_all_threads(progress_callback=progress_callback, db_paths=db_paths)
+        version = current['version'] + 1 if current is not None else 1
+        file_name = f'corpus-{version}.sqlite'
+        temp_path = os.path.join(cache_dir, file_name + '.tmp')
+        write_shared_cache(temp_path, corpus)
+        os.replace(temp_path, os.path.join(cache_dir, file_name))
+        info = {
+            'version': version,
+            'file': file_name,
+            'built_at': time.time(),
+            'build_seconds': round(time.time() - started_at, 3),
+            'threads': len(corpus['messages']),
+            'messages': sum(len(messages) for messages in corpus['messages'].values()),
+        }
+        _write_current_version(cache_dir, info)
+        _prune_old_versions(cache_dir, version)
+    return info
+
+
+def attach_shared_cache(cache_dir=SHARED_CACHE_DIR, db_paths=None):
+    """
+    Opens the published version read-only, building one first if there is none.
+
+    :return: dictionary with 'version', 'info', 'stamp' (see current_stamp), 'conn' and 'lock' (held while using conn)
+    """
+
+    for _ in range(3):
+        stamp = current_stamp(cache_dir)
+        info = read_current_version(cache_dir)
+        if info is None:
+            publish_shared_cache(cache_dir, db_paths=db_paths, if_missing=True)
+            continue
+        uri = Path(cache_dir, info['file']).resolve().as_uri() + '?mode=ro&immutable=1'
+        try:
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            conn.execute('select 1 from threads limit 1')
+        except sqlite3.OperationalError:
+            continue  # Pruned between reading current.json and opening it; a newer version has been published
+        return {'version': info['version'], 'info': info, 'stamp': stamp, 'conn': conn, 'lock': threading.Lock()}
+    raise RuntimeError(f'Could not attach to the shared corpus cache in {cache_dir}')
+
+
+def detach_shared_cache(shared_cache):
+    with shared_cache['lock']:
+        shared_cache['conn'].close()
+
+
+def read_names(shared_cache):
+    with shared_cache['lock']:
+        return [row[0] for row in shared_cache['conn'].execute('select name from names order by name')]
+
+
+def read_thread(shared_cache, name):
+    """
+    One thread's messages, in the same form as messages_from_sqlite.
+
+    :raises IndexError: if there is no thread with that name (as messages_from_sqlite does)
+    """
+
+    with shared_cache['lock']:
+        row = shared_cache['conn'].execute('select id from threads where name = ?', (name,)).fetchone()
+        if row is None:
+            raise IndexError(name)
+        rows = shared_cache['conn'].execute(
+            'select sender, timestamp, message, guid from messages where thread_id = ? order by position', (row[0],)
+        ).fetchall()
+    return [
+        {'sender': sender, 'timestamp': timestamp, 'message': message_text, 'guid': guid}
+        for sender, timestamp, message_text, guid in rows
+    ]
+
+
+def read_thread_summaries(shared_cache):
+    """Conversation summaries in the same form as thread_summaries_from_sqlite, most recently active first."""
+    with shared_cache['lock']:
+        rows = shared_cache['conn'].execute(
+            """
+            select name, message_count, first_timestamp, last_timestamp, last_sender, last_message
+            from threads
+            where name in (select name from names) and message_count > 0
+            order by last_timestamp desc
+            """
+        ).fetchall()
+    keys = ('name', 'message_count', 'first_timestamp', 'last_timestamp', 'last_sender', 'last_message')
+    return [dict(zip(keys, row)) for row in rows]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build or inspect the corpus cache shared by web app workers.')
+    parser.add_argument('command', choices=['build', 'status'])
+    parser.add_argument('--cache-dir', default=SHARED_CACHE_DIR)
+    parser.add_argument('--db', action='append', dest='db_paths', help='message database to read (repeat to merge several)')
+    args = parser.parse_args(argv)
+    if args.command == 'build':
+        info = publish_shared_cache(args.cache_dir, db_paths=args.db_paths)
+        print(f"Published version {info['version']}: {info['messages']} messages in {info['threads']} threads ({info['build_seconds']}s)")
+        return 0
+    info = read_current_version(args.cache_dir)
+    if info is None:
+        print(f'No version published in {args.cache_dir}')
+        return 1
+    age = time.time() - info['built_at']
+    print(f"Version {info['version']} ({info['file']}): {info['messages']} messages in {info['threads']} threads, built {age:.0f}s ago")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
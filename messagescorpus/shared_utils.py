@@ -3,6 +3,9 @@ import os
 import re
 
 BASE_REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Files derived from the message databases (always safe to delete; they are rebuilt on demand)
+CORPUS_CACHE_DIR = os.environ.get('MESSAGESCORPUS_CACHE_DIR', os.path.join(BASE_REPO_DIR, 'cache'))
+NAME_GROUPS_PATH = os.path.join(BASE_REPO_DIR, 'name_groups.json')
 
 # How your messages will appear in the parsed logs
 MY_DISPLAY_NAME = 'Fred'
@@ -40,7 +43,7 @@ def get_name_groups():
     as that's how the threads are formatted, rather than using their name.
     """
 
-    with open(os.path.join(BASE_REPO_DIR, 'name_groups.json'), 'r') as ng:
+    with open(NAME_GROUPS_PATH, 'r') as ng:
         name_groups = json.load(ng)
     name_groups_cleaned = {}
     for k, v in name_groups.items():
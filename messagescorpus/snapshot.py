@@ -0,0 +1,217 @@
+import atexit
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import quote
+
+
+"""
+Read-only snapshots of chat.db.
+
+Reading the live database while Messages.app writes to it can hit lock waits, and separate queries can see different
+states of the data. A snapshot copies the database once with the SQLite backup API (into memory or a temp file), adds
+indexes suited to our queries, and all reads then go against that stable copy. The original file is only ever opened
+read-only.
+"""
+
+# '' (read the live database), 'memory' or 'file'
+SNAPSHOT_MODE = os.environ.get('MESSAGESCORPUS_SNAPSHOT', '')
+# Snapshots older than this are refreshed on next use (None means never refresh automatically)
+SNAPSHOT_MAX_AGE_SECONDS = float(os.environ['MESSAGESCORPUS_SNAPSHOT_MAX_AGE']) if os.environ.get('MESSAGESCORPUS_SNAPSHOT_MAX_AGE') else None
+
+SNAPSHOT_INDEXES = [
+    # Single-thread loads (SQLITE_THREAD_QUERY) filter on this expression. Apple's schema has no index on it.
+    "create index if not exists snapshot_message_thread_date on message(coalesce(cache_roomnames, handle_id), date)",
+    "create index if not exists snapshot_message_date on message(date)",
+    "create index if not exists snapshot_chat_room_name on chat(room_name)",
+    "create index if not exists snapshot_chat_handle_join_chat on chat_handle_join(chat_id, handle_id)",
+    # Apple's own index for the per-chat summary pass (SQLITE_SUMMARY_QUERY), for databases that predate it
+    "create index if not exists chat_message_join_idx_message_date_id_chat_id on chat_message_join(chat_id, message_date, message_id)",
+]
+
+SNAPSHOTS = {}
+SNAPSHOTS_LOCK = threading.Lock()
+
+
+def set_snapshot_mode(mode, max_age_seconds=None):
+    """
+    Turns snapshot reads on or off for subsequent loads.
+
+    :param mode: '' to read the live database, 'memory' or 'file' to read from a snapshot
+    :param max_age_seconds: refresh snapshots older than this on next use (None to keep them until refresh_snapshot is called)
+    """
+
+    global SNAPSHOT_MODE, SNAPSHOT_MAX_AGE_SECONDS
+    if mode not in ('', 'memory', 'file'):
+        raise ValueError(f'Unknown snapshot mode "{mode}" (expected "", "memory" or "file")')
+    SNAPSHOT_MODE = mode
+    SNAPSHOT_MAX_AGE_SECONDS = max_age_seconds
+
+
+def connect_read_only(db_path):
+    return sqlite3.connect(f'file:{quote(os.path.abspath(db_path))}?mode=ro', uri=True)
+
+
+def database_file_state(db_path):
+    """(size, modification time) of a database file and of its write-ahead log, which change with every write."""
+    state = []
+    for path in (db_path, db_path + '-wal'):
+        try:
+            stat_result = os.stat(path)
+        except FileNotFoundError:
+            state.append(None)
+        else:
+            state.append((stat_result.st_size, stat_result.st_mtime_ns))
+    return tuple(state)
+
+
+def create_snapshot(source_path, in_memory=False):
+    """
+    Copies `source_path` with the backup API and indexes the copy.
+
+    :return: snapshot dictionary with the copy's location, creation time, the source's state when it was copied (see
+        database_file_state) and how long the copy and indexing took
+    """
+
+    started_at = time.perf_counter()
+    source_state = database_file_state(source_path)
+    source = connect_read_only(source_path)
+    if in_memory:
+        snapshot_path = None
+        destination = sqlite3.connect(':memory:', check_same_thread=False)
+    else:
+        fd, snapshot_path = tempfile.mkstemp(prefix='chat-snapshot-', suffix='.db')
+        os.close(fd)
+        destination = sqlite3.connect(snapshot_path)
+    try:
+        # Copy in a single step so the snapshot is one consistent state of the source
+        source.backup(destination)
+    finally:
+        source.close()
+    copy_seconds = time.perf_counter() - started_at
+    for index_sql in SNAPSHOT_INDEXES:
+        destination.execute(index_sql)
+    destination.execute('analyze')
+    destination.commit()
+    if not in_memory:
+        destination.close()
+        destination = None
+    return {
+        'source_path': source_path,
+        'path': snapshot_path,
+        'connection': destination,
+        'lock': threading.Lock(),
+        'created_at': time.time(),
+        'source_state': source_state,
+        'copy_seconds': round(copy_seconds, 3),
+        'refresh_seconds': round(time.perf_counter() - started_at, 3),
+    }
+
+
+def discard_snapshot(snapshot):
+    if snapshot['connection'] is not None:
+        snapshot['connection'].close()
+    if snapshot['path'] is not None and os.path.exists(snapshot['path']):
+        os.remove(snapshot['path'])
+
+
+def refresh_snapshot(source_path, in_memory=None):
+    """Replaces (or creates) the snapshot of `source_path`, returning the new snapshot."""
+    if in_memory is None:
+        in_memory = SNAPSHOT_MODE == 'memory'
+    snapshot = create_snapshot(source_path, in_memory=in_memory)
+    with SNAPSHOTS_LOCK:
+        old_snapshot = SNAPSHOTS.get(source_path)
+        SNAPSHOTS[source_path] = snapshot
+    if old_snapshot is not None:
+        # Wait for any reader still using an old in-memory copy
+        with old_snapshot['lock']:
+            discard_snapshot(old_snapshot)
+    return snapshot
+
+
+def is_snapshot_usable(snapshot):
+    """False if `snapshot` is missing, too old or of the wrong kind for SNAPSHOT_MODE, so get_snapshot would replace it."""
+    if snapshot is None:
+        return False
+    too_old = SNAPSHOT_MAX_AGE_SECONDS is not None and time.time() - snapshot['created_at'] > SNAPSHOT_MAX_AGE_SECONDS
+    wrong_kind = (snapshot['path'] is None) != (SNAPSHOT_MODE == 'memory')
+    return not too_old and not wrong_kind
+
+
+def get_snapshot(source_path):
+    """Returns the current snapshot of `source_path`, creating or refreshing it if it's missing or too old."""
+    snapshot = SNAPSHOTS.get(source_path)
+    if not is_snapshot_usable(snapshot):
+        snapshot = refresh_snapshot(source_path)
+    return snapshot
+
+
+@atexit.register
+def discard_all_snapshots():
+    with SNAPSHOTS_LOCK:
+        for snapshot in SNAPSHOTS.values():
+            discard_snapshot(snapshot)
+        SNAPSHOTS.clear()
+
+
+def snapshot_status():
+    """Age and refresh cost of each snapshot, e.g. for display or monitoring."""
+    now = time.time()
+    return [
+        {
+            'source_path': source_path,
+            'in_memory': snapshot['path'] is None,
+            'age_seconds': round(now - snapshot['created_at'], 3),
+            'copy_seconds': snapshot['copy_seconds'],
+            'refresh_seconds': snapshot['refresh_seconds'],
+        }
+        for source_path, snapshot in SNAPSHOTS.items()
+    ]
+
+
+def message_db_state(db_path):
+    """
+    State of the data that the next read of `db_path` would see (see database_file_state): the source's state when its
+    snapshot was taken if snapshot mode is on and the snapshot is still usable, otherwise its current state (which is what
+    a new snapshot would copy). Never takes a snapshot itself, so it's cheap enough for conditional requests.
+    """
+
+    snapshot = SNAPSHOTS.get(db_path)
+    if SNAPSHOT_MODE and is_snapshot_usable(snapshot):
+        return snapshot['source_state']
+    return database_file_state(db_path)
+
+
+@contextmanager
+def open_message_db(db_path):
+    """
+    Yields a connection to read `db_path` from: its snapshot if snapshot mode is on, otherwise the live database.
+    Queries run inside one read transaction, so they all see the same state of the database.
+    """
+
+    if SNAPSHOT_MODE:
+        snapshot = get_snapshot(db_path)
+        if snapshot['path'] is not None:
+            try:
+                conn = connect_read_only(snapshot['path'])
+            except sqlite3.OperationalError:
+                # refresh_snapshot replaced and removed this copy after get_snapshot returned it; read its replacement
+                snapshot = get_snapshot(db_path)
+                conn = connect_read_only(snapshot['path']) if snapshot['path'] is not None else None
+        if snapshot['connection'] is not None:
+            # An in-memory snapshot only exists inside its one connection, so readers take turns with it
+            with snapshot['lock']:
+                yield snapshot['connection']
+            return
+    else:
+        conn = connect_read_only(db_path)
+    try:
+        conn.execute('begin')
+        yield conn
+        conn.rollback()
+    finally:
+        conn.close()
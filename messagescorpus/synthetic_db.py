@@ -0,0 +1,221 @@
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import time
+
+from .corpus import OBJECT_REPLACEMENT_CHAR
+
+
+"""
+Generates a synthetic Messages database (chat.db) for load tests and benchmarks.
+
+The tables and columns are the subset of Apple's schema that this package reads, filled with a deterministic (seeded)
+history: 1:1 conversations with email and phone handles, group chats, a long-tailed spread of messages over threads,
+messages that only have an attributedBody, and attachments. The same arguments always produce the same database, so
+timings taken against it are comparable across runs and machines. Point the loaders at it with MESSAGESCORPUS_DB_PATHS
+(or db_paths=...). Run with e.g.
+
+    python -m messagescorpus.synthetic_db /tmp/synthetic_chat.db --messages 200000
+"""
+
+SYNTHETIC_SCHEMA = """
+create table handle (rowid integer primary key, id text not null, service text);
+create table chat (rowid integer primary key, guid text, room_name text, chat_identifier text, service_name text, display_name text);
+create table chat_handle_join (chat_id integer, handle_id integer);
+create table chat_message_join (chat_id integer, message_id integer, message_date integer default 0, primary key (chat_id, message_id));
+create table message (
+    rowid integer primary key, guid text unique not null, text text, attributedBody blob, handle_id integer default 0,
+    is_from_me integer default 0, account text, date integer, service text, cache_roomnames text
+);
+create table attachment (
+    rowid integer primary key, guid text, filename text, mime_type text, transfer_name text, total_bytes integer, created_date integer
+);
+create table message_attachment_join (message_id integer, attachment_id integer);
+create index message_idx_handle on message (handle_id, date);
+create index message_idx_date on message (date);
+create index chat_message_join_idx_message_date_id_chat_id on chat_message_join (chat_id, message_date, message_id);
+"""
+
+APPLE_EPOCH = 978307200  # 2001-01-01 in Unix time; message.date counts nanoseconds from it
+MY_ACCOUNT = 'e:me@example.com'
+FIRST_NAMES = (
+    'alex', 'amy', 'ben', 'carla', 'dan', 'eli', 'fran', 'gabe', 'hana', 'ian', 'jess', 'kai', 'lena', 'max', 'nina', 'omar',
+    'pia', 'quinn', 'rosa', 'sam', 'tara', 'uma', 'vic', 'wes', 'xena', 'yuri', 'zoe',
+)
+WORDS = (
+    'the', 'a', 'to', 'you', 'i', 'and', 'it', 'is', 'that', 'for', 'on', 'are', 'we', 'be', 'have', 'do', 'at', 'what',
+    'this', 'just', 'so', 'not', 'can', 'get', 'if', 'was', 'but', 'with', 'will', 'me', 'my', 'your', 'there', 'here',
+    'lol', 'haha', 'ok', 'okay', 'yeah', 'yes', 'no', 'maybe', 'sure', 'thanks', 'sorry', 'love', 'good', 'great', 'nice',
+    'tonight', 'tomorrow', 'today', 'weekend', 'later', 'soon', 'now', 'time', 'home', 'work', 'dinner', 'lunch', 'coffee',
+    'beer', 'pizza', 'game', 'movie', 'show', 'world', 'series', 'playoffs', 'restaurant', 'birthday', 'party', 'trip',
+    'flight', 'train', 'traffic', 'weather', 'beach', 'running', 'late', 'leaving', 'call', 'text', 'picture', 'photo',
+    'family', 'mom', 'dad', 'kids', 'dog', 'cat', 'house', 'apartment', 'rent', 'money', 'phone', 'car', 'gym', 'school',
+)
+MEDIA_TYPES = (
+    ('image/jpeg', 'IMG_{}.jpeg'),
+    ('image/heic', 'IMG_{}.HEIC'),
+    ('video/quicktime', 'IMG_{}.MOV'),
+    ('application/pdf', 'Document {}.pdf'),
+)
+INSERT_BATCH_SIZE = 10000
+
+
+def attributed_body(text):
+    """A typedstream archive of an NSAttributedString holding `text`, as Messages stores it when `text` is empty."""
+    encoded = text.encode('utf-8')
+    if len(encoded) >= 0x80:
+        raise ValueError('attributedBody texts are limited to 127 bytes here')
+    return (
+        b'\x04\x0bstreamtyped\x81\xe8\x03\x84\x01@\x84\x84\x84\x12NSAttributedString\x00\x84\x84\x08NSObject\x00\x85\x92'
+        b'\x84\x84\x84\x08NSString\x01\x94\x84\x01+' + bytes([len(encoded)]) + encoded
+        + b'\x86\x84\x02iI\x01' + bytes([len(text)]) + b'\x92\x84\x84\x84\x0cNSDictionary\x00\x94\x84\x01i\x01\x92\x84\x96\x96'
+        b'\x1d__kIMMessagePartAttributeName\x86\x92\x84\x84\x84\x08NSNumber\x00\x84\x84\x07NSValue\x00\x94\x84\x01*\x84\x99\x99\x00\x86\x86\x86'
+    )
+
+
+def random_text(rng, max_words=24):
+    num_words = min(int(rng.expovariate(1 / 7)) + 1, max_words)
+    return ' '.join(rng.choice(WORDS) for _ in range(num_words))
+
+
+def build_conversations(rng, num_contacts, num_groups):
+    """
+    Returns (handles, conversations): handle rows, and conversations as dictionaries with 'chat_id', 'room_name' (None for
+    1:1 chats), 'identifier', 'service' and 'handle_ids' (their members).
+    """
+
+    handles = []
+    for contact_idx in range(num_contacts):
+        first_name = FIRST_NAMES[contact_idx % len(FIRST_NAMES)]
+        if contact_idx % 3 == 2:
+            handles.append((len(handles) + 1, f'+1555{rng.randrange(10 ** 7):07d}', 'SMS'))
+        else:
+            handles.append((len(handles) + 1, f'{first_name}{contact_idx // len(FIRST_NAMES) or ""}@example.com', 'iMessage'))
+    conversations = []
+    for handle_id, handle, service in handles:
+        conversations.append({'room_name': None, 'identifier': handle, 'service': service, 'handle_ids': [handle_id]})
+    for _ in range(num_groups):
+        room_name = f'chat{rng.randrange(10 ** 11, 10 ** 12)}'
+        members = rng.sample([handle_id for handle_id, _, _ in handles], min(len(handles), rng.randint(2, 6)))
+        conversations.append({'room_name': room_name, 'identifier': room_name, 'service': 'iMessage', 'handle_ids': members})
+    for chat_id, conversation in enumerate(conversations, start=1):
+        conversation['chat_id'] = chat_id
+    return handles, conversations
+
+
+def generate_chat_db(path, num_messages=100000, num_contacts=40, num_groups=8, years=8, attributed_body_fraction=0.15,
+                     media_fraction=0.03, seed=0):
+    """
+    Writes a synthetic chat.db to `path` (replacing any file there).
+
+    :param num_messages: total messages, spread over conversations with a long tail (a few very long threads)
+    :param num_contacts: 1:1 conversations; every third contact has a phone number handle, the rest email handles
+    :param num_groups: group chats, each with 2 to 6 of the contacts
+    :param years: length of the history, which ends in November 2023
+    :param attributed_body_fraction: share of messages with no `text`, only an attributedBody archive
+    :param media_fraction: share of messages that are attachments
+    :return: dictionary with 'path', 'messages', 'conversations', 'attachments' and 'seconds'
+    """
+
+    started_at = time.time()
+    rng = random.Random(seed)
+    handles, conversations = build_conversations(rng, num_contacts, num_groups)
+    # Zipf-like weights, shuffled so the busiest threads are a mix of 1:1 and group chats
+    weights = [1 / (rank + 1) for rank in range(len(conversations))]
+    rng.shuffle(weights)
+    end_time = 1700000000 + rng.randrange(86400)
+    start_time = end_time - years * 365 * 86400
+    timestamps = sorted(rng.uniform(start_time, end_time) for _ in range(num_messages))
+
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute('pragma journal_mode = off')
+        conn.execute('pragma synchronous = off')
+        conn.executescript(SYNTHETIC_SCHEMA)
+        conn.executemany('insert into handle values (?, ?, ?)', handles)
+        conn.executemany('insert into chat values (?, ?, ?, ?, ?, ?)', [
+            (conversation['chat_id'], f"{conversation['service']};{'+' if conversation['room_name'] else '-'};{conversation['identifier']}",
+             conversation['room_name'], conversation['identifier'], conversation['service'], None)
+            for conversation in conversations
+        ])
+        conn.executemany('insert into chat_handle_join values (?, ?)', [
+            (conversation['chat_id'], handle_id) for conversation in conversations for handle_id in conversation['handle_ids']
+        ])
+
+        messages = []
+        chat_joins = []
+        attachments = []
+        attachment_joins = []
+        conversation_choices = rng.choices(conversations, weights=weights, k=num_messages)
+        for rowid, (conversation, timestamp) in enumerate(zip(conversation_choices, timestamps), start=1):
+            is_from_me = rng.random() < 0.45
+            handle_id = conversation['handle_ids'][0] if conversation['room_name'] is None else (
+                0 if is_from_me else rng.choice(conversation['handle_ids'])
+            )
+            text = random_text(rng)
+            body = None
+            roll = rng.random()
+            if roll < media_fraction:
+                text = OBJECT_REPLACEMENT_CHAR
+                mime_type, name_format = rng.choice(MEDIA_TYPES)
+                transfer_name = name_format.format(rowid)
+                attachment_id = len(attachments) + 1
+                attachments.append((
+                    attachment_id, f'at_{seed}_{attachment_id}', f'~/Library/Messages/Attachments/{rowid % 256:02x}/{transfer_name}',
+                    mime_type, transfer_name, rng.randrange(20000, 8000000), int((timestamp - APPLE_EPOCH) * 1e9),
+                ))
+                attachment_joins.append((rowid, attachment_id))
+            elif roll < media_fraction + attributed_body_fraction:
+                body = attributed_body(text[:100].rstrip())
+                text = None
+            messages.append((
+                rowid, f'synthetic-{seed}-{rowid}', text, body, handle_id, int(is_from_me), MY_ACCOUNT,
+                int((timestamp - APPLE_EPOCH) * 1e9), conversation['service'], conversation['room_name'],
+            ))
+            chat_joins.append((conversation['chat_id'], rowid, messages[-1][7]))
+            if len(messages) == INSERT_BATCH_SIZE:
+                conn.executemany('insert into message values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', messages)
+                conn.executemany('insert into chat_message_join values (?, ?, ?)', chat_joins)
+                messages = []
+                chat_joins = []
+        conn.executemany('insert into message values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', messages)
+        conn.executemany('insert into chat_message_join values (?, ?, ?)', chat_joins)
+        conn.executemany('insert into attachment values (?, ?, ?, ?, ?, ?, ?)', attachments)
+        conn.executemany('insert into message_attachment_join values (?, ?)', attachment_joins)
+        conn.commit()
+    finally:
+        conn.close()
+    return {
+        'path': path,
+        'messages': num_messages,
+        'conversations': len(conversations),
+        'attachments': len(attachments),
+        'seconds': round(time.time() - started_at, 3),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate a synthetic Messages database for load tests and benchmarks.')
+    parser.add_argument('path', help='database file to write')
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--contacts', type=int, default=40)
+    parser.add_argument('--groups', type=int, default=8)
+    parser.add_argument('--years', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    result = generate_chat_db(
+        args.path, num_messages=args.messages, num_contacts=args.contacts, num_groups=args.groups, years=args.years, seed=args.seed
+    )
+    print(
+        f"Wrote {result['messages']} messages in {result['conversations']} conversations "
+        f"({result['attachments']} attachments) to {result['path']} in {result['seconds']}s"
+    )
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
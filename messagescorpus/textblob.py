@@ -0,0 +1,227 @@
+import bisect
+import collections
+import json
+import mmap
+import os
+import re
+from array import array
+
+from .multisearch import fold_case
+from .regex_guard import check_regex_safety
+
+
+"""
+An on-disk, memory-mapped representation of the corpus text for searching without per-message Python objects.
+
+All message text is stored as one UTF-8 file, with messages separated by newlines, next to a case-folded twin of it.
+Each has an array of int64 byte offsets (one per message, plus the end), and a small JSON file lists the threads and
+their message ranges. Searches run bytes.find / bytes.rfind (or a compiled bytes regex) over the mapped buffer a thread
+at a time and map hits back to message positions with bisect, so no per-message copies are made per query.
+
+Regexes are compiled as bytes patterns with re.MULTILINE, so ^ and $ match at message boundaries (and at newlines
+within messages), and \\w, \\b and case-insensitivity only know about ASCII.
+"""
+
+TEXT_FILE = 'text.bin'
+FOLDED_FILE = 'folded.bin'
+OFFSETS_FILE = 'offsets.bin'
+FOLDED_OFFSETS_FILE = 'folded_offsets.bin'
+THREADS_FILE = 'threads.json'
+MESSAGE_SEPARATOR = b'\n'
+
+
+def _write_file(path, write):
+    """Writes a file through a temporary name, so readers never see it half written."""
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'wb') as f:
+        write(f)
+    os.replace(temp_path, path)
+
+
+def build_text_blob(message_obj, blob_dir):
+    """
+    Writes the text blob for a thread-keyed message dictionary to `blob_dir`, replacing any blob already there.
+
+    :param message_obj: dictionary of name:list of messages, as returned by message_dict_from_sqlite
+    """
+
+    os.makedirs(blob_dir, exist_ok=True)
+    offsets = array('q', [0])
+    folded_offsets = array('q', [0])
+    threads = []
+    with open(os.path.join(blob_dir, TEXT_FILE + '.tmp'), 'wb') as text_file, \
+            open(os.path.join(blob_dir, FOLDED_FILE + '.tmp'), 'wb') as folded_file:
+        for name, message_list in message_obj.items():
+            threads.append([name, len(offsets) - 1, len(message_list)])
+            for message in message_list:
+                text = message['message'].encode('utf-8') + MESSAGE_SEPARATOR
+                folded = fold_case(message['message']).encode('utf-8') + MESSAGE_SEPARATOR
+                text_file.write(text)
+                folded_file.write(folded)
+                offsets.append(offsets[-1] + len(text))
+                folded_offsets.append(folded_offsets[-1] + len(folded))
+    os.replace(os.path.join(blob_dir, TEXT_FILE + '.tmp'), os.path.join(blob_dir, TEXT_FILE))
+    os.replace(os.path.join(blob_dir, FOLDED_FILE + '.tmp'), os.path.join(blob_dir, FOLDED_FILE))
+    _write_file(os.path.join(blob_dir, OFFSETS_FILE), offsets.tofile)
+    _write_file(os.path.join(blob_dir, FOLDED_OFFSETS_FILE), folded_offsets.tofile)
+    # Written last; the sizes let open_text_blob notice a blob that's halfway through being rewritten
+    threads_info = {'threads': threads, 'text_size': offsets[-1], 'folded_size': folded_offsets[-1]}
+    _write_file(os.path.join(blob_dir, THREADS_FILE), lambda f: f.write(json.dumps(threads_info).encode('utf-8')))
+
+
+def _map_file(path):
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''  # Empty files can't be mapped
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def open_text_blob(blob_dir):
+    """
+    Maps a blob written by build_text_blob.
+
+    :return: dictionary with 'text' and 'folded' (buffers), 'offsets' and 'folded_offsets' (int64 memoryviews),
+        'threads' (list of [name, first message position, message count]) and 'thread_positions' ({name: index into threads})
+    :raises ValueError: if the files don't belong together (e.g. the blob is being rebuilt)
+    """
+
+    with open(os.path.join(blob_dir, THREADS_FILE), 'rb') as f:
+        threads_info = json.load(f)
+    text = _map_file(os.path.join(blob_dir, TEXT_FILE))
+    folded = _map_file(os.path.join(blob_dir, FOLDED_FILE))
+    offsets = memoryview(_map_file(os.path.join(blob_dir, OFFSETS_FILE))).cast('q')
+    folded_offsets = memoryview(_map_file(os.path.join(blob_dir, FOLDED_OFFSETS_FILE))).cast('q')
+    if len(text) != threads_info['text_size'] or len(folded) != threads_info['folded_size'] or len(offsets) != len(folded_offsets):
+        raise ValueError(f'The text blob in {blob_dir} is incomplete or out of date; rebuild it')
+    threads = threads_info['threads']
+    return {
+        'text': text,
+        'folded': folded,
+        'offsets': offsets,
+        'folded_offsets': folded_offsets,
+        'threads': threads,
+        'thread_positions': {name: idx for idx, (name, _, _) in enumerate(threads)},
+    }
+
+
+def message_text(blob, position):
+    """The text of the message at `position` (over the whole blob), decoded from the mapped file."""
+    offsets = blob['offsets']
+    return blob['text'][offsets[position]:offsets[position + 1] - len(MESSAGE_SEPARATOR)].decode('utf-8')
+
+
+def _char_offset(buffer, start, end):
+    return len(buffer[start:end].decode('utf-8', errors='replace'))
+
+
+def _find_literal(buffer, offsets, needle, first, last, most_recent, limit):
+    """
+    Positions in [first, last) of messages containing `needle`, with each message's first byte offset of it,
+    newest first if `most_recent`. Hits that run across a message separator are ignored.
+    """
+
+    hits = []
+    start, end = offsets[first], offsets[last]
+    while len(hits) < limit:
+        found = buffer.rfind(needle, start, end) if most_recent else buffer.find(needle, start, end)
+        if found == -1:
+            break
+        position = bisect.bisect_right(offsets, found, first, last) - 1
+        message_start, message_end = offsets[position], offsets[position + 1] - len(MESSAGE_SEPARATOR)
+        if most_recent:
+            found = buffer.find(needle, message_start, message_end)
+            end = message_start
+        else:
+            start = offsets[position + 1]
+        if found != -1 and found + len(needle) <= message_end:
+            hits.append((position, found))
+    return hits
+
+
+def _find_regex(buffer, offsets, pattern, first, last, most_recent, limit, regex_group):
+    """Like _find_literal for a compiled bytes pattern; returns (position, byte span) with the span of `regex_group`."""
+    group = [regex_group] if regex_group else []
+    hits = collections.deque(maxlen=limit if most_recent else None)
+    start, end = offsets[first], offsets[last]
+    while start < end:
+        match = pattern.search(buffer, start, end)
+        if match is None:
+            break
+        position = bisect.bisect_right(offsets, match.start(), first, last) - 1
+        message_start, message_end = offsets[position], offsets[position + 1] - len(MESSAGE_SEPARATOR)
+        if match.end() > message_end:
+            # Ran into the next message; search this message on its own
+            match = pattern.search(buffer, message_start, message_end)
+        if match is not None:
+            hits.append((position, match.span(*group)))
+            if not most_recent and len(hits) == limit:
+                break
+        start = offsets[position + 1]
+    return list(reversed(hits)) if most_recent else list(hits)
+
+
+def search_text_blob(blob, query, ignore_case=True, regex=False, regex_group=None, max_results=20, most_recent=True, names=None, message_obj=None):
+    """
+    Searches the blob for a substring or (bytes) regex, thread by thread in the order they were written.
+    Matches use the same (ordered index, character span) form as corpus.search_matches.
+
+    :param names: optional list of thread names to search (all threads by default)
+    :param message_obj: optional thread-keyed message dictionary the blob was built from, used to fill in 'ordered_lists'
+    :return: dictionary with keys 'matches', 'num_matches', 'timed_out' and, if message_obj is given, 'ordered_lists'
+    :raises re.error / UnsafeRegexError: for invalid or exponential regexes
+    """
+
+    if regex:
+        flags = re.MULTILINE | (re.IGNORECASE if ignore_case else 0)
+        check_regex_safety(query, flags)
+        pattern = re.compile(query.encode('utf-8'), flags)
+        buffer, offsets = blob['text'], blob['offsets']
+    elif ignore_case:
+        needle = fold_case(query).encode('utf-8')
+        buffer, offsets = blob['folded'], blob['folded_offsets']
+    else:
+        needle = query.encode('utf-8')
+        buffer, offsets = blob['text'], blob['offsets']
+
+    if names is None:
+        threads = blob['threads']
+    else:
+        threads = [blob['threads'][blob['thread_positions'][name]] for name in names if name in blob['thread_positions']]
+
+    num_matches = 0
+    matches = {}
+    for name, first, count in threads:
+        if not count:
+            continue
+        limit = max_results - num_matches
+        if regex:
+            hits = _find_regex(buffer, offsets, pattern, first, first + count, most_recent, limit, regex_group)
+        else:
+            hits = [
+                (position, (found, found + len(needle)))
+                for position, found in _find_literal(buffer, offsets, needle, first, first + count, most_recent, limit)
+            ]
+        if not hits:
+            continue
+        matches[name] = []
+        for position, (byte_start, byte_end) in hits:
+            message_start = offsets[position]
+            char_start = _char_offset(buffer, message_start, byte_start)
+            char_end = char_start + (len(query) if not regex else _char_offset(buffer, byte_start, byte_end))
+            ordered_idx = first + count - 1 - position if most_recent else position - first
+            matches[name].append((ordered_idx, (char_start, char_end)))
+        num_matches += len(hits)
+        if num_matches == max_results:
+            break
+
+    results = {
+        'matches': matches,
+        'num_matches': num_matches,
+        'timed_out': False,
+    }
+    if message_obj is not None:
+        results['ordered_lists'] = {
+            name: list(reversed(message_obj[name])) if most_recent else message_obj[name]
+            for name in matches
+        }
+    return results
@@ -0,0 +1,65 @@
+import json
+import os
+import sys
+import tempfile
+
+import pytest
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Everything derived from the databases goes to a throwaway directory. Set before messagescorpus is imported, since cache
+# locations are read once at import
+os.environ['MESSAGESCORPUS_CACHE_DIR'] = tempfile.mkdtemp(prefix='messagescorpus-tests-')
+os.environ.pop('MESSAGESCORPUS_SHARED_CACHE', None)
+os.environ.pop('MESSAGESCORPUS_SNAPSHOT', None)
+sys.path[:0] = [REPO_DIR, os.path.join(REPO_DIR, 'webapp')]
+
+from messagescorpus import corpus, shared_utils  # noqa: E402
+from messagescorpus.synthetic_db import generate_chat_db  # noqa: E402
+
+
+"""
+Shared fixtures: a small synthetic chat.db (see messagescorpus.synthetic_db) that every loader reads by default, and a
+name_groups.json of our own, so no test depends on the databases or name groups of the machine it runs on.
+"""
+
+TEST_NAME_GROUPS = {'Alex': ['alex@example.com']}
+
+
+@pytest.fixture(scope='session')
+def test_dir(tmp_path_factory):
+    return tmp_path_factory.mktemp('messagescorpus')
+
+
+@pytest.fixture(scope='session')
+def chat_db(test_dir):
+    """Path of a synthetic chat.db with 3000 messages over 15 conversations, 3 of them group chats."""
+    return generate_chat_db(str(test_dir / 'chat.db'), num_messages=3000, num_contacts=12, num_groups=3, years=2, seed=1)['path']
+
+
+@pytest.fixture(scope='session', autouse=True)
+def test_environment(test_dir, chat_db):
+    name_groups_path = test_dir / 'name_groups.json'
+    name_groups_path.write_text(json.dumps(TEST_NAME_GROUPS))
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(shared_utils, 'NAME_GROUPS_PATH', str(name_groups_path))
+        monkeypatch.setattr(corpus, 'NAME_GROUPS_PATH', str(name_groups_path))
+        monkeypatch.setenv(corpus.MESSAGE_DB_PATHS_ENV_VAR, chat_db)
+        yield
+
+
+@pytest.fixture(scope='session')
+def corpus_data(chat_db):
+    """load_all_threads of the synthetic database, phone-number threads included."""
+    return corpus.load_all_threads(include_phone_numbers=True, db_paths=[chat_db])
+
+
+@pytest.fixture
+def make_messages():
+    """Builds a message list from (sender, timestamp, text) tuples."""
+    def make(rows):
+        return [
+            {'sender': sender, 'timestamp': timestamp, 'message': text, 'guid': f'test-{idx}'}
+            for idx, (sender, timestamp, text) in enumerate(rows)
+        ]
+    return make
@@ -0,0 +1,77 @@
+import shutil
+import sqlite3
+
+from messagescorpus.corpus import (
+    load_all_threads, merge_sqlite_outputs, message_data_version, messages_from_sqlite, thread_summaries_from_sqlite
+)
+
+
+def row(rowid, guid, raw_date):
+    return (rowid, 'thread', 0, 'sender', '', f'message {rowid}', 'iMessage', None, guid, raw_date)
+
+
+def test_merge_orders_by_date_and_drops_repeated_guids():
+    first = [row(1, 'a', 10), row(2, 'b', 20), row(3, None, 30)]
+    second = [row(7, 'a', 10), row(8, 'c', 15), row(9, None, 30), row(10, 'b', 40)]
+    merged = merge_sqlite_outputs([first, second])
+    assert [merged_row[0] for merged_row in merged] == [1, 8, 2, 3, 9]
+
+
+def test_overlapping_databases_are_deduplicated(chat_db, corpus_data, tmp_path):
+    copy_path = str(tmp_path / 'archive.db')
+    shutil.copy(chat_db, copy_path)
+    with sqlite3.connect(copy_path) as conn:
+        # The archive has one message the original doesn't
+        conn.execute(
+            "insert into message (rowid, guid, text, handle_id, is_from_me, account, date, service, cache_roomnames) "
+            "select 100000, 'archive-only', 'from the archive', handle_id, 0, account, date + 1, service, cache_roomnames "
+            "from message where rowid = (select max(rowid) from message)"
+        )
+    merged = load_all_threads(include_phone_numbers=True, db_paths=[chat_db, copy_path])['messages']
+    assert set(merged) == set(corpus_data['messages'])
+    added = [
+        name for name, messages in merged.items()
+        if [message['guid'] for message in messages] != [message['guid'] for message in corpus_data['messages'][name]]
+    ]
+    assert len(added) == 1
+    assert merged[added[0]][-1]['message'] == 'from the archive'
+    assert len(merged[added[0]]) == len(corpus_data['messages'][added[0]]) + 1
+
+
+def test_every_message_has_the_same_keys(corpus_data):
+    assert {tuple(message) for messages in corpus_data['messages'].values() for message in messages} == {
+        ('sender', 'timestamp', 'message', 'guid')
+    }
+
+
+def test_threads_are_in_date_order_and_named_through_name_groups(corpus_data):
+    assert 'Alex' in corpus_data['names']
+    assert 'alex@example.com' not in corpus_data['names']
+    for messages in corpus_data['messages'].values():
+        timestamps = [message['timestamp'] for message in messages]
+        assert timestamps == sorted(timestamps)
+
+
+def test_single_thread_load_matches_full_load(corpus_data):
+    assert messages_from_sqlite(other_name_filter='Alex') == corpus_data['messages']['Alex']
+
+
+def test_summaries_agree_with_loaded_threads(chat_db, corpus_data):
+    summaries = thread_summaries_from_sqlite(include_phone_numbers=True, db_paths=[chat_db])
+    assert [summary['last_timestamp'] for summary in summaries] == sorted((s['last_timestamp'] for s in summaries), reverse=True)
+    assert {summary['name'] for summary in summaries} == set(corpus_data['names'])
+    for summary in summaries:
+        messages = corpus_data['messages'][summary['name']]
+        assert summary['message_count'] == len(messages)
+        assert summary['first_timestamp'] == messages[0]['timestamp']
+        assert summary['last_timestamp'] == messages[-1]['timestamp']
+
+
+def test_data_version_follows_the_database(chat_db, tmp_path):
+    copy_path = str(tmp_path / 'chat.db')
+    shutil.copy(chat_db, copy_path)
+    version = message_data_version([copy_path])
+    assert message_data_version([copy_path]) == version
+    with sqlite3.connect(copy_path) as conn:
+        conn.execute("update message set text = 'edited' where rowid = 1")
+    assert message_data_version([copy_path]) != version
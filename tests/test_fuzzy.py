@@ -0,0 +1,57 @@
+import pytest
+
+from messagescorpus.fuzzy import build_deletion_index, default_max_distance, edit_distance, fuzzy_search, fuzzy_variants
+
+
+@pytest.mark.parametrize('a, b, distance', [
+    ('pizza', 'pizza', 0),
+    ('pizza', 'piza', 1),
+    ('pizza', 'pizzas', 1),
+    ('pizza', 'pazza', 1),
+    ('pizza', 'pzziza', 2),
+    ('recieve', 'receive', 1),  # an adjacent transposition is one edit
+    ('', 'abc', 3),
+])
+def test_edit_distance(a, b, distance):
+    assert edit_distance(a, b, 3) == distance
+    assert edit_distance(b, a, 3) == distance
+
+
+def test_edit_distance_stops_past_the_limit():
+    assert edit_distance('restaurant', 'rest', 2) == 3
+    assert edit_distance('kitten', 'sitting', 1) == 2
+
+
+def test_default_max_distance():
+    assert [default_max_distance(word) for word in ('ok', 'pizza', 'tomorrow')] == [0, 1, 2]
+
+
+def test_variants_come_from_the_deletion_index():
+    vocabulary = ['tomorrow', 'tomorow', 'borrow', 'morrow', 'sorrow']
+    deletion_index = build_deletion_index(vocabulary, max_distance=2)
+    assert fuzzy_variants('tommorow', deletion_index, 2) == {'tomorrow', 'tomorow'}
+    assert fuzzy_variants('tommorow', deletion_index, 1) == {'tomorow'}
+
+
+def test_every_query_word_must_match(make_messages):
+    messages = make_messages([
+        ('Dan', '2021-01-01 10:00:00', 'Pizza tomorrow?'),
+        ('Amy', '2021-01-02 10:00:00', 'pizza tonight'),
+        ('Dan', '2021-01-03 10:00:00', 'tomorow works'),
+    ])
+    result = fuzzy_search(messages, 'piza tommorow', most_recent=False)
+    assert result['num_matches'] == 1
+    assert result['matches'][None] == [(0, (0, 5))]
+    assert result['variants'] == {'piza': ['pizza'], 'tommorow': ['tomorow', 'tomorrow']}
+
+
+def test_max_distance_is_checked(make_messages):
+    with pytest.raises(ValueError):
+        fuzzy_search(make_messages([('Dan', '2021-01-01 10:00:00', 'hi')]), 'hi', max_distance=3)
+
+
+def test_fuzzy_search_over_the_corpus(corpus_data):
+    exact = fuzzy_search(corpus_data['messages'], 'restaurant', max_distance=0, max_results=10 ** 6)
+    fuzzy = fuzzy_search(corpus_data['messages'], 'restaraunt', max_results=10 ** 6)
+    assert exact['num_matches'] > 0
+    assert fuzzy['num_matches'] == exact['num_matches']
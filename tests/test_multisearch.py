@@ -0,0 +1,38 @@
+from messagescorpus.multisearch import build_term_matcher, find_all, non_overlapping_spans, search_terms, split_terms
+
+
+def test_split_terms():
+    assert split_terms('danny, big d\n\nDanny ,danny') == ['danny', 'big d', 'Danny']
+
+
+def test_find_all_reports_overlapping_occurrences():
+    matcher = build_term_matcher(['new york', 'york', 'new', ''])
+    assert find_all(matcher, 'New York, new yorker') == [
+        (2, (0, 3)), (0, (0, 8)), (1, (4, 8)), (2, (10, 13)), (0, (10, 18)), (1, (14, 18)),
+    ]
+    assert find_all(matcher, 'nothing here') == []
+    assert find_all(build_term_matcher(['']), 'anything') == []
+
+
+def test_find_all_case_and_special_characters():
+    assert find_all(build_term_matcher(['a.b'], ignore_case=False), 'axb a.b A.B') == [(0, (4, 7))]
+    # 'İ' lowercases to two characters, so it's left as it is and offsets still line up
+    assert find_all(build_term_matcher(['İstanbul']), 'İSTANBUL or istanbul') == [(0, (0, 8))]
+
+
+def test_non_overlapping_spans_prefer_leftmost_longest():
+    matcher = build_term_matcher(['new york', 'york', 'new'])
+    assert non_overlapping_spans(find_all(matcher, 'new york, york')) == [(0, 8), (10, 14)]
+
+
+def test_search_terms_counts_each_term(make_messages):
+    messages = make_messages([
+        ('Dan', '2021-01-01 10:00:00', 'pizza or beer'),
+        ('Amy', '2021-01-02 10:00:00', 'coffee'),
+        ('Dan', '2021-01-03 10:00:00', 'Beer beer'),
+    ])
+    result = search_terms(messages, 'beer, pizza, tea')
+    assert result['num_matches'] == 2
+    assert result['matches'][None] == [(0, (0, 4)), (2, (0, 5))]
+    assert result['term_counts'] == {'beer': 2, 'pizza': 1, 'tea': 0}
+    assert search_terms(messages, ['tea']) is None
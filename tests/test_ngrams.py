@@ -0,0 +1,96 @@
+import json
+import os
+import shutil
+import sqlite3
+from collections import Counter
+
+import pytest
+
+from messagescorpus import corpus, shared_utils
+from messagescorpus.corpus import MEDIA_PLACEHOLDER
+from messagescorpus.indexes import tokenize
+from messagescorpus.ngrams import count_ngrams, ingest_new_messages, ngram_trend, top_ngrams
+
+
+@pytest.fixture
+def db_copy(chat_db, tmp_path):
+    path = str(tmp_path / 'chat.db')
+    shutil.copy(chat_db, path)
+    return path
+
+
+@pytest.fixture
+def store_path(tmp_path):
+    return str(tmp_path / 'ngrams.sqlite')
+
+
+def expected_counts(messages, n=1, sender=None):
+    counts = Counter()
+    for message in messages:
+        if message['message'] in ('', MEDIA_PLACEHOLDER) or (sender is not None and message['sender'] != sender):
+            continue
+        counts.update({ngram: count for ngram, count in count_ngrams(tokenize(message['message']), max_n=n).items()
+                       if ngram.count(' ') == n - 1})
+    return dict(counts)
+
+
+def add_message(db_path, text):
+    with sqlite3.connect(db_path) as conn:
+        conn.execute(
+            "insert into message (guid, text, handle_id, is_from_me, account, date, service, cache_roomnames) "
+            "select 'added-' || (max(rowid) + 1), ?, handle_id, 1, account, date + 1, service, cache_roomnames "
+            "from message where rowid = (select max(rowid) from message where cache_roomnames is null)",
+            (text,),
+        )
+
+
+def test_count_ngrams():
+    assert count_ngrams(['see', 'you', 'soon'], max_n=2) == Counter({'see': 1, 'you': 1, 'soon': 1, 'see you': 1, 'you soon': 1})
+
+
+def test_counts_match_the_loaded_threads(db_copy, store_path, corpus_data):
+    result = ingest_new_messages(store_path, db_paths=[db_copy])
+    assert result['messages'] > 0 and not result['rebuilt']
+    for n in (1, 2):
+        assert dict(top_ngrams(store_path, n=n, k=10 ** 6, thread='Alex', db_paths=[db_copy])) == expected_counts(
+            corpus_data['messages']['Alex'], n=n
+        )
+    assert dict(top_ngrams(store_path, k=10 ** 6, thread='Alex', sender='Alex', db_paths=[db_copy])) == expected_counts(
+        corpus_data['messages']['Alex'], sender='Alex'
+    )
+
+
+def test_ingest_only_reads_new_messages(db_copy, store_path):
+    ingest_new_messages(store_path, db_paths=[db_copy])
+    assert ingest_new_messages(store_path, db_paths=[db_copy])['messages'] == 0
+    # The same database under another path isn't read again
+    relative_path = os.path.relpath(db_copy)
+    assert ingest_new_messages(store_path, db_paths=[relative_path])['messages'] == 0
+
+    add_message(db_copy, 'zebra crossing')
+    assert ingest_new_messages(store_path, db_paths=[db_copy])['messages'] == 1
+    assert top_ngrams(store_path, n=2, k=1, sender=shared_utils.MY_DISPLAY_NAME, period='2023-11', min_length=len('zebra crossing'),
+                      db_paths=[db_copy]) == [('zebra crossing', 1)]
+    assert sum(count for _, count in ngram_trend(store_path, 'zebra', db_paths=[db_copy])) == 1
+
+
+def test_overlapping_databases_are_counted_once(db_copy, store_path, tmp_path):
+    archive_path = str(tmp_path / 'archive.db')
+    shutil.copy(db_copy, archive_path)
+    first = ingest_new_messages(store_path, db_paths=[db_copy])
+    assert ingest_new_messages(store_path, db_paths=[db_copy, archive_path])['messages'] == 0
+    assert first['messages'] > 0
+
+
+def test_changed_name_groups_rebuild_the_counts(db_copy, store_path, tmp_path, monkeypatch):
+    ingest_new_messages(store_path, db_paths=[db_copy])
+    assert top_ngrams(store_path, thread='Alex', db_paths=[db_copy])
+
+    name_groups_path = tmp_path / 'name_groups.json'
+    name_groups_path.write_text(json.dumps({'Alexandra': ['alex@example.com']}))
+    monkeypatch.setattr(shared_utils, 'NAME_GROUPS_PATH', str(name_groups_path))
+    monkeypatch.setattr(corpus, 'NAME_GROUPS_PATH', str(name_groups_path))
+    result = ingest_new_messages(store_path, db_paths=[db_copy])
+    assert result['rebuilt'] and result['messages'] > 0
+    assert top_ngrams(store_path, thread='Alex', db_paths=[db_copy]) == []
+    assert top_ngrams(store_path, thread='Alexandra', sender='Alexandra', db_paths=[db_copy])
@@ -0,0 +1,81 @@
+import pytest
+
+from messagescorpus.query_language import is_structured_query, normalize_date, parse_query, structured_search
+
+
+def test_parse_query_splits_filters_from_text():
+    plan = parse_query('from:Dan in:"Family Group" after:2021 before:2022-3 "see  you" soon')
+    assert plan == {
+        'threads': ['Family Group'],
+        'senders': ['Dan'],
+        'after': '2021',
+        'before': '2022-03',
+        'text': 'see  you soon',
+    }
+
+
+def test_parse_query_keeps_unknown_operators_as_text():
+    assert parse_query('http://example.com FROM:me')['text'] == 'http://example.com'
+    assert parse_query('http://example.com FROM:me')['senders'] == ['me']
+
+
+@pytest.mark.parametrize('value, expected', [('2021', '2021'), ('2021-3', '2021-03'), ('2021/03/07', '2021-03-07')])
+def test_normalize_date(value, expected):
+    assert normalize_date(value) == expected
+
+
+def test_bad_date_raises_value_error():
+    with pytest.raises(ValueError):
+        parse_query('after:last-week dinner')
+
+
+def test_is_structured_query():
+    assert is_structured_query('from:me dinner')
+    assert is_structured_query('dinner in:Family')
+    assert not is_structured_query('dinner at 8:30')
+    assert not is_structured_query('in: the morning')
+
+
+@pytest.fixture
+def threads(make_messages):
+    return {
+        'Family Group': make_messages([
+            ('Dan', '2020-12-31 23:00:00', 'dinner tonight?'),
+            ('Fred', '2021-01-02 18:00:00', 'Dinner at 8'),
+            ('Dan', '2021-06-01 12:00:00', 'lunch instead'),
+            ('Dan', '2022-01-01 09:00:00', 'dinner again'),
+        ]),
+        'Amy': make_messages([
+            ('Amy', '2021-02-01 10:00:00', 'dinner?'),
+        ]),
+    }
+
+
+def test_filters_narrow_the_search(threads):
+    result = structured_search(threads, 'from:Dan in:"family group" after:2021 dinner', most_recent=False)
+    assert result['num_matches'] == 1
+    assert result['matches']['Family Group'] == [(3, (0, 6))]
+
+
+def test_filter_only_queries_match_with_empty_spans(threads):
+    result = structured_search(threads, 'from:me before:2021-06', most_recent=False)
+    assert result['matches'] == {'Family Group': [(1, (0, 0))], 'Amy': []}
+
+
+def test_several_in_filters_search_each_thread(threads):
+    result = structured_search(threads, 'in:Amy in:"Family Group" dinner')
+    assert result['num_matches'] == 4
+
+
+def test_in_filter_on_a_message_list_needs_its_thread_name(threads):
+    messages = threads['Amy']
+    assert structured_search(messages, 'in:amy dinner', thread_name='Amy')['num_matches'] == 1
+    assert structured_search(messages, 'in:"Family Group" dinner', thread_name='Amy') is None
+    with pytest.raises(ValueError):
+        structured_search(messages, 'in:Amy dinner')
+
+
+def test_aliases_resolve_through_name_groups(threads):
+    name_groups = {'Dan': {'danny', '+15551230001'}}
+    result = structured_search(threads, 'from:danny lunch', name_groups=name_groups)
+    assert result['num_matches'] == 1
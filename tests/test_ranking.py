@@ -0,0 +1,55 @@
+import math
+
+from messagescorpus.indexes import build_inverted_index
+from messagescorpus.ranking import BM25_B, BM25_K1, bm25_scores, ranked_search
+
+
+def test_bm25_scores_match_the_formula(make_messages):
+    messages = make_messages([
+        ('Dan', '2021-01-01 10:00:00', 'pizza pizza tonight'),
+        ('Amy', '2021-01-02 10:00:00', 'pizza'),
+        ('Dan', '2021-01-03 10:00:00', 'tonight is fine'),
+    ])
+    scores = bm25_scores({None: build_inverted_index(messages)}, ['pizza'])
+    assert set(scores) == {(None, 0), (None, 1)}
+    avg_length = 7 / 3
+    idf = math.log(1 + (3 - 2 + 0.5) / (2 + 0.5))
+
+    def expected(term_frequency, length):
+        return idf * term_frequency * (BM25_K1 + 1) / (term_frequency + BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length))
+
+    assert math.isclose(scores[(None, 0)], expected(2, 3))
+    assert math.isclose(scores[(None, 1)], expected(1, 1))
+
+
+def test_rare_terms_outrank_common_ones(make_messages):
+    messages = make_messages([('Dan', f'2021-01-{day:02d} 10:00:00', 'ok see you') for day in range(1, 21)] + [
+        ('Amy', '2021-02-01 10:00:00', 'ok the playoffs'),
+    ])
+    result = ranked_search(messages, 'ok playoffs', max_results=3, most_recent=False)
+    assert result['matches'][None][0] == (20, (0, 2))
+    assert result['scores'][None] == sorted(result['scores'][None], reverse=True)
+
+
+def test_windows_report_the_best_message(make_messages):
+    messages = make_messages([
+        ('Dan', '2021-01-01 10:00:00', 'where'),
+        ('Amy', '2021-01-01 10:01:00', 'beach beach'),
+        ('Dan', '2021-01-01 10:02:00', 'unrelated'),
+        ('Amy', '2021-01-01 10:03:00', 'nothing'),
+    ])
+    result = ranked_search(messages, 'beach', window=2, most_recent=False)
+    assert result['num_matches'] == 1
+    assert result['matches'][None] == [(1, (0, 5))]
+
+
+def test_statistics_span_every_thread(corpus_data):
+    threads = dict(list(corpus_data['messages'].items())[:4])
+    indexes = {}
+    result = ranked_search(threads, 'playoffs world', max_results=10, indexes=indexes)
+    assert result['num_matches'] == 10
+    assert set(indexes) == set(threads)
+    all_scores = sorted((score for scores in result['scores'].values() for score in scores), reverse=True)
+    # The same search with cached indexes gives the same ranking
+    assert ranked_search(threads, 'playoffs world', max_results=10, indexes=indexes)['scores'] == result['scores']
+    assert len(all_scores) == 10
@@ -0,0 +1,45 @@
+import re
+
+import pytest
+
+from messagescorpus.regex_guard import UnsafeRegexError, check_regex_safety, guarded_regex_search
+
+
+@pytest.mark.parametrize('pattern', [r'(a+)+$', r'(\w*)*x', r'(ab|ab)*c', r'((a|b)+)*'])
+def test_rejects_backtracking_shapes(pattern):
+    with pytest.raises(UnsafeRegexError):
+        check_regex_safety(pattern)
+
+
+@pytest.mark.parametrize('pattern', [r'dinner', r'\d{3}-\d{4}', r'(ab)+c', r'(foo|bar)*', r'a+b+'])
+def test_accepts_ordinary_patterns(pattern):
+    check_regex_safety(pattern)
+
+
+def test_invalid_pattern_raises_re_error():
+    with pytest.raises(re.error):
+        check_regex_safety('(unclosed')
+
+
+def test_search_matches_in_order():
+    texts = ['Dinner at 8', 'no match', 'lunch then dinner']
+    result = guarded_regex_search(texts, r'din+er', texts_key=('test', len(texts)))
+    assert not result['timed_out']
+    assert result['matches'] == [(0, (0, 6)), (2, (11, 17))]
+    # Same key: the worker reuses the texts it already has
+    assert guarded_regex_search(texts, 'lunch', texts_key=('test', len(texts)))['matches'] == [(2, (0, 5))]
+
+
+def test_search_respects_case_group_and_limit():
+    texts = ['Call 555-1234', 'call 555-9876', 'call 555-0000']
+    result = guarded_regex_search(texts, r'call (\d+)', ignore_case=False, regex_group=1, max_results=1)
+    assert result['matches'] == [(1, (5, 8))]
+
+
+def test_slow_search_times_out():
+    # Passes the static check (the parser factors the branches into a(?:|a)), but backtracks exponentially without a "c"
+    result = guarded_regex_search(['a' * 40], r'(a|aa)*c', timeout=0.5)
+    assert result['timed_out']
+    assert result['elapsed_seconds'] < 5
+    # The next search gets a fresh worker
+    assert guarded_regex_search(['abc'], 'b')['matches'] == [(0, (1, 2))]
@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+from messagescorpus.corpus import message_names_from_sqlite, thread_summaries_from_sqlite
+from messagescorpus.shared_cache import (
+    KEEP_VERSIONS, attach_shared_cache, current_stamp, detach_shared_cache, publish_shared_cache, read_current_version, read_names,
+    read_thread, read_thread_summaries
+)
+
+
+@pytest.fixture
+def cache_dir(tmp_path):
+    return str(tmp_path / 'shared')
+
+
+def test_attach_builds_the_first_version(cache_dir, corpus_data):
+    assert current_stamp(cache_dir) is None
+    shared_cache = attach_shared_cache(cache_dir)
+    try:
+        assert shared_cache['version'] == 1
+        names = read_names(shared_cache)
+        assert names == message_names_from_sqlite()
+        for name in names:
+            assert read_thread(shared_cache, name) == corpus_data['messages'][name]
+        with pytest.raises(IndexError):
+            read_thread(shared_cache, 'Nobody')
+    finally:
+        detach_shared_cache(shared_cache)
+
+
+def test_summaries_match_sqlite(cache_dir):
+    shared_cache = attach_shared_cache(cache_dir)
+    try:
+        assert read_thread_summaries(shared_cache) == thread_summaries_from_sqlite()
+    finally:
+        detach_shared_cache(shared_cache)
+
+
+def test_new_versions_replace_old_ones(cache_dir):
+    shared_cache = attach_shared_cache(cache_dir)
+    first_stamp = current_stamp(cache_dir)
+    try:
+        for _ in range(KEEP_VERSIONS + 1):
+            info = publish_shared_cache(cache_dir)
+        assert info == read_current_version(cache_dir)
+        assert info['version'] == KEEP_VERSIONS + 2
+        assert current_stamp(cache_dir) != first_stamp
+        assert publish_shared_cache(cache_dir, if_missing=True) == info
+        # Old versions are pruned, but a worker attached to one keeps reading it until it reattaches
+        corpus_files = sorted(file_name for file_name in os.listdir(cache_dir) if file_name.startswith('corpus-'))
+        assert corpus_files == [f'corpus-{version}.sqlite' for version in range(info['version'] - KEEP_VERSIONS + 1, info['version'] + 1)]
+        assert read_thread(shared_cache, 'Alex')
+    finally:
+        detach_shared_cache(shared_cache)
+    shared_cache = attach_shared_cache(cache_dir)
+    try:
+        assert shared_cache['version'] == info['version']
+    finally:
+        detach_shared_cache(shared_cache)
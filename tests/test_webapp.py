@@ -0,0 +1,161 @@
+import shutil
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+import pytest
+
+import app as webapp
+from messagescorpus import corpus
+
+
+def reset_caches():
+    with webapp.THREAD_CACHE_LOCK:
+        for cache in (webapp.MESSAGE_CACHE, webapp.THREAD_METADATA_CACHE, webapp.THREAD_INDEX_CACHE, webapp.THREAD_DATA_VERSIONS,
+                      webapp.THREAD_SOURCE_VERSIONS):
+            cache.clear()
+    with webapp.SEARCH_RESULT_CACHE_LOCK:
+        webapp.SEARCH_RESULT_CACHE.clear()
+    webapp.MESSAGE_NAMES_CACHE = None
+    webapp.NAME_GROUPS_CACHE = None
+    webapp.THREAD_SUMMARIES_CACHE = None
+
+
+@pytest.fixture
+def db_copy(chat_db, tmp_path, monkeypatch):
+    path = str(tmp_path / 'chat.db')
+    shutil.copy(chat_db, path)
+    monkeypatch.setenv(corpus.MESSAGE_DB_PATHS_ENV_VAR, path)
+    return path
+
+
+@pytest.fixture
+def client(db_copy, monkeypatch):
+    monkeypatch.setattr(webapp, 'WARMUP_STATE', dict(webapp.WARMUP_STATE, status='idle', error=None))
+    reset_caches()
+    yield webapp.app.test_client()
+    reset_caches()
+
+
+def wait_for_warmup(client):
+    for _ in range(200):
+        status = client.get('/warmup').get_json()
+        if status['status'] != 'running':
+            return status
+        time.sleep(0.05)
+    raise AssertionError('warm-up did not finish')
+
+
+def test_unchanged_pages_revalidate_without_loading(client):
+    response = client.get('/?name=Alex')
+    assert response.status_code == 200
+    etag, weak = response.get_etag()
+    assert weak and 'Alex' in webapp.MESSAGE_CACHE
+    assert client.get('/?name=Alex', headers={'If-None-Match': f'W/"{etag}"'}).status_code == 304
+
+    # Another worker (or this one after eviction) answers from the data version alone
+    reset_caches()
+    response = client.get('/?name=Alex', headers={'If-None-Match': f'W/"{etag}"'})
+    assert response.status_code == 304
+    assert 'Alex' not in webapp.MESSAGE_CACHE
+    assert client.get('/?name=Alex&thread_limit=5', headers={'If-None-Match': f'W/"{etag}"'}).status_code == 200
+
+
+def test_etag_follows_the_data(client, db_copy):
+    etag = client.get('/?name=Alex').get_etag()[0]
+    with sqlite3.connect(db_copy) as conn:
+        conn.execute("update message set text = 'edited' where rowid = 1")
+    # The cached thread (and so the page) is unchanged until it's reloaded
+    assert client.get('/?name=Alex').get_etag()[0] == etag
+    reset_caches()
+    assert client.get('/?name=Alex').get_etag()[0] != etag
+
+
+def test_no_etag_while_warming_up(client):
+    etag = client.get('/?name=Alex').get_etag()[0]
+    webapp.WARMUP_STATE['status'] = 'running'
+    response = client.get('/?name=Alex', headers={'If-None-Match': f'W/"{etag}"'})
+    assert response.status_code == 200
+    assert response.get_etag() == (None, None)
+    assert response.headers['Cache-Control'] == 'no-store'
+
+
+def test_warmup_and_snapshot_refresh_need_post(client, corpus_data):
+    status = client.get('/warmup?start=1').get_json()
+    assert status['status'] == 'idle' and not status['started']
+    assert client.post('/warmup').get_json()['started']
+    status = wait_for_warmup(client)
+    assert status['status'] == 'done'
+    assert set(webapp.MESSAGE_CACHE) == set(corpus_data['messages'])
+    assert client.get('/snapshot').status_code == 200
+    assert client.post('/snapshot').status_code == 200
+
+
+def test_concurrent_requests_load_a_thread_once(client, monkeypatch):
+    loads = Counter()
+    load_thread_messages = webapp.load_thread_messages
+
+    def slow_load(name):
+        loads[name] += 1
+        time.sleep(0.1)
+        return load_thread_messages(name)
+
+    monkeypatch.setattr(webapp, 'load_thread_messages', slow_load)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(webapp.get_cached_messages('Alex'))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert loads == {'Alex': 1}
+    assert len({(id(messages), data_version) for messages, data_version, _ in results}) == 1
+    assert sorted(was_cached for _, _, was_cached in results) == [False] + [True] * 7
+    assert not webapp.THREAD_LOAD_LOCKS
+
+
+def test_eviction_keeps_per_thread_caches_together(client, corpus_data, monkeypatch):
+    monkeypatch.setattr(webapp, 'MAX_CACHED_THREADS', 2)
+    names = corpus_data['names'][:5]
+    errors = []
+
+    def browse(name):
+        try:
+            messages, data_version, _ = webapp.get_cached_messages(name)
+            webapp.get_cached_thread_index(name, messages, data_version)
+            assert messages == corpus_data['messages'][name]
+        except Exception as exc:
+            errors.append(exc)
+
+    threads = [threading.Thread(target=browse, args=(names[idx % len(names)],)) for idx in range(40)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    assert len(webapp.MESSAGE_CACHE) <= 2
+    assert set(webapp.THREAD_METADATA_CACHE) == set(webapp.THREAD_DATA_VERSIONS) == set(webapp.THREAD_SOURCE_VERSIONS) == set(
+        webapp.MESSAGE_CACHE
+    )
+    assert set(webapp.THREAD_INDEX_CACHE) <= set(webapp.MESSAGE_CACHE)
+
+
+def test_shared_cache_mode(client, corpus_data, tmp_path, monkeypatch):
+    monkeypatch.setattr(webapp, 'SHARED_CACHE_MODE', True)
+    monkeypatch.setattr(webapp, 'SHARED_CACHE_DIR', str(tmp_path / 'shared'))
+    monkeypatch.setattr(webapp, 'SHARED_CACHE', None)
+    response = client.get('/?name=Alex')
+    assert response.status_code == 200
+    assert webapp.MESSAGE_CACHE['Alex'] == corpus_data['messages']['Alex']
+    first_version = webapp.SHARED_CACHE['version']
+    etag = response.get_etag()[0]
+
+    # A refresh rebuilds the shared cache in the background, and every worker moves to the new version
+    response = client.get('/?name=Alex&refresh_cache=1')
+    assert response.status_code == 200
+    assert wait_for_warmup(client)['status'] == 'done'
+    client.get('/conversations')
+    assert webapp.SHARED_CACHE['version'] == first_version + 1
+    assert 'Alex' not in webapp.MESSAGE_CACHE
+    assert client.get('/?name=Alex', headers={'If-None-Match': f'W/"{etag}"'}).status_code == 200
+    webapp.detach_shared_cache(webapp.SHARED_CACHE)
@@ -1,16 +1,97 @@
+import gzip
+import hashlib
+import itertools
+import json
+import os
 import re
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlencode
 
-from flask import Flask, render_template, request
+from flask import Flask, jsonify, render_template, request, url_for
 
-from messagescorpus.corpus import message_names_from_sqlite, messages_from_sqlite, search_corpus
+try:
+    import brotli
+except ImportError:  # Optional; responses are gzipped without it
+    brotli = None
+
+from messagescorpus.attachments import clear_attachment_cache, format_size, get_attachments
+from messagescorpus.corpus import (
+    MEDIA_PLACEHOLDER, load_all_threads, message_data_version, message_names_from_sqlite, messages_from_sqlite, refresh_db_snapshots,
+    search_matches, thread_metadata, thread_summaries_from_sqlite
+)
+from messagescorpus.indexes import build_thread_index, centered_window, position_for_date
+from messagescorpus.memory_profile import deep_sizeof, profile_message_dict
+from messagescorpus.multisearch import non_overlapping_spans, search_terms
+from messagescorpus.fuzzy import fuzzy_search
+from messagescorpus.ranking import ranked_search
+from messagescorpus.query_language import is_structured_query, normalize_date, parse_query, resolve_name, structured_search
+from messagescorpus.regex_guard import DEFAULT_REGEX_TIMEOUT_SECONDS
+from messagescorpus.shared_cache import (
+    SHARED_CACHE_DIR, attach_shared_cache, current_stamp, detach_shared_cache, publish_shared_cache, read_names, read_thread,
+    read_thread_summaries
+)
+from messagescorpus.shared_utils import get_name_groups
+from messagescorpus.snapshot import snapshot_status
 
 
 app = Flask(__name__)
+# Static URLs carry a hash of the file's contents (see static_url), so browsers can keep them for a year
+app.config["SEND_FILE_MAX_AGE_DEFAULT"] = 365 * 24 * 60 * 60
 MESSAGE_CACHE = {}
 MESSAGE_NAMES_CACHE = None
+NAME_GROUPS_CACHE = None
+THREAD_METADATA_CACHE = {}
+# Bumped whenever a thread's cached messages are replaced, so results computed from older data are never reused
+THREAD_DATA_VERSIONS = {}
+DATA_VERSION_COUNTER = itertools.count(1)
+# Versions of the data each cached thread was loaded from (see current_data_version). Unlike the counters above they're
+# the same in every worker, so page ETags built from them can be revalidated by any worker
+THREAD_SOURCE_VERSIONS = {}
+# LRU of search matches (indices and spans only) keyed by thread, query, flags and data version
+SEARCH_RESULT_CACHE = OrderedDict()
+SEARCH_RESULT_CACHE_SIZE = 256
+SEARCH_RESULT_CACHE_LOCK = threading.Lock()
+# Sidebar summaries as (etag, JSON body), computed by one aggregate query and dropped whenever the data is reloaded
+THREAD_SUMMARIES_CACHE = None
+SUMMARY_PREVIEW_LENGTH = 80
+# Per-thread lookup structures for structured queries, as (data_version, index)
+THREAD_INDEX_CACHE = {}
+# Guards MESSAGE_CACHE and everything else kept per thread, which request threads read and write concurrently. Loads run
+# outside it, one at a time per thread (THREAD_LOAD_LOCKS), so concurrent requests for a thread wait for the same load
+THREAD_CACHE_LOCK = threading.Lock()
+THREAD_LOAD_LOCKS = {}
+WARMUP_STATE = {
+    "status": "idle",
+    "rows_processed": 0,
+    "total_rows": 0,
+    "started_at": None,
+    "finished_at": None,
+    "error": None,
+}
+WARMUP_LOCK = threading.Lock()
 DEFAULT_THREAD_MESSAGE_LIMIT = 20
 THREAD_MESSAGE_LIMIT_INCREMENT = 10
 SEARCH_CONTEXT_INCREMENT = 5
+# User-typed regexes run in a worker process with this time budget, so a pathological pattern can't stall the server
+REGEX_TIMEOUT_SECONDS = DEFAULT_REGEX_TIMEOUT_SECONDS
+# With MESSAGESCORPUS_SHARED_CACHE=1 (for running several worker processes), threads are read from the on-disk cache shared
+# by all workers (see messagescorpus.shared_cache) instead of from chat.db, and each worker only keeps the most recently
+# used threads in memory
+SHARED_CACHE_MODE = os.environ.get("MESSAGESCORPUS_SHARED_CACHE") == "1"
+SHARED_CACHE = None
+SHARED_CACHE_LOCK = threading.Lock()
+MAX_CACHED_THREADS = int(os.environ.get("MESSAGESCORPUS_MAX_CACHED_THREADS", "32" if SHARED_CACHE_MODE else "0")) or None
+# Debug routes (/debug/memory) expose process internals and are slow, so they're only served in debug mode or with
+# MESSAGESCORPUS_DEBUG_ROUTES=1 (see register_debug_routes)
+DEBUG_ROUTES = os.environ.get("MESSAGESCORPUS_DEBUG_ROUTES") == "1"
+STATIC_VERSIONS = {}
+# HTML and JSON responses at least this large are compressed (brotli if installed and accepted, otherwise gzip)
+COMPRESSIBLE_MIMETYPES = ("text/html", "application/json")
+COMPRESSION_MIN_BYTES = 1024
+GZIP_COMPRESS_LEVEL = 6
+BROTLI_QUALITY = 5
 
 
 def parse_int_arg(name, default, minimum=None):
@@ -19,7 +100,7 @@ def parse_int_arg(name, default, minimum=None):
         parsed = int(value) if value != "" else default
     except ValueError:
         return default
-    if minimum is not None:
+    if minimum is not None and parsed is not None:
         return max(minimum, parsed)
     return parsed
 
@@ -30,89 +111,554 @@ def parse_checkbox_arg(name, default=False):
     return request.args.get(name) == "on"
 
 
+def _current_shared_cache():
+    """get_shared_cache without taking SHARED_CACHE_LOCK; call with it held."""
+    global SHARED_CACHE, MESSAGE_NAMES_CACHE, NAME_GROUPS_CACHE, THREAD_SUMMARIES_CACHE
+    stamp = current_stamp(SHARED_CACHE_DIR)
+    if SHARED_CACHE is None or stamp is None or stamp != SHARED_CACHE["stamp"]:
+        attached = attach_shared_cache(SHARED_CACHE_DIR)
+        if SHARED_CACHE is None or attached["version"] != SHARED_CACHE["version"]:
+            if SHARED_CACHE is not None:
+                detach_shared_cache(SHARED_CACHE)
+            with THREAD_CACHE_LOCK:
+                MESSAGE_CACHE.clear()
+                THREAD_METADATA_CACHE.clear()
+                THREAD_INDEX_CACHE.clear()
+                THREAD_DATA_VERSIONS.clear()
+                THREAD_SOURCE_VERSIONS.clear()
+            MESSAGE_NAMES_CACHE = None
+            NAME_GROUPS_CACHE = None
+            THREAD_SUMMARIES_CACHE = None
+            SHARED_CACHE = attached
+        else:
+            detach_shared_cache(attached)
+            SHARED_CACHE["stamp"] = attached["stamp"]
+    return SHARED_CACHE
+
+
+def get_shared_cache():
+    """
+    The shared cache version this worker reads from, reattaching if a newer one has been published since the last call
+    (one stat of the version stamp) and dropping the threads, names and summaries cached from the old version.
+    Only for its info: reading from the returned version can race with another request detaching it, so reads go
+    through read_shared_cache.
+    """
+
+    with SHARED_CACHE_LOCK:
+        return _current_shared_cache()
+
+
+def read_shared_cache(reader, *args):
+    """
+    Calls reader(shared_cache, *args) (e.g. shared_cache.read_thread) on the current version, returning its result and
+    the version's data version (see current_data_version). The version is looked up and read under SHARED_CACHE_LOCK, so
+    no other request can detach and close it in between; reads of one version take turns with its connection anyway.
+    """
+
+    with SHARED_CACHE_LOCK:
+        shared_cache = _current_shared_cache()
+        return reader(shared_cache, *args), shared_cache_data_version(shared_cache)
+
+
+def shared_cache_data_version(shared_cache):
+    return f"shared-{shared_cache['info']['version']}-{shared_cache['info']['built_at']}"
+
+
+@app.before_request
+def check_shared_cache_version():
+    if SHARED_CACHE_MODE:
+        get_shared_cache()
+
+
+def current_data_version():
+    """
+    Version of the data that threads and names loaded now would come from: the published shared cache version, or the
+    state of the message databases and name groups (see message_data_version). It's the same in every worker.
+    """
+
+    if SHARED_CACHE_MODE:
+        return shared_cache_data_version(get_shared_cache())
+    return message_data_version()
+
+
+def load_thread_messages(name):
+    """A thread's messages and the version of the data they were read from (see current_data_version)."""
+    if SHARED_CACHE_MODE:
+        return read_shared_cache(read_thread, name)
+    source_version = current_data_version()
+    return messages_from_sqlite(other_name_filter=name), source_version
+
+
+def store_cached_messages(name, messages, source_version):
+    """Caches a thread's messages, returning their new data version."""
+    metadata = thread_metadata(messages)
+    with THREAD_CACHE_LOCK:
+        data_version = next(DATA_VERSION_COUNTER)
+        MESSAGE_CACHE.pop(name, None)
+        MESSAGE_CACHE[name] = messages
+        THREAD_METADATA_CACHE[name] = metadata
+        THREAD_DATA_VERSIONS[name] = data_version
+        THREAD_SOURCE_VERSIONS[name] = source_version
+        if MAX_CACHED_THREADS is not None:
+            # MESSAGE_CACHE is kept in least recently used order (see get_cached_messages). Everything else held per thread
+            # goes with it; search results keyed by the old data version age out of their own LRU. Requests still using an
+            # evicted thread keep their own reference to its messages and data version
+            while len(MESSAGE_CACHE) > MAX_CACHED_THREADS:
+                evicted_name = next(iter(MESSAGE_CACHE))
+                MESSAGE_CACHE.pop(evicted_name)
+                THREAD_METADATA_CACHE.pop(evicted_name, None)
+                THREAD_INDEX_CACHE.pop(evicted_name, None)
+                THREAD_DATA_VERSIONS.pop(evicted_name, None)
+                THREAD_SOURCE_VERSIONS.pop(evicted_name, None)
+    return data_version
+
+
+def _cached_thread(name):
+    """(messages, data_version) if the thread is cached (marking it most recently used), else None. Call with THREAD_CACHE_LOCK held."""
+    if name not in MESSAGE_CACHE:
+        return None
+    if MAX_CACHED_THREADS is not None:
+        MESSAGE_CACHE[name] = MESSAGE_CACHE.pop(name)
+    return MESSAGE_CACHE[name], THREAD_DATA_VERSIONS[name]
+
+
 def get_cached_messages(name):
-    was_cached = name in MESSAGE_CACHE
-    if not was_cached:
-        MESSAGE_CACHE[name] = messages_from_sqlite(other_name_filter=name)
-    return MESSAGE_CACHE[name], was_cached
+    """
+    Returns (messages, data_version, was_cached) for a thread, loading it if it isn't cached. Concurrent requests for a
+    thread that isn't cached wait for a single load of it.
+    """
+
+    with THREAD_CACHE_LOCK:
+        cached = _cached_thread(name)
+        if cached is not None:
+            return (*cached, True)
+        load_lock = THREAD_LOAD_LOCKS.setdefault(name, threading.Lock())
+    try:
+        with load_lock:
+            with THREAD_CACHE_LOCK:
+                cached = _cached_thread(name)
+            if cached is not None:
+                # Loaded by the request this one waited for
+                return (*cached, True)
+            messages, source_version = load_thread_messages(name)
+            return messages, store_cached_messages(name, messages, source_version), False
+    finally:
+        with THREAD_CACHE_LOCK:
+            if THREAD_LOAD_LOCKS.get(name) is load_lock and not load_lock.locked():
+                del THREAD_LOAD_LOCKS[name]
 
 
 def refresh_cached_messages(name):
-    MESSAGE_CACHE.pop(name, None)
-    MESSAGE_CACHE[name] = messages_from_sqlite(other_name_filter=name)
-    return MESSAGE_CACHE[name]
+    """
+    Reloads a thread from SQLite, returning (messages, data_version), or None in shared cache mode: there a new version of
+    the whole shared cache is built by a background warm-up, which this and every other worker switch to once it's
+    published.
+    """
 
+    clear_attachment_cache()
+    if SHARED_CACHE_MODE:
+        start_background_warmup(refresh_snapshots=True)
+        return None
+    refresh_db_snapshots()
+    messages, source_version = load_thread_messages(name)
+    return messages, store_cached_messages(name, messages, source_version)
 
-def get_cached_message_names():
+
+def get_cached_name_groups():
+    global NAME_GROUPS_CACHE
+    if NAME_GROUPS_CACHE is None:
+        NAME_GROUPS_CACHE = get_name_groups()
+    return NAME_GROUPS_CACHE
+
+
+def get_cached_thread_index(name, messages, data_version):
+    with THREAD_CACHE_LOCK:
+        cached = THREAD_INDEX_CACHE.get(name)
+    if cached is not None and cached[0] == data_version:
+        return cached[1]
+    thread_index = build_thread_index(messages)
+    with THREAD_CACHE_LOCK:
+        # Only kept while these messages are the cached ones, so an evicted or replaced thread's index isn't put back
+        if THREAD_DATA_VERSIONS.get(name) == data_version:
+            THREAD_INDEX_CACHE[name] = (data_version, thread_index)
+    return thread_index
+
+
+def run_thread_search(name, messages, data_version, query, ignore_case, regex, regex_group, max_results, most_recent, multi_term, rank, fuzzy):
+    """
+    Runs one search over a thread's messages and returns what the page needs to render it: match indices and spans,
+    the match count, whether a guarded regex search timed out, and any extra spans to highlight per match.
+    """
+
+    highlight_spans = {}
+    if rank and not regex and not multi_term:
+        search_results = ranked_search(
+            messages,
+            query,
+            max_results=max_results,
+            most_recent=most_recent,
+            indexes={None: get_cached_thread_index(name, messages, data_version)},
+        )
+        if search_results is not None:
+            for (message_idx, _), term_spans in zip(search_results["matches"][None], search_results["term_spans"][None]):
+                highlight_spans[message_idx] = [span for _, span in term_spans]
+    elif fuzzy and not regex and not multi_term:
+        search_results = fuzzy_search(
+            messages,
+            query,
+            max_results=max_results,
+            most_recent=most_recent,
+            indexes={None: get_cached_thread_index(name, messages, data_version)},
+        )
+        if search_results is not None:
+            for (message_idx, _), term_spans in zip(search_results["matches"][None], search_results["term_spans"][None]):
+                highlight_spans[message_idx] = [span for _, span in term_spans]
+    elif not regex and not multi_term and is_structured_query(query):
+        # The in: filter (if any) already chose this thread, so it matches this list
+        search_results = structured_search(
+            messages,
+            query,
+            ignore_case=ignore_case,
+            max_results=max_results,
+            most_recent=most_recent,
+            indexes={None: get_cached_thread_index(name, messages, data_version)},
+            name_groups=get_cached_name_groups(),
+            thread_name=name,
+        )
+    elif multi_term:
+        search_results = search_terms(messages, query, ignore_case=ignore_case, max_results=max_results, most_recent=most_recent)
+        if search_results is not None:
+            for (message_idx, _), term_spans in zip(search_results["matches"][None], search_results["term_spans"][None]):
+                highlight_spans[message_idx] = non_overlapping_spans(term_spans)
+    else:
+        search_results = search_matches(
+            messages,
+            query,
+            ignore_case=ignore_case,
+            regex=regex,
+            regex_group=regex_group,
+            max_results=max_results,
+            most_recent=most_recent,
+            regex_timeout=REGEX_TIMEOUT_SECONDS,
+        )
+    return {
+        "matches": [] if search_results is None else search_results["matches"][None],
+        "num_matches": 0 if search_results is None else search_results["num_matches"],
+        "timed_out": search_results is not None and search_results["timed_out"],
+        "highlight_spans": highlight_spans,
+    }
+
+
+def get_cached_search(name, messages, data_version, search_options):
+    """
+    Returns (search, was_cached) for a search within one thread (see run_thread_search), reusing earlier results for the
+    same thread data. Only match indices and spans are kept, so expanding context around a match never re-runs the search.
+    Regex searches that time out are not cached, so they can be retried.
+    """
+
+    cache_key = (name, data_version, tuple(sorted(search_options.items())))
+    with SEARCH_RESULT_CACHE_LOCK:
+        cached = SEARCH_RESULT_CACHE.get(cache_key)
+        if cached is not None:
+            SEARCH_RESULT_CACHE.move_to_end(cache_key)
+            return cached, True
+
+    search = run_thread_search(name, messages, data_version, **search_options)
+    if not search["timed_out"]:
+        with SEARCH_RESULT_CACHE_LOCK:
+            SEARCH_RESULT_CACHE[cache_key] = search
+            while len(SEARCH_RESULT_CACHE) > SEARCH_RESULT_CACHE_SIZE:
+                SEARCH_RESULT_CACHE.popitem(last=False)
+    return search, False
+
+
+def load_message_names():
     global MESSAGE_NAMES_CACHE
+    MESSAGE_NAMES_CACHE = read_shared_cache(read_names)[0] if SHARED_CACHE_MODE else message_names_from_sqlite()
+
+
+def get_cached_message_names():
     if MESSAGE_NAMES_CACHE is None:
-        MESSAGE_NAMES_CACHE = message_names_from_sqlite()
+        load_message_names()
     return MESSAGE_NAMES_CACHE
 
 
 def refresh_cached_message_names():
-    global MESSAGE_NAMES_CACHE
-    MESSAGE_NAMES_CACHE = message_names_from_sqlite()
+    global NAME_GROUPS_CACHE, THREAD_SUMMARIES_CACHE
+    load_message_names()
+    NAME_GROUPS_CACHE = None
+    THREAD_SUMMARIES_CACHE = None
     return MESSAGE_NAMES_CACHE
 
 
-def highlight_message(message, match_span):
-    start, end = match_span
-    return {
-        "before": message[:start],
-        "match": message[start:end],
-        "after": message[end:],
+def get_cached_thread_summaries():
+    """
+    Returns (etag, body) for the sidebar's conversation summaries, most recently active first.
+    The ETag is a hash of the body, so clients revalidating after a refresh that changed nothing still get a 304.
+    """
+
+    global THREAD_SUMMARIES_CACHE
+    if THREAD_SUMMARIES_CACHE is None:
+        conversations = []
+        summaries = read_shared_cache(read_thread_summaries)[0] if SHARED_CACHE_MODE else thread_summaries_from_sqlite()
+        for summary in summaries:
+            preview = summary["last_message"]
+            if len(preview) > SUMMARY_PREVIEW_LENGTH:
+                preview = preview[:SUMMARY_PREVIEW_LENGTH - 1] + "\u2026"
+            conversations.append({
+                "name": summary["name"],
+                "message_count": summary["message_count"],
+                "last_timestamp": summary["last_timestamp"],
+                "last_sender": summary["last_sender"],
+                "preview": preview,
+            })
+        body = json.dumps({"conversations": conversations}, separators=(",", ":"))
+        etag = hashlib.sha1(body.encode("utf-8")).hexdigest()
+        THREAD_SUMMARIES_CACHE = (etag, body)
+    return THREAD_SUMMARIES_CACHE
+
+
+def update_warmup_progress(rows_processed, total_rows):
+    WARMUP_STATE["rows_processed"] = rows_processed
+    WARMUP_STATE["total_rows"] = total_rows
+
+
+def warm_message_cache(refresh_snapshots=False):
+    """
+    Fills the thread, names and metadata caches for every conversation from a single database pass.
+
+    :param refresh_snapshots: re-copy the database snapshots first (see refresh_db_snapshots), so new messages are read
+    """
+
+    global MESSAGE_NAMES_CACHE, THREAD_SUMMARIES_CACHE
+    if not WARMUP_LOCK.acquire(blocking=False):
+        return False
+    try:
+        WARMUP_STATE.update(status="running", rows_processed=0, total_rows=0, started_at=time.time(), finished_at=None, error=None)
+        if refresh_snapshots:
+            refresh_db_snapshots()
+        if SHARED_CACHE_MODE:
+            # Publishes a new version for every worker rather than filling this worker's memory
+            publish_shared_cache(SHARED_CACHE_DIR, progress_callback=update_warmup_progress)
+            get_shared_cache()
+        else:
+            source_version = current_data_version()
+            corpus = load_all_threads(progress_callback=update_warmup_progress)
+            for name, messages in corpus["messages"].items():
+                store_cached_messages(name, messages, source_version)
+            MESSAGE_NAMES_CACHE = corpus["names"]
+            THREAD_SUMMARIES_CACHE = None
+        WARMUP_STATE.update(status="done", finished_at=time.time())
+    except Exception as exc:
+        WARMUP_STATE.update(status="error", finished_at=time.time(), error=str(exc))
+    finally:
+        WARMUP_LOCK.release()
+    return True
+
+
+def start_background_warmup(refresh_snapshots=False):
+    if WARMUP_STATE["status"] == "running":
+        return False
+    threading.Thread(
+        target=warm_message_cache, kwargs={"refresh_snapshots": refresh_snapshots}, name="message-cache-warmup", daemon=True
+    ).start()
+    return True
+
+
+def get_warmup_status():
+    status = dict(WARMUP_STATE)
+    if status["started_at"] is not None:
+        status["elapsed_seconds"] = round((status["finished_at"] or time.time()) - status["started_at"], 3)
+    status["cached_threads"] = len(MESSAGE_CACHE)
+    if SHARED_CACHE_MODE and SHARED_CACHE is not None:
+        # Every thread is in the shared cache; this worker only holds the recently used ones in memory
+        status["cached_threads"] = SHARED_CACHE["info"]["threads"]
+        status["shared_cache_version"] = SHARED_CACHE["version"]
+    return status
+
+
+@app.template_global()
+def static_url(filename):
+    """URL of a static file with a hash of its contents, so it can be cached for a year and still update when it changes."""
+    version = STATIC_VERSIONS.get(filename)
+    if version is None or app.debug:
+        with open(os.path.join(app.static_folder, filename), "rb") as f:
+            version = STATIC_VERSIONS[filename] = hashlib.sha1(f.read()).hexdigest()[:12]
+    return url_for("static", filename=filename, v=version)
+
+
+def build_page_etag(name):
+    """
+    ETag for a page of `name`: a hash of the request parameters, the thread (which an in: filter can pick), the version of
+    the data its messages come from and the warm-up status shown. It needs neither the thread's messages nor a search, so
+    unchanged pages are revalidated without either: a thread that isn't cached yet would be loaded from the current data
+    version. It's weak because pages with the same data can still differ in incidental text, such as whether the thread
+    was a cache hit. Pages shown while a warm-up is running get no ETag (see index).
+    """
+
+    with THREAD_CACHE_LOCK:
+        thread_version = THREAD_SOURCE_VERSIONS.get(name)
+    if thread_version is None:
+        thread_version = current_data_version()
+    # Just the parts of the warm-up status the page shows; the thread count is only shown once it's done
+    warmup_status = get_warmup_status()
+    warmup_key = (warmup_status["status"], warmup_status["error"], warmup_status["status"] == "done" and warmup_status["cached_threads"])
+    page_key = (name, thread_version, warmup_key, sorted(request.args.items(multi=True)))
+    return hashlib.sha1(repr(page_key).encode("utf-8")).hexdigest()
+
+
+def not_modified_page(page_etag):
+    response = app.response_class(status=304)
+    response.set_etag(page_etag, weak=True)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+def compress_body(data, encoding):
+    if encoding == "br":
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    # mtime=0 keeps the output the same for the same body
+    return gzip.compress(data, compresslevel=GZIP_COMPRESS_LEVEL, mtime=0)
+
+
+@app.after_request
+def compress_response(response):
+    """Compresses large HTML and JSON responses for clients that accept it."""
+    if (
+        response.status_code != 200
+        or response.direct_passthrough
+        or response.mimetype not in COMPRESSIBLE_MIMETYPES
+        or "Content-Encoding" in response.headers
+    ):
+        return response
+    response.vary.add("Accept-Encoding")
+    if brotli is not None and request.accept_encodings["br"]:
+        encoding = "br"
+    elif request.accept_encodings["gzip"]:
+        encoding = "gzip"
+    else:
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESSION_MIN_BYTES:
+        return response
+    response.set_data(compress_body(data, encoding))
+    response.headers["Content-Encoding"] = encoding
+    # A strong ETag names one exact byte sequence, which this encoding no longer is
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def build_search_url(form_data, **overrides):
+    """URL for the current search with some parameters changed, e.g. to expand the context around one match."""
+    params = {
+        "name": form_data["name"],
+        "search_form": "1",
+        "query": form_data["query"],
+        "thread_limit": form_data["thread_limit"],
+        "context": form_data["context"],
+        "max_results": form_data["max_results"],
+        "regex_group": form_data["regex_group"],
     }
+    for checkbox in ("ignore_case", "regex", "most_recent", "multi_term", "rank", "fuzzy"):
+        if form_data[checkbox]:
+            params[checkbox] = "on"
+    params.update(overrides)
+    return "/?" + urlencode(params)
+
 
+def highlight_message(message, match_spans):
+    """Splits a message into [{"text": ..., "is_match": ...}] parts around a list of non-overlapping (start, end) spans."""
+    parts = []
+    position = 0
+    for start, end in match_spans:
+        if start == end:
+            continue
+        if start > position:
+            parts.append({"text": message[position:start], "is_match": False})
+        parts.append({"text": message[start:end], "is_match": True})
+        position = end
+    if position < len(message):
+        parts.append({"text": message[position:], "is_match": False})
+    return parts
 
-def build_thread_rows(messages, limit=DEFAULT_THREAD_MESSAGE_LIMIT):
-    recent_messages = messages[-limit:]
+
+def build_thread_rows(messages, limit=DEFAULT_THREAD_MESSAGE_LIMIT, start=None, target_position=None):
+    """
+    Rows for browsing a thread: the most recent `limit` messages, or `limit` messages from position `start` on.
+    The row at `target_position` (e.g. the first message on a jumped-to date) is marked as a match.
+    """
+
+    if start is None:
+        start = max(len(messages) - limit, 0)
     return [
         {
             "timestamp": message["timestamp"],
             "sender": message["sender"],
-            "is_match": False,
+            "is_match": position == target_position,
             "message_parts": None,
             "message": message["message"],
+            "guid": message["guid"],
         }
-        for message in recent_messages
+        for position, message in enumerate(messages[start:start + limit], start=start)
     ]
 
 
-def build_result_blocks(search_results, context, most_recent, expanded_match_index=None, extra_before=0, extra_after=0):
-    if search_results is None:
-        return []
+def add_attachment_info(rows):
+    """
+    Adds each row's attachments (name, type and size), looking up all the media messages among `rows` with one
+    batched query, so attachment metadata only costs anything for the page being shown.
+    """
+
+    attachments = get_attachments(row["guid"] for row in rows if MEDIA_PLACEHOLDER in row["message"])
+    for row in rows:
+        row["attachments"] = [
+            dict(attachment, size_label=format_size(attachment["size"])) for attachment in attachments.get(row.get("guid"), [])
+        ]
+    return rows
 
-    df = search_results["dfs"][None]
-    matches = search_results["matches"][None]
-    total_rows = len(df)
-    if most_recent:
-        df = df.iloc[::-1]
+
+def build_result_blocks(messages, matches, context, most_recent, expanded_match_index=None, extra_before=0, extra_after=0, highlight_spans=None):
+    """
+    Builds the rows around each match by slicing the thread's message list, so the cost is proportional to the window shown.
+    With most_recent, match indices count back from the newest message (as returned by search_matches).
+    highlight_spans optionally maps a match index to all the spans to highlight in that message (default: just its match span).
+    """
+
+    highlight_spans = highlight_spans or {}
+    total_rows = len(messages)
+
+    def message_at(ordered_idx):
+        return messages[total_rows - 1 - ordered_idx] if most_recent else messages[ordered_idx]
 
     result_blocks = []
     for message_idx, match_span in matches:
         block_extra_before = extra_before if expanded_match_index == message_idx else 0
         block_extra_after = extra_after if expanded_match_index == message_idx else 0
         if most_recent:
+            # Indices count back from the most recent message, so "before" means a higher index
             start_idx = message_idx + context + block_extra_before
             end_idx = message_idx - context - block_extra_after
-            sub_df = df.loc[start_idx:end_idx, :]
+            row_indices = range(min(start_idx, total_rows - 1), max(end_idx, 0) - 1, -1)
             can_expand_before = start_idx < (total_rows - 1)
             can_expand_after = end_idx > 0
         else:
             start_idx = message_idx - (context + block_extra_before)
             end_idx = message_idx + (context + block_extra_after)
-            sub_df = df.loc[start_idx:end_idx, :]
+            row_indices = range(max(start_idx, 0), min(end_idx, total_rows - 1) + 1)
             can_expand_before = start_idx > 0
             can_expand_after = end_idx < (total_rows - 1)
         rows = []
-        for row_idx, row in sub_df.iterrows():
+        for row_idx in row_indices:
+            row = message_at(row_idx)
             rows.append({
                 "timestamp": row["timestamp"],
                 "sender": row["sender"],
                 "is_match": row_idx == message_idx,
-                "message_parts": highlight_message(row["message"], match_span) if row_idx == message_idx else None,
+                "message_parts": highlight_message(row["message"], highlight_spans.get(message_idx, [match_span])) if row_idx == message_idx else None,
                 "message": row["message"],
+                "guid": row["guid"],
             })
         result_blocks.append({
             "match_index": message_idx,
@@ -128,12 +674,13 @@ def build_result_blocks(search_results, context, most_recent, expanded_match_ind
 
 @app.route("/")
 def index():
-    suggested_names = get_cached_message_names()
     search_form_submitted = request.args.get("search_form") == "1"
     form_data = {
         "name": request.args.get("name", ""),
         "query": request.args.get("query", ""),
         "thread_limit": parse_int_arg("thread_limit", DEFAULT_THREAD_MESSAGE_LIMIT, minimum=1),
+        "thread_start": parse_int_arg("thread_start", None, minimum=0),
+        "jump_date": request.args.get("jump_date", ""),
         "expanded_match": request.args.get("expanded_match", ""),
         "extra_before": parse_int_arg("extra_before", 0, minimum=0),
         "extra_after": parse_int_arg("extra_after", 0, minimum=0),
@@ -143,6 +690,9 @@ def index():
         "ignore_case": parse_checkbox_arg("ignore_case", default=not search_form_submitted),
         "regex": parse_checkbox_arg("regex", default=False),
         "most_recent": parse_checkbox_arg("most_recent", default=not search_form_submitted),
+        "multi_term": parse_checkbox_arg("multi_term", default=False),
+        "rank": parse_checkbox_arg("rank", default=False),
+        "fuzzy": parse_checkbox_arg("fuzzy", default=False),
     }
     has_submission = bool(form_data["name"] or form_data["query"])
     refresh_requested = request.args.get("refresh_cache", "") == "1"
@@ -152,17 +702,48 @@ def index():
     result_blocks = []
     result_count = 0
     thread_rows = []
+    thread_start = 0
     total_thread_messages = 0
+    selected_thread_metadata = None
     selected_name = form_data["name"]
+    search_timed_out = False
 
-    if refresh_requested and selected_name:
+    if form_data["query"] and not form_data["regex"] and not form_data["multi_term"] and is_structured_query(form_data["query"]):
+        # An in: filter picks the conversation to search, so structured queries work from any page
         try:
-            messages = refresh_cached_messages(selected_name)
-            refresh_cached_message_names()
-            suggested_names = get_cached_message_names()
-            cache_status = "refreshed from SQLite"
-            info_message = f'Refreshed cache for "{selected_name}" ({len(messages)} messages loaded).'
-            thread_rows = build_thread_rows(messages)
+            plan = parse_query(form_data["query"])
+            if len(plan["threads"]) > 1:
+                error_message = "The web app searches one conversation at a time; use a single in: filter."
+            elif plan["threads"]:
+                with THREAD_CACHE_LOCK:
+                    cached_names = set(MESSAGE_CACHE)
+                candidate_names = set(get_cached_message_names()) | cached_names
+                thread_name = resolve_name(plan["threads"][0], candidate_names, name_groups=get_cached_name_groups())
+                if thread_name is None:
+                    error_message = f'No conversation found for "{plan["threads"][0]}".'
+                else:
+                    selected_name = form_data["name"] = thread_name
+        except ValueError as exc:
+            error_message = str(exc)
+
+    # Refreshes can change the data, and warm-up progress changes on every poll, so those pages are always rebuilt
+    cacheable = not refresh_requested and WARMUP_STATE["status"] != "running"
+    if cacheable:
+        page_etag = build_page_etag(selected_name)
+        if request.if_none_match.contains_weak(page_etag):
+            return not_modified_page(page_etag)
+
+    if refresh_requested and selected_name and not error_message:
+        try:
+            refreshed = refresh_cached_messages(selected_name)
+            if refreshed is None:
+                info_message = "Rebuilding the shared cache from SQLite in the background; new messages appear once it's done."
+            else:
+                messages, data_version = refreshed
+                refresh_cached_message_names()
+                cache_status = "refreshed from SQLite"
+                info_message = f'Refreshed cache for "{selected_name}" ({len(messages)} messages loaded).'
+                thread_rows = build_thread_rows(messages)
         except IndexError:
             error_message = f'No conversation found for "{selected_name}".'
         except ValueError as exc:
@@ -170,12 +751,15 @@ def index():
 
     if not error_message and selected_name:
         try:
-            if refresh_requested and cache_status == "refreshed from SQLite":
-                messages = MESSAGE_CACHE[selected_name]
-            else:
-                messages, was_cached = get_cached_messages(selected_name)
+            # A refreshed thread is used as loaded, since another request may already have evicted it
+            if cache_status != "refreshed from SQLite":
+                messages, data_version, was_cached = get_cached_messages(selected_name)
                 cache_status = "cache hit" if was_cached else "loaded from SQLite"
             total_thread_messages = len(messages)
+            with THREAD_CACHE_LOCK:
+                selected_thread_metadata = THREAD_METADATA_CACHE.get(selected_name)
+            if selected_thread_metadata is None:
+                selected_thread_metadata = thread_metadata(messages)
             if form_data["query"]:
                 regex_group = None
                 expanded_match_index = None
@@ -183,27 +767,51 @@ def index():
                     expanded_match_index = int(form_data["expanded_match"])
                 if form_data["regex_group"] != "":
                     regex_group = int(form_data["regex_group"])
-                search_results = search_corpus(
-                    messages,
-                    form_data["query"],
-                    ignore_case=form_data["ignore_case"],
-                    regex=form_data["regex"],
-                    regex_group=regex_group,
-                    context=form_data["context"],
-                    max_results=form_data["max_results"],
-                    most_recent=form_data["most_recent"],
-                )
+                search_options = {
+                    "query": form_data["query"],
+                    "ignore_case": form_data["ignore_case"],
+                    "regex": form_data["regex"],
+                    "regex_group": regex_group,
+                    "max_results": form_data["max_results"],
+                    "most_recent": form_data["most_recent"],
+                    "multi_term": form_data["multi_term"],
+                    "rank": form_data["rank"],
+                    "fuzzy": form_data["fuzzy"],
+                }
+                search, search_was_cached = get_cached_search(selected_name, messages, data_version, search_options)
+                result_count = search["num_matches"]
+                if search_was_cached:
+                    cache_status = f"{cache_status}, search results cached"
+                if search["timed_out"]:
+                    search_timed_out = True
+                    info_message = f"The search timed out after {REGEX_TIMEOUT_SECONDS:g} seconds; showing the matches found so far."
                 result_blocks = build_result_blocks(
-                    search_results,
+                    messages,
+                    search["matches"],
                     context=form_data["context"],
                     most_recent=form_data["most_recent"],
                     expanded_match_index=expanded_match_index,
                     extra_before=form_data["extra_before"],
                     extra_after=form_data["extra_after"],
+                    highlight_spans=search["highlight_spans"],
                 )
-                result_count = 0 if search_results is None else search_results["num_matches"]
+                add_attachment_info([row for block in result_blocks for row in block["rows"]])
             else:
-                thread_rows = build_thread_rows(messages, limit=form_data["thread_limit"])
+                thread_limit = form_data["thread_limit"]
+                thread_start = form_data["thread_start"]
+                target_position = None
+                if form_data["jump_date"]:
+                    thread_index = get_cached_thread_index(selected_name, messages, data_version)
+                    target_position = position_for_date(thread_index, normalize_date(form_data["jump_date"]))
+                    thread_start, _ = centered_window(len(messages), target_position, thread_limit)
+                    if target_position == len(messages):
+                        info_message = f"No messages on or after {form_data['jump_date']}; showing the most recent."
+                elif thread_start is None:
+                    thread_start = max(len(messages) - thread_limit, 0)
+                thread_start = min(thread_start, len(messages))
+                thread_rows = add_attachment_info(
+                    build_thread_rows(messages, limit=thread_limit, start=thread_start, target_position=target_position)
+                )
         except ValueError as exc:
             error_message = str(exc)
         except IndexError:
@@ -211,23 +819,144 @@ def index():
         except re.error as exc:
             error_message = f"Invalid regex: {exc}"
 
-    return render_template(
-        "index.html",
-        form_data=form_data,
-        has_submission=has_submission,
-        suggested_names=suggested_names,
-        result_blocks=result_blocks,
-        result_count=result_count,
-        thread_rows=thread_rows,
-        total_thread_messages=total_thread_messages,
-        thread_limit_increment=THREAD_MESSAGE_LIMIT_INCREMENT,
-        search_context_increment=SEARCH_CONTEXT_INCREMENT,
-        error_message=error_message,
-        info_message=info_message,
-        cache_status=cache_status,
-        selected_name=selected_name,
-    )
+    # Timed-out searches can change on the next request without any data version changing. The ETag is rebuilt because
+    # the thread may have just been loaded from a newer version than the one checked above
+    page_etag = build_page_etag(selected_name) if cacheable and not search_timed_out else None
+    if page_etag is not None and request.if_none_match.contains_weak(page_etag):
+        response = not_modified_page(page_etag)
+    else:
+        response = app.response_class(render_template(
+            "index.html",
+            warmup_status=get_warmup_status(),
+            thread_metadata=selected_thread_metadata,
+            form_data=form_data,
+            build_search_url=build_search_url,
+            has_submission=has_submission,
+            result_blocks=result_blocks,
+            result_count=result_count,
+            thread_rows=thread_rows,
+            thread_start=thread_start,
+            total_thread_messages=total_thread_messages,
+            thread_limit_increment=THREAD_MESSAGE_LIMIT_INCREMENT,
+            search_context_increment=SEARCH_CONTEXT_INCREMENT,
+            error_message=error_message,
+            info_message=info_message,
+            cache_status=cache_status,
+            selected_name=selected_name,
+        ), mimetype="text/html")
+    if page_etag is not None:
+        response.set_etag(page_etag, weak=True)
+        response.headers["Cache-Control"] = "no-cache"
+    elif WARMUP_STATE["status"] == "running":
+        response.headers["Cache-Control"] = "no-store"
+    if cache_status:
+        # For load tests and debugging (see load_test.py)
+        response.headers["X-Cache-Status"] = cache_status
+    return response
+
+
+@app.route("/conversations")
+def conversations():
+    """Conversation summaries for the sidebar, revalidated with an ETag so unchanged lists cost a 304."""
+    etag, body = get_cached_thread_summaries()
+    response = app.response_class(body, mimetype="application/json")
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
+
+
+@app.route("/thread_messages")
+def thread_messages():
+    """
+    One page of a thread as JSON, for paging backwards or forwards from a jumped-to window without reloading.
+    Pages end at `before` (older messages) or start at `after` (newer messages).
+    """
+
+    name = request.args.get("name", "")
+    limit = parse_int_arg("limit", THREAD_MESSAGE_LIMIT_INCREMENT, minimum=1)
+    try:
+        messages, _, _ = get_cached_messages(name)
+    except (IndexError, ValueError):
+        return jsonify({"error": f'No conversation found for "{name}".'}), 404
+    if "before" in request.args:
+        end = min(parse_int_arg("before", len(messages), minimum=0), len(messages))
+        start = max(end - limit, 0)
+    else:
+        start = min(parse_int_arg("after", 0, minimum=0), len(messages))
+        end = min(start + limit, len(messages))
+    rows = add_attachment_info([
+        {"timestamp": message["timestamp"], "sender": message["sender"], "message": message["message"], "guid": message["guid"]}
+        for message in messages[start:end]
+    ])
+    response = jsonify({
+        "rows": rows,
+        "start": start,
+        "end": end,
+        "total": len(messages),
+    })
+    response.add_etag()
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
+
+
+@app.route("/warmup", methods=["GET", "POST"])
+def warmup():
+    """Reports warm-up progress as JSON; POST to kick off a background warm-up."""
+    started = False
+    if request.method == "POST":
+        started = start_background_warmup()
+    status = get_warmup_status()
+    status["started"] = started
+    return jsonify(status)
+
+
+@app.route("/snapshot", methods=["GET", "POST"])
+def snapshot():
+    """Reports the age and refresh cost of chat.db snapshots as JSON; POST to re-copy them."""
+    if request.method == "POST":
+        refresh_db_snapshots()
+    return jsonify(snapshot_status())
+
+
+def debug_memory():
+    """
+    Reports how much memory the in-process caches hold, as JSON: the message cache by thread and by field (including
+    duplicate-string waste), and the search, index and summary caches. Walks every cached object, so it takes a moment.
+    """
+
+    with SEARCH_RESULT_CACHE_LOCK:
+        search_results = list(SEARCH_RESULT_CACHE.values())
+    with THREAD_CACHE_LOCK:
+        message_cache = dict(MESSAGE_CACHE)
+        thread_indexes = dict(THREAD_INDEX_CACHE)
+        thread_metadata_cache = dict(THREAD_METADATA_CACHE)
+    profile = profile_message_dict(message_cache, top_threads=parse_int_arg("top_threads", 20, minimum=1))
+    # Strings shared with the message cache (e.g. thread names) aren't counted again in the other caches
+    seen = set()
+    deep_sizeof(message_cache, seen)
+    profile["other_caches"] = {
+        "search_results": {"entries": len(search_results), "bytes": deep_sizeof(search_results, seen)},
+        "thread_indexes": {"entries": len(thread_indexes), "bytes": deep_sizeof(thread_indexes, seen)},
+        "thread_metadata": {"entries": len(thread_metadata_cache), "bytes": deep_sizeof(thread_metadata_cache, seen)},
+        "message_names": {"entries": len(MESSAGE_NAMES_CACHE or []), "bytes": deep_sizeof(MESSAGE_NAMES_CACHE, seen)},
+        "thread_summaries": {"entries": 1 if THREAD_SUMMARIES_CACHE else 0, "bytes": deep_sizeof(THREAD_SUMMARIES_CACHE, seen)},
+    }
+    return jsonify(profile)
+
+
+def register_debug_routes():
+    if "debug_memory" not in app.view_functions:
+        app.add_url_rule("/debug/memory", view_func=debug_memory)
+
+
+# app.debug is already set here under `flask --debug run` (FLASK_DEBUG); app.run(debug=True) below sets it later
+if DEBUG_ROUTES or app.debug:
+    register_debug_routes()
 
 
 if __name__ == "__main__":
+    # The debug reloader runs this module twice; only warm up in the process that actually serves requests
+    if os.environ.get("MESSAGESCORPUS_WARMUP") == "1" and os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_background_warmup()
+    register_debug_routes()
     app.run(debug=True)
@@ -0,0 +1,326 @@
+import argparse
+import json
+import math
+import os
+import random
+import re
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from urllib.parse import urlencode
+
+from messagescorpus.shared_utils import CORPUS_CACHE_DIR
+from messagescorpus.synthetic_db import generate_chat_db
+
+
+"""
+Load and concurrency test for the web app, against a synthetic chat.db (see messagescorpus.synthetic_db).
+
+Each of --sessions concurrent sessions replays its own seeded sequence of requests, chosen by --mix from:
+
+- browse: open a conversation (the most recent messages, a longer page or a jumped-to date), then page older messages
+  through /thread_messages and fetch the sidebar's /conversations list
+- search: a search in a conversation, with plain, structured, multi-term, ranked, fuzzy and regex queries mixed in
+- expand: load more context around one match of the session's last search
+- refresh: reload a conversation from SQLite
+
+Requests go through the Flask test client in this process (the default), or to a running server with --url. Results are
+latency percentiles (p50/p95/p99) per kind of request, throughput, errors (5xx responses and exceptions) and thread and
+search cache hit rates (from the X-Cache-Status header). With the same arguments, the database and every session's
+request sequence are the same, so runs are comparable; save one with --json and compare a later run to it with --compare.
+Run from the repo root with e.g.
+
+    PYTHONPATH=. python webapp/load_test.py --messages 200000 --sessions 16 --requests 100
+    PYTHONPATH=. python webapp/load_test.py --json before.json
+    PYTHONPATH=. python webapp/load_test.py --compare before.json
+
+With --url, start the server on the same database first, e.g.
+
+    MESSAGESCORPUS_DB_PATHS=cache/load_test/chat-100000-40-8-0.db PYTHONPATH=. python3 webapp/app.py
+"""
+
+DEFAULT_MIX = "browse=50,search=30,expand=15,refresh=5"
+LOAD_TEST_DB_DIR = os.path.join(CORPUS_CACHE_DIR, "load_test")
+# (weight, query, extra form fields); queries use words from synthetic_db.WORDS
+SEARCH_VARIANTS = (
+    (30, "dinner", {}),
+    (10, "pizza tonight", {}),
+    (10, "from:me coffee", {}),
+    (5, "after:2020 trip before:2022", {}),
+    (10, "beer,pizza,coffee", {"multi_term": "on"}),
+    (15, "game tonight", {"rank": "on"}),
+    (10, "resturant tomorow", {"fuzzy": "on"}),
+    (5, r"\b(lunch|dinner) (today|tomorrow)\b", {"regex": "on"}),
+    (5, "the", {}),
+)
+EXPANDABLE_MATCH_RE = re.compile(r"expanded_match=(\d+)")
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    return sorted_values[max(math.ceil(p / 100 * len(sorted_values)) - 1, 0)]
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(","):
+        action, _, weight = part.partition("=")
+        if action not in ("browse", "search", "expand", "refresh"):
+            raise ValueError(f'Unknown action "{action}" in --mix')
+        weights[action] = float(weight)
+    return weights
+
+
+def in_process_client():
+    """A request function for the app in this process; returns (status, headers, body)."""
+    from app import app
+
+    client = app.test_client()
+
+    def get(path, method="GET"):
+        response = client.open(path, method=method)
+        return response.status_code, response.headers, response.get_data(as_text=True)
+
+    return get
+
+
+def http_client(base_url, timeout):
+    def get(path, method="GET"):
+        # POSTs carry an empty body, which also makes urllib send a Content-Length
+        data = b"" if method == "POST" else None
+        try:
+            with urllib.request.urlopen(urllib.request.Request(base_url.rstrip("/") + path, data=data, method=method), timeout=timeout) as response:
+                return response.status, response.headers, response.read().decode("utf-8", errors="replace")
+        except urllib.error.HTTPError as exc:
+            return exc.code, exc.headers, exc.read().decode("utf-8", errors="replace")
+
+    return get
+
+
+def run_session(session_idx, get, names, args, weights, start_barrier):
+    """Runs one session's requests and returns a list of result dictionaries."""
+    rng = random.Random(args.seed * 1000003 + session_idx)
+    # Some conversations are much more popular than others, as in real use
+    name_weights = [1 / (rank + 1) for rank in range(len(names))]
+    actions = list(weights)
+    last_search = None
+    results = []
+
+    def request(action, path):
+        started_at = time.perf_counter()
+        try:
+            status, headers, body = get(path)
+            error = f"HTTP {status}" if status >= 500 else None
+        except Exception as exc:
+            status, headers, body, error = None, {}, "", f"{type(exc).__name__}: {exc}"
+        results.append({
+            "action": action,
+            "seconds": time.perf_counter() - started_at,
+            "status": status,
+            "error": error,
+            "cache_status": headers.get("X-Cache-Status"),
+        })
+        return body
+
+    start_barrier.wait()
+    for _ in range(args.requests):
+        action = rng.choices(actions, weights=[weights[action] for action in actions])[0]
+        name = rng.choices(names, weights=name_weights)[0]
+        if action == "expand" and last_search is None:
+            action = "search"
+        if action == "browse":
+            roll = rng.random()
+            params = {"name": name}
+            if roll < 0.15:
+                params["thread_limit"] = 100
+            elif roll < 0.3:
+                params["jump_date"] = f"{rng.randint(2016, 2023)}-{rng.randint(1, 12):02d}-01"
+            request("browse", "/?" + urlencode(params))
+            if rng.random() < 0.3:
+                request("browse_page", "/thread_messages?" + urlencode({"name": name, "before": rng.randint(0, 2000), "limit": 20}))
+            request("sidebar", "/conversations")
+        elif action == "search":
+            _, query, extra = rng.choices(SEARCH_VARIANTS, weights=[variant[0] for variant in SEARCH_VARIANTS])[0]
+            params = {"name": name, "search_form": "1", "query": query, "ignore_case": "on", "most_recent": "on", "context": 3, **extra}
+            body = request("search", "/?" + urlencode(params))
+            last_search = (params, EXPANDABLE_MATCH_RE.findall(body))
+        elif action == "expand":
+            params, match_indices = last_search
+            if match_indices:
+                params = dict(params, expanded_match=rng.choice(match_indices), extra_before=5, extra_after=5)
+            request("expand", "/?" + urlencode(params))
+        else:
+            request("refresh", "/?" + urlencode({"name": name, "refresh_cache": "1"}))
+        if args.think_time:
+            time.sleep(rng.expovariate(1 / args.think_time))
+    return results
+
+
+def summarize(results, wall_seconds):
+    by_action = {}
+    for result in results:
+        by_action.setdefault(result["action"], []).append(result)
+    by_action["all"] = results
+
+    summary = {"actions": {}, "throughput": len(results) / wall_seconds if wall_seconds else None, "wall_seconds": wall_seconds}
+    for action, action_results in by_action.items():
+        latencies = sorted(result["seconds"] * 1000 for result in action_results)
+        summary["actions"][action] = {
+            "requests": len(action_results),
+            "errors": sum(result["error"] is not None for result in action_results),
+            "mean_ms": sum(latencies) / len(latencies),
+            **{f"p{p}_ms": percentile(latencies, p) for p in PERCENTILES},
+        }
+
+    thread_hits = thread_lookups = search_hits = search_lookups = 0
+    for result in results:
+        cache_status = result["cache_status"] or ""
+        if cache_status.startswith("cache hit") or cache_status.startswith("loaded from SQLite"):
+            thread_lookups += 1
+            thread_hits += cache_status.startswith("cache hit")
+        if result["action"] in ("search", "expand") and cache_status and result["error"] is None:
+            search_lookups += 1
+            search_hits += "search results cached" in cache_status
+    summary["cache"] = {
+        "thread_hits": thread_hits,
+        "thread_lookups": thread_lookups,
+        "search_hits": search_hits,
+        "search_lookups": search_lookups,
+    }
+    errors = {}
+    for result in results:
+        if result["error"] is not None:
+            errors[result["error"]] = errors.get(result["error"], 0) + 1
+    summary["errors"] = errors
+    return summary
+
+
+def format_rate(hits, lookups):
+    return f"{100 * hits / lookups:.1f}% ({hits}/{lookups})" if lookups else "n/a"
+
+
+def print_summary(summary):
+    print(f"  {'request':<12} {'count':>7} {'errors':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'mean ms':>9}")
+    for action, stats in summary["actions"].items():
+        print(
+            f"  {action:<12} {stats['requests']:>7} {stats['errors']:>7} {stats['p50_ms']:>9.1f} {stats['p95_ms']:>9.1f} "
+            f"{stats['p99_ms']:>9.1f} {stats['mean_ms']:>9.1f}"
+        )
+    print(f"Throughput: {summary['throughput']:.1f} requests/s over {summary['wall_seconds']:.1f}s")
+    cache = summary["cache"]
+    print(f"Thread cache hit rate: {format_rate(cache['thread_hits'], cache['thread_lookups'])}")
+    print(f"Search cache hit rate: {format_rate(cache['search_hits'], cache['search_lookups'])}")
+    for error, count in summary["errors"].items():
+        print(f"  {count} x {error}")
+
+
+def print_comparison(previous, summary):
+    if previous["config"] != summary["config"]:
+        print("Note: the previous run used different settings:", json.dumps(previous["config"], sort_keys=True))
+    print("Compared with the previous run:")
+    for action, stats in summary["actions"].items():
+        previous_stats = previous["summary"]["actions"].get(action)
+        if previous_stats is None:
+            continue
+        changes = []
+        for p in PERCENTILES:
+            old, new = previous_stats[f"p{p}_ms"], stats[f"p{p}_ms"]
+            changes.append(f"p{p} {old:.1f} -> {new:.1f} ms ({100 * (new - old) / old:+.0f}%)" if old else f"p{p} {new:.1f} ms")
+        print(f"  {action:<12} " + ", ".join(changes))
+    old, new = previous["summary"]["throughput"], summary["throughput"]
+    print(f"  throughput   {old:.1f} -> {new:.1f} requests/s ({100 * (new - old) / old:+.0f}%)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Concurrent load test for the web app against a synthetic Messages database.")
+    parser.add_argument("--db", help="database to use (default: a synthetic one, generated on first use)")
+    parser.add_argument("--messages", type=int, default=100000, help="size of the synthetic database")
+    parser.add_argument("--contacts", type=int, default=40)
+    parser.add_argument("--groups", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0, help="seeds the database and every session's requests")
+    parser.add_argument("--sessions", type=int, default=8, help="concurrent sessions")
+    parser.add_argument("--requests", type=int, default=50, help="actions per session")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"relative weights of browse, search, expand and refresh (default {DEFAULT_MIX})")
+    parser.add_argument("--think-time", type=float, default=0, help="mean seconds between a session's actions")
+    parser.add_argument("--warm", action="store_true", help="warm every thread into the cache before starting")
+    parser.add_argument("--url", help="base URL of a running server to test instead of the app in this process")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds before an HTTP request counts as an error")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="compare with results written earlier by --json")
+    args = parser.parse_args(argv)
+    weights = parse_mix(args.mix)
+
+    db_path = args.db
+    if db_path is None:
+        db_path = os.path.join(LOAD_TEST_DB_DIR, f"chat-{args.messages}-{args.contacts}-{args.groups}-{args.seed}.db")
+        if not os.path.exists(db_path):
+            os.makedirs(LOAD_TEST_DB_DIR, exist_ok=True)
+            generated = generate_chat_db(
+                db_path, num_messages=args.messages, num_contacts=args.contacts, num_groups=args.groups, seed=args.seed
+            )
+            print(f"Generated {db_path} ({generated['messages']} messages) in {generated['seconds']}s")
+    if args.url:
+        print(f"Testing {args.url}; it should be serving {db_path} (MESSAGESCORPUS_DB_PATHS)")
+        make_client = lambda: http_client(args.url, args.timeout)
+    else:
+        os.environ["MESSAGESCORPUS_DB_PATHS"] = os.path.abspath(db_path)
+        make_client = in_process_client
+
+    get = make_client()
+    status, _, body = get("/conversations")
+    if status != 200:
+        print(f"/conversations returned {status}: {body[:200]}", file=sys.stderr)
+        return 1
+    names = [conversation["name"] for conversation in json.loads(body)["conversations"]]
+    if args.warm:
+        get("/warmup", method="POST")
+        while json.loads(get("/warmup")[2])["status"] == "running":
+            time.sleep(0.2)
+
+    sessions = [make_client() for _ in range(args.sessions)]
+    session_results = [None] * args.sessions
+    start_barrier = threading.Barrier(args.sessions + 1)
+
+    def session_thread(session_idx):
+        session_results[session_idx] = run_session(session_idx, sessions[session_idx], names, args, weights, start_barrier)
+
+    threads = [threading.Thread(target=session_thread, args=(session_idx,)) for session_idx in range(args.sessions)]
+    for thread in threads:
+        thread.start()
+    start_barrier.wait()
+    started_at = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    wall_seconds = time.perf_counter() - started_at
+
+    results = [result for session in session_results for result in session or []]
+    summary = summarize(results, wall_seconds)
+    config = {
+        "db": os.path.basename(db_path),
+        "target": args.url or "in-process",
+        "sessions": args.sessions,
+        "requests": args.requests,
+        "mix": args.mix,
+        "think_time": args.think_time,
+        "seed": args.seed,
+        "warm": args.warm,
+    }
+    summary["config"] = config
+    print(f"{args.sessions} sessions x {args.requests} actions against {config['target']} ({db_path}):")
+    print_summary(summary)
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(json.load(f), summary)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"config": config, "summary": summary}, f, indent=2)
+    return 1 if summary["actions"]["all"]["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
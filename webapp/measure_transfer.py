@@ -0,0 +1,115 @@
+import argparse
+import re
+import sys
+from urllib.parse import urlencode
+
+from app import app
+
+
+"""
+Measures the bytes the web app sends per page navigation, as a browser would fetch them.
+
+A scripted sequence of navigations (opening conversations, searching, expanding context, going back) is replayed twice
+through the Flask test client: once as a client with no HTTP cache and no compression, which is what every navigation
+cost when the CSS and JS were inlined and pages had no validators, and once as a browser that sends Accept-Encoding,
+revalidates pages with If-None-Match and keeps versioned static files. Each navigation fetches the page, its stylesheet
+and script, and the sidebar's /conversations list. Run from the repo root with:
+
+    PYTHONPATH=. python webapp/measure_transfer.py --name Dan --query dinner
+"""
+
+ASSET_RE = re.compile(r'(?:href|src)="(/static/[^"]+)"')
+
+
+def build_navigations(names, query):
+    navigations = [("home", {})]
+    for name in names:
+        navigations.append((f"open {name}", {"name": name}))
+    name = names[0]
+    search = {"name": name, "search_form": "1", "query": query, "ignore_case": "on", "most_recent": "on", "context": "3"}
+    navigations.append((f"search {name}", search))
+    navigations.append((f"expand context {name}", dict(search, expanded_match="0", extra_before="5", extra_after="5")))
+    navigations.append((f"back to search {name}", search))
+    for name in names:
+        navigations.append((f"back to {name}", {"name": name}))
+    navigations.append(("home again", {}))
+    return navigations
+
+
+def fetch(client, url, browser_cache, headers):
+    """GETs url, revalidating with the cached ETag if there is one; returns (bytes on the wire, status, body)."""
+    request_headers = dict(headers)
+    cached = browser_cache.get(url) if browser_cache is not None else None
+    if cached is not None:
+        request_headers["If-None-Match"] = cached["etag"]
+    response = client.get(url, headers=request_headers)
+    data = response.get_data()
+    wire_bytes = len(data) + sum(len(key) + len(value) + 4 for key, value in response.headers.items())
+    if response.status_code == 304:
+        return wire_bytes, 304, cached["body"]
+    body = response.get_data(as_text=True) if response.headers.get("Content-Encoding") is None else None
+    if browser_cache is not None and response.headers.get("ETag"):
+        browser_cache[url] = {"etag": response.headers["ETag"], "body": body}
+    return wire_bytes, response.status_code, body
+
+
+def replay(navigations, cached):
+    """
+    Replays the navigations and returns [(label, page bytes, asset bytes, conversations bytes, page status)].
+    With `cached`, requests accept gzip/brotli, pages are revalidated and versioned static files are fetched once.
+    """
+
+    client = app.test_client()
+    headers = {"Accept-Encoding": "br, gzip"} if cached else {}
+    browser_cache = {} if cached else None
+    static_cache = set()
+    results = []
+    for label, params in navigations:
+        page_url = "/?" + urlencode(params) if params else "/"
+        page_bytes, status, body = fetch(client, page_url, browser_cache, headers)
+        if body is None:
+            # Compressed; fetch it again uncompressed (not counted) just to find the asset URLs
+            body = client.get(page_url).get_data(as_text=True)
+        asset_bytes = 0
+        for asset_url in ASSET_RE.findall(body):
+            if cached and asset_url in static_cache:
+                continue  # Fresh in the browser cache for a year; no request at all
+            asset_bytes += fetch(client, asset_url, None, headers)[0]
+            static_cache.add(asset_url)
+        conversations_bytes = fetch(client, "/conversations", browser_cache, headers)[0]
+        results.append((label, page_bytes, asset_bytes, conversations_bytes, status))
+    return results
+
+
+def print_results(title, results):
+    print(title)
+    print(f"  {'navigation':<32} {'page':>9} {'assets':>9} {'sidebar':>9} {'total':>9}  status")
+    for label, page_bytes, asset_bytes, conversations_bytes, status in results:
+        total = page_bytes + asset_bytes + conversations_bytes
+        print(f"  {label:<32} {page_bytes:>9} {asset_bytes:>9} {conversations_bytes:>9} {total:>9}  {status}")
+    total = sum(page + assets + sidebar for _, page, assets, sidebar, _ in results)
+    print(f"  {'total':<32} {'':>9} {'':>9} {'':>9} {total:>9}  ({total / len(results):.0f} bytes per navigation)")
+    return total
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure bytes transferred per web app navigation, with and without HTTP caching and compression.")
+    parser.add_argument("--name", action="append", dest="names", help="conversation to open (repeat for several; default: the two most recently active)")
+    parser.add_argument("--query", default="the", help="search to run in the first conversation")
+    args = parser.parse_args(argv)
+    names = args.names
+    if not names:
+        conversations = app.test_client().get("/conversations").get_json()["conversations"]
+        names = [conversation["name"] for conversation in conversations[:2]]
+    navigations = build_navigations(names, args.query)
+
+    # Load every thread first, so both passes see the same (warm) data versions
+    replay(navigations, cached=False)
+    uncached_total = print_results("No HTTP cache, no compression:", replay(navigations, cached=False))
+    cached_total = print_results("Browser cache with ETags and compression:", replay(navigations, cached=True))
+    print(f"{cached_total} bytes instead of {uncached_total} ({100 * cached_total / uncached_total:.1f}%)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
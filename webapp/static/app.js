@@ -0,0 +1,132 @@
+const nameFilterInput = document.getElementById("name_filter");
+const conversationList = document.getElementById("conversation-list");
+let conversationLinks = [];
+
+function filterConversations() {
+    const filterValue = nameFilterInput.value.trim().toLowerCase();
+    for (const link of conversationLinks) {
+        const conversationName = link.dataset.name || "";
+        link.style.display = conversationName.includes(filterValue) ? "block" : "none";
+    }
+}
+
+function buildConversationLink(conversation) {
+    const link = document.createElement("a");
+    link.className = "conversation-link";
+    if (conversation.name === conversationList.dataset.selected) {
+        link.classList.add("active");
+    }
+    link.href = `/?name=${encodeURIComponent(conversation.name)}`;
+    link.dataset.name = conversation.name.toLowerCase();
+    link.textContent = conversation.name;
+    const summary = document.createElement("span");
+    summary.className = "conversation-summary";
+    summary.textContent = `${conversation.message_count} messages, last ${conversation.last_timestamp.slice(0, 10)}`;
+    summary.title = `${conversation.last_sender}: ${conversation.preview}`;
+    link.appendChild(summary);
+    return link;
+}
+
+// Summaries are served with an ETag, so after the first load the browser only revalidates them
+fetch("/conversations")
+    .then((response) => response.json())
+    .then((data) => {
+        conversationLinks = data.conversations.map(buildConversationLink);
+        conversationList.replaceChildren(...conversationLinks);
+        filterConversations();
+    });
+
+if (nameFilterInput) {
+    nameFilterInput.addEventListener("input", filterConversations);
+}
+
+const threadRows = document.getElementById("thread-rows");
+
+function buildMessageRow(row) {
+    const rowElement = document.createElement("div");
+    rowElement.className = "message-row";
+    for (const [className, text] of [["timestamp", row.timestamp], ["sender", row.sender], ["message-text", row.message]]) {
+        const cell = document.createElement("div");
+        cell.className = className;
+        cell.textContent = text;
+        rowElement.appendChild(cell);
+    }
+    for (const attachment of row.attachments) {
+        const attachmentElement = document.createElement("div");
+        attachmentElement.className = "attachment";
+        const details = [attachment.mime_type, attachment.size_label].filter(Boolean).join(", ");
+        attachmentElement.textContent = (attachment.name || "attachment") + (details ? ` (${details})` : "");
+        rowElement.lastChild.appendChild(attachmentElement);
+    }
+    return rowElement;
+}
+
+function loadThreadPage(link) {
+    const older = link.dataset.direction === "older";
+    const params = new URLSearchParams({name: threadRows.dataset.name, limit: threadRows.dataset.pageSize});
+    params.set(older ? "before" : "after", older ? threadRows.dataset.start : threadRows.dataset.end);
+    link.classList.add("disabled");
+    fetch(`/thread_messages?${params}`)
+        .then((response) => response.json())
+        .then((page) => {
+            link.classList.remove("disabled");
+            if (page.error) {
+                return;
+            }
+            const rowElements = page.rows.map(buildMessageRow);
+            if (older) {
+                // Keep the rows already on screen where they are while older ones are added above them
+                const previousHeight = document.documentElement.scrollHeight;
+                threadRows.prepend(...rowElements);
+                window.scrollBy(0, document.documentElement.scrollHeight - previousHeight);
+                threadRows.dataset.start = page.start;
+                link.hidden = page.start === 0;
+            } else {
+                threadRows.append(...rowElements);
+                threadRows.dataset.end = page.end;
+                link.hidden = page.end >= page.total;
+            }
+        });
+}
+
+if (threadRows) {
+    for (const link of document.querySelectorAll(".thread-page-link")) {
+        link.addEventListener("click", (event) => {
+            event.preventDefault();
+            if (!link.classList.contains("disabled")) {
+                loadThreadPage(link);
+            }
+        });
+    }
+    const jumpTarget = document.getElementById("jump-target");
+    if (jumpTarget) {
+        jumpTarget.scrollIntoView({block: "center"});
+    }
+}
+
+const warmupStatus = document.getElementById("warmup-status");
+const warmupButton = document.getElementById("warmup-button");
+
+function pollWarmup() {
+    fetch("/warmup")
+        .then((response) => response.json())
+        .then((status) => {
+            if (status.status === "running") {
+                warmupStatus.textContent = `Warming cache: ${status.rows_processed} of ${status.total_rows} messages read.`;
+                setTimeout(pollWarmup, 1000);
+            } else if (status.status === "done") {
+                warmupStatus.textContent = `All ${status.cached_threads} conversations cached.`;
+            } else if (status.status === "error") {
+                warmupStatus.textContent = `Warm-up failed: ${status.error}`;
+            }
+        });
+}
+
+if (warmupButton) {
+    warmupButton.addEventListener("click", () => {
+        warmupButton.disabled = true;
+        fetch("/warmup", {method: "POST"}).then(pollWarmup);
+    });
+} else if (warmupStatus && warmupStatus.textContent.includes("Warming cache")) {
+    pollWarmup();
+}